@@ -0,0 +1,82 @@
+"""
+Micro-benchmark and tolerance check: text-page blurred background.
+
+Compares make_blurred_background (downsample, blur, upsample, one-pass lighten)
+against the previous full-resolution pipeline on a set of images, fails if
+the difference exceeds the tolerance, then times both.
+
+    python bench_background.py [image ...]
+"""
+import sys
+import time
+
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageStat
+
+from image_utils import make_blurred_background
+
+SIZE = (1024, 1024)
+# متوسط الفرق لكل قناة (من 255) وأقصى فرق مسموح لأي بكسل
+MAX_MEAN_DIFF = 2.0
+MAX_PIXEL_DIFF = 24
+
+
+def legacy_background(source):
+    """The previous create_text_page background, kept as reference."""
+    img = source.convert("RGB").resize(SIZE, Image.LANCZOS)
+    img = img.filter(ImageFilter.GaussianBlur(radius=30))
+    overlay = Image.new('RGB', SIZE, (255, 255, 255))
+    return Image.blend(img, overlay, 0.6)
+
+
+def synthetic_images():
+    """Stripes, blocks and a gradient: harder for a low-res blur than typical watercolor art."""
+    images = []
+    stripes = Image.new("RGB", (1024, 1024))
+    draw = ImageDraw.Draw(stripes)
+    for x in range(0, 1024, 16):
+        draw.rectangle((x, 0, x + 8, 1024), fill=(x % 256, (x * 3) % 256, 200))
+    images.append(stripes)
+
+    blocks = Image.new("RGB", (768, 1024), (250, 240, 220))
+    draw = ImageDraw.Draw(blocks)
+    draw.ellipse((200, 300, 560, 700), fill=(40, 90, 160))
+    draw.rectangle((0, 800, 768, 1024), fill=(60, 140, 70))
+    images.append(blocks)
+
+    gradient = Image.linear_gradient("L").resize((1024, 1024)).convert("RGB")
+    images.append(gradient)
+    return images
+
+
+def compare(a, b):
+    diff = ImageChops.difference(a, b)
+    mean = sum(ImageStat.Stat(diff).mean) / 3
+    peak = max(high for _, high in diff.getextrema())
+    return mean, peak
+
+
+def bench(fn, images, rounds=5):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for img in images:
+            fn(img)
+    return (time.perf_counter() - started) / (rounds * len(images))
+
+
+if __name__ == "__main__":
+    images = [Image.open(p) for p in sys.argv[1:]] or synthetic_images()
+
+    failed = False
+    for i, img in enumerate(images):
+        mean, peak = compare(legacy_background(img), make_blurred_background(img, SIZE))
+        ok = mean <= MAX_MEAN_DIFF and peak <= MAX_PIXEL_DIFF
+        failed |= not ok
+        print(f"Image {i}: mean diff {mean:.2f}, max diff {peak} {'OK' if ok else 'FAIL'}")
+    if failed:
+        sys.exit(1)
+
+    legacy = bench(legacy_background, images)
+    fast = bench(lambda img: make_blurred_background(img, SIZE), images)
+    print(f"Legacy: {legacy * 1000:7.1f} ms/page")
+    print(f"Fast:   {fast * 1000:7.1f} ms/page")
+    print(f"Speedup: {legacy / fast:6.1f}x")
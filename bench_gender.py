@@ -0,0 +1,92 @@
+"""
+Micro-benchmark: precompiled gender adaptation vs. the previous per-call implementation.
+
+Runs every page of every story through both implementations, checks that the
+output is identical, then times them.
+
+    python bench_gender.py [rounds]
+"""
+import re
+import sys
+import time
+
+from story_catalog import get_catalog
+from gender_adaptation import MASCULINE_TO_FEMININE, feminize_text, _feminize_word
+
+
+def legacy_apply_gender_replacements(text):
+    """The previous StoryManager._apply_gender_replacements (girl branch), kept as reference."""
+    # The table used to be rebuilt from a dict literal on every call
+    replacements = dict(MASCULINE_TO_FEMININE)
+
+    words = text.split()
+    new_words = []
+
+    # Tashkeel removal regex
+    tashkeel_pattern = re.compile(r'[\u0617-\u061A\u064B-\u0652]')
+
+    for word in words:
+        match = re.match(r"^([وفب]?)(.*?)([\.,!؟:\"]*)$", word)
+
+        if match:
+            prefix, body, suffix = match.groups()
+
+            clean_body = tashkeel_pattern.sub("", body)
+            clean_full_core = prefix + clean_body
+
+            clean_body = clean_body.replace("أ", "ا").replace("إ", "ا").replace("آ", "ا")
+            clean_full_core = clean_full_core.replace("أ", "ا").replace("إ", "ا").replace("آ", "ا")
+
+            if clean_full_core in replacements:
+                new_words.append(replacements[clean_full_core] + suffix)
+                continue
+
+            if clean_body in replacements:
+                new_words.append(prefix + replacements[clean_body] + suffix)
+                continue
+
+            if clean_body.startswith("ال") and clean_body[2:] in replacements:
+                new_words.append(prefix + "ال" + replacements[clean_body[2:]] + suffix)
+                continue
+
+            new_words.append(word)
+        else:
+            new_words.append(word)
+
+    return " ".join(new_words)
+
+
+def collect_pages():
+    catalog = get_catalog()
+    return [page.text.replace("{child_name}", "ليلى")
+            for key in catalog.keys()
+            for page in catalog.get(*key).pages]
+
+
+def bench(fn, pages, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for text in pages:
+            fn(text)
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    pages = collect_pages()
+
+    mismatches = [t for t in pages if legacy_apply_gender_replacements(t) != feminize_text(t)]
+    print(f"Pages: {len(pages)} | Mismatches: {len(mismatches)}")
+    if mismatches:
+        sys.exit(1)
+
+    legacy = bench(legacy_apply_gender_replacements, pages, rounds)
+    _feminize_word.cache_clear()
+    cold = bench(feminize_text, pages, 1)
+    warm = bench(feminize_text, pages, rounds)
+
+    per_page = lambda total, n: total / (n * len(pages)) * 1e6
+    print(f"Legacy:   {per_page(legacy, rounds):8.1f} µs/page")
+    print(f"Compiled: {per_page(cold, 1):8.1f} µs/page (cold cache)")
+    print(f"Compiled: {per_page(warm, rounds):8.1f} µs/page (warm cache)")
+    print(f"Speedup:  {legacy / warm:8.1f}x")
@@ -0,0 +1,77 @@
+"""
+Micro-benchmark: storybook PDF assembly with fpdf vs. the streaming writer in pdf_utils.
+
+Builds a book like the one main.py sends (JPEG cover and text pages, PNG art
+pages), assembles it with both writers and times them. The fpdf run is
+skipped if fpdf is not installed.
+
+    python bench_pdf.py [pages] [rounds]
+"""
+import os
+import sys
+import time
+import tempfile
+
+from PIL import Image, ImageDraw
+
+from pdf_utils import create_pdf
+
+
+def make_book(directory, pages):
+    """Cover + (text page, art page) per story page, with noisy art so sizes are realistic."""
+    cover = os.path.join(directory, "cover.jpg")
+    Image.effect_noise((1024, 1024), 60).convert("RGB").save(cover, quality=92, subsampling=0)
+    paths = [cover]
+    for i in range(pages):
+        text_page = os.path.join(directory, f"text_{i}.jpg")
+        img = Image.new("RGB", (1024, 1024), (250, 246, 236))
+        ImageDraw.Draw(img).text((120, 480), f"Page {i + 1}", fill=(40, 40, 40))
+        img.save(text_page, quality=92, subsampling=0)
+
+        art_page = os.path.join(directory, f"art_{i}.png")
+        noise = Image.effect_noise((256, 256), 40 + i).resize((1024, 1024), Image.BICUBIC)
+        Image.merge("RGB", (noise, noise.rotate(90), noise.rotate(180))).save(art_page)
+        paths += [text_page, art_page]
+    return paths
+
+
+def legacy_create_pdf(image_paths, output_path):
+    """The previous fpdf-based create_pdf, kept as reference."""
+    from fpdf import FPDF
+    pdf = FPDF(unit='mm', format=(210, 210))
+    for img_path in image_paths:
+        pdf.add_page()
+        pdf.image(img_path, x=0, y=0, w=210, h=210)
+    pdf.output(output_path)
+    return output_path
+
+
+def bench(fn, paths, output_path, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        fn(paths, output_path)
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    pages = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = make_book(directory, pages)
+        output = os.path.join(directory, "book.pdf")
+        input_kb = sum(os.path.getsize(p) for p in paths) // 1024
+
+        per_page = lambda total: total / (rounds * len(paths)) * 1e3
+        streaming = bench(create_pdf, paths, output, rounds)
+        print(f"Pages: {len(paths)} | Input: {input_kb} KB")
+        print(f"Streaming: {per_page(streaming):8.2f} ms/page | {os.path.getsize(output) // 1024} KB")
+
+        try:
+            import fpdf  # noqa: F401
+        except ImportError:
+            print("fpdf not installed, skipping the legacy writer")
+            sys.exit(0)
+        legacy = bench(legacy_create_pdf, paths, output, rounds)
+        print(f"fpdf:      {per_page(legacy):8.2f} ms/page | {os.path.getsize(output) // 1024} KB")
+        print(f"Speedup:   {legacy / streaming:8.1f}x")
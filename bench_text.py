@@ -0,0 +1,104 @@
+"""
+Micro-benchmark: text-page line wrapping with and without the shaping/measurement cache.
+
+Wraps every page of every story (as create_text_page used to) using uncached
+reshape + textbbox calls and using the shared caches in image_utils, checks
+that both and the linear-time layout engine (layout_text) produce the same
+lines, with no multi-word line wider than the limit, then times them.
+
+    python bench_text.py [rounds]
+"""
+import sys
+import time
+
+import arabic_reshaper
+from bidi.algorithm import get_display
+from PIL import Image, ImageDraw
+
+from story_catalog import get_catalog
+from image_utils import _get_arabic_font, _prepare_arabic_text, _text_bbox, _text_length, layout_text
+
+MAX_WIDTH = 1024 - 120 * 2
+NAMES = ["ليلى", "يوسف", "نور الهدى", "آدم"]
+
+
+def wrap(text, font, shape, bbox):
+    """The create_text_page wrapping loop, parameterized by the shaping/measuring functions."""
+    lines = []
+    current_line = []
+    for word in text.split():
+        current_line.append(word)
+        box = bbox(shape(" ".join(current_line)), font)
+        if box[2] - box[0] > MAX_WIDTH:
+            current_line.pop()
+            lines.append(" ".join(current_line))
+            current_line = [word]
+    if current_line:
+        lines.append(" ".join(current_line))
+    return lines
+
+
+_draw = ImageDraw.Draw(Image.new("RGB", (1024, 1024)))
+
+
+def legacy_shape(text):
+    return get_display(arabic_reshaper.reshape(text))
+
+
+def legacy_bbox(text, font):
+    return _draw.textbbox((0, 0), text, font=font)
+
+
+def collect_pages():
+    catalog = get_catalog()
+    return [page.text.replace("{child_name}", name)
+            for name in NAMES
+            for key in catalog.keys()
+            for page in catalog.get(*key).pages]
+
+
+def bench(shape, bbox, pages, font, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for text in pages:
+            wrap(text, font, shape, bbox)
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    font = _get_arabic_font(52, weight="regular")
+    pages = collect_pages()
+
+    mismatches = [t for t in pages
+                  if wrap(t, font, legacy_shape, legacy_bbox) != wrap(t, font, _prepare_arabic_text, _text_bbox)]
+    layout_mismatches = [t for t in pages
+                         if wrap(t, font, legacy_shape, legacy_bbox)
+                         != [line.text for line in layout_text(t, font, max_width=MAX_WIDTH, line_height=100).lines]]
+    too_wide = [line.text for t in pages
+                for line in layout_text(t, font, max_width=MAX_WIDTH, line_height=100).lines
+                if " " in line.text and line.width > MAX_WIDTH]
+    print(f"Pages: {len(pages)} | Mismatches: {len(mismatches)} cached, {len(layout_mismatches)} layout"
+          f" | Lines over {MAX_WIDTH}px: {len(too_wide)}")
+    if mismatches or layout_mismatches or too_wide:
+        sys.exit(1)
+
+    legacy = bench(legacy_shape, legacy_bbox, pages, font, rounds)
+    _prepare_arabic_text.cache_clear()
+    _text_bbox.cache_clear()
+    cold = bench(_prepare_arabic_text, _text_bbox, pages, font, 1)
+    warm = bench(_prepare_arabic_text, _text_bbox, pages, font, rounds)
+
+    for cache in (_prepare_arabic_text, _text_bbox, _text_length, layout_text):
+        cache.cache_clear()
+    started = time.perf_counter()
+    for text in pages:
+        layout_text(text, font, max_width=MAX_WIDTH, line_height=100)
+    layout = time.perf_counter() - started
+
+    per_page = lambda total, n: total / (n * len(pages)) * 1e3
+    print(f"Legacy: {per_page(legacy, rounds):8.2f} ms/page")
+    print(f"Cached: {per_page(cold, 1):8.2f} ms/page (cold cache)")
+    print(f"Cached: {per_page(warm, rounds):8.2f} ms/page (warm cache)")
+    print(f"Layout: {per_page(layout, 1):8.2f} ms/page (linear, cold cache)")
+    print(f"Speedup: {legacy / warm:7.1f}x (warm cache)")
@@ -0,0 +1,72 @@
+"""
+Check: page prompts stay within PROMPT_MAX_CHARS without losing the scene.
+
+Builds every catalog page prompt twice:
+- with a typical character description (a ~1350-char vision answer), where
+  every section (personality, composition, ...) must survive the budget;
+- with a very long description (as a verbose vision answer wrapped by
+  enhance_ai_description can produce), where each prompt must still end with
+  its SCENE ACTION and fit the budget.
+
+    python check_prompt_budget.py
+"""
+import sys
+
+from prompt_compiler import DEFAULT_MAX_CHARS
+from story_catalog import get_catalog
+from story_manager import StoryManager
+
+TYPICAL_CHAR_DESC = " ".join(
+    f"Feature {i}: warm skin tone number {i} with big dark almond eyes and curly hair shade {i}, shown clearly."
+    for i in range(13)
+)
+
+# أقسام اختيارية يجب أن تبقى في كتاب عادي
+OPTIONAL_MARKERS = ("CHARACTER PERSONALITY MEMORY", "COMPOSITION", "OUTFIT LOCK")
+
+LONG_CHAR_DESC = " ".join(
+    f"Detail {i}: the child has a distinctive feature number {i}, clearly visible in every scene."
+    for i in range(40)
+)
+
+
+def build_pages(char_desc):
+    for value, age_group in get_catalog().keys():
+        manager = StoryManager("ليلى", "بنت")
+        manager.inject_character_dna(char_desc)
+        manager.set_outfit_by_age(age_group)
+        manager.inject_personality(traits=[value, "curious", "imaginative", "kind"], core_value=value)
+        for page in manager.generate_story_prompts(value, age_group) or []:
+            yield value, age_group, page
+
+
+def check_sections_kept(char_desc):
+    failures = 0
+    for value, age_group, page in build_pages(char_desc):
+        missing = [marker for marker in OPTIONAL_MARKERS if marker not in page["prompt"]]
+        if missing:
+            failures += 1
+            print(f"❌ {value}/{age_group} page {page['page']}: dropped {missing}")
+    return failures
+
+
+def check(char_desc):
+    failures = 0
+    for value, age_group, page in build_pages(char_desc):
+            prompt = page["prompt"]
+            if "SCENE ACTION" not in prompt or len(prompt) > DEFAULT_MAX_CHARS:
+                failures += 1
+                print(f"❌ {value}/{age_group} page {page['page']}: {len(prompt)} chars, "
+                      f"scene {'kept' if 'SCENE ACTION' in prompt else 'missing'}")
+    return failures
+
+
+if __name__ == "__main__":
+    print(f"Typical description: {len(TYPICAL_CHAR_DESC)} chars | Budget: {DEFAULT_MAX_CHARS}")
+    kept_failures = check_sections_kept(TYPICAL_CHAR_DESC)
+    print("✅ Every page kept every section" if not kept_failures else f"❌ {kept_failures} pages lost sections")
+
+    print(f"Long description: {len(LONG_CHAR_DESC)} chars | Budget: {DEFAULT_MAX_CHARS}")
+    failures = check(LONG_CHAR_DESC)
+    print("✅ Every page kept its scene" if not failures else f"❌ {failures} pages failed")
+    sys.exit(1 if failures or kept_failures else 0)
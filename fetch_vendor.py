@@ -0,0 +1,53 @@
+"""
+Fetch the page-flip library into vendor/ so flipbooks work offline.
+
+Downloads the page-flip 2.0.7 package from the npm registry, checks it
+against the integrity hash the registry publishes for it, and extracts
+dist/js/page-flip.browser.js and its LICENSE into vendor/. Commit both
+files; create_html_flipbook() then copies or inlines the library instead
+of loading it from the CDN.
+
+    python fetch_vendor.py
+"""
+import os
+import sys
+import base64
+import hashlib
+import tarfile
+from io import BytesIO
+
+import requests
+
+PACKAGE = "page-flip"
+VERSION = "2.0.7"
+REGISTRY_URL = f"https://registry.npmjs.org/{PACKAGE}/{VERSION}"
+VENDOR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vendor")
+
+# member of the npm tarball -> file in vendor/
+FILES = {
+    "package/dist/js/page-flip.browser.js": "page-flip.browser.js",
+    "package/LICENSE": "page-flip.LICENSE",
+}
+
+
+def verify(data, integrity):
+    """Checks an npm "sha512-<base64>" integrity string."""
+    algorithm, _, expected = integrity.partition("-")
+    digest = base64.b64encode(hashlib.new(algorithm, data).digest()).decode("ascii")
+    return digest == expected
+
+
+if __name__ == "__main__":
+    meta = requests.get(REGISTRY_URL, timeout=30).json()
+    tarball = requests.get(meta["dist"]["tarball"], timeout=60).content
+    if not verify(tarball, meta["dist"]["integrity"]):
+        print(f"❌ {PACKAGE}@{VERSION}: tarball does not match the registry integrity hash")
+        sys.exit(1)
+
+    os.makedirs(VENDOR_DIR, exist_ok=True)
+    with tarfile.open(fileobj=BytesIO(tarball), mode="r:gz") as archive:
+        for member, name in FILES.items():
+            data = archive.extractfile(member).read()
+            with open(os.path.join(VENDOR_DIR, name), "wb") as f:
+                f.write(data)
+            print(f"✅ vendor/{name}: {len(data) // 1024} KB")
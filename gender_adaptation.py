@@ -0,0 +1,251 @@
+"""
+Gender adaptation for story text (masculine -> feminine Egyptian Arabic).
+
+The replacement table and regexes are compiled once at import; each distinct
+word is resolved once and cached.
+"""
+
+import re
+from functools import lru_cache
+
+# Dictionary of Masculine -> Feminine replacements
+MASCULINE_TO_FEMININE = {
+    # Nouns/Titles
+    "بطل": "بطلة",
+    "ولد": "بنت",
+    "صديق": "صديقة",
+    "ابني": "بنتي",
+    "يا حبيبي": "يا حبيبتي",
+    "حبيبي": "حبيبتي",
+    "مستكشف": "مستكشفة",
+    "شاطر": "شاطرة",
+    "صغير": "صغيرة",
+    "جميل": "جميلة",
+    "كبير": "كبيرة",
+    "مخضوض": "مخضوضة",
+    "آسف": "آسفة",
+    "غلطان": "غلطانة",
+
+    # Pronouns/Suffixes
+    "هو": "هي",
+    "هم": "هن",
+    "أنت": "أنتي",
+    "لك": "ليكي",
+    "بنفسه": "بنفسها",
+    "نفسه": "نفسها",
+    "لنفسه": "لنفسها",
+    "لوحده": "لوحدها",
+    "صاحبه": "صاحبتها",
+    "أخوه": "أخوها",
+    "جده": "جدها",
+    "إيده": "إيدها",
+    "رجله": "رجلها",
+    "بؤه": "بؤها",
+    "قلبه": "قلبها",
+    "حواليه": "حواليها",
+    "وراه": "وراها",
+    "مكانه": "مكانها",
+    "بيته": "بيتها",
+    "أصحابه": " أصحابها",
+    "سريره": "سريرها",
+    "شنطته": "شنطتها",
+    "لعبته": "لعبتها",
+    "هدومه": "هدومها",
+    "إنه": "إنها",
+    "له": "لها",
+    "عنده": "عندها",
+    "منه": "منها",
+    "شجاعته": "شجاعتها",
+
+    # Adjectives / States
+    "شجاع": "شجاعة",
+    "ذكي": "ذكية",
+    "متعاون": "متعاونة",
+    "مؤدب": "مؤدبة",
+    "محترم": "محترمة",
+    "لطيف": "لطيفة",
+    "حنين": "حنينة",
+    "مبسوط": "مبسوطة",
+    "فرحان": "فرحانة",
+    "زعلان": "زعلانة",
+    "خايف": "خايفة",
+    "تعبان": "تعبانة",
+    "وحيد": "وحيدة",
+    "جديد": "جديدة",
+    "طيب": "طيبة",
+    "واقف": "واقفة",
+    "قاعد": "قاعدة",
+    "ماسك": "ماسكة",
+    "نايم": "نايمة",
+    "جاهز": "جاهزة",
+    "مستعد": "مستعدة",
+    "عايز": "عايزة",
+    "واثقة": "واثقة", # Already fem usually but good to have
+    "سعيد": "سعيدة",
+    "رايح": "رايحة",
+
+    # Verbs (Past)
+    "قال": "قالت",
+    "كان": "كانت",
+    "حب": "حبت",
+    "حس": "حست",
+    "افتكر": "افتكرت",
+    "وقع": "وقعت",
+    "قرر": "قررت",
+    "طلع": "طلعت",
+    "عدى": "عدت",
+    "مد": "مدت",
+    "شد": "شدت",
+    "قدر": "قدرت",
+    "شاف": "شافت",
+    "أنقذ": "أنقذت",
+    "قام": "قامت",
+    "فتح": "فتحت",
+    "ضحك": "ضحكت",
+    "وقف": "وقفت",
+    "لبس": "لبست",
+    "ابتسم": "ابتسمت",
+    "وصل": "وصلت",
+    "لقاها": "لقتها",
+    "مشي": "مشيت",
+    "قعد": "قعدت",
+    "رجع": "رجعت",
+    "خلص": "خلصت",
+    "جاب": "جابت",
+    "بدأ": "بدأت",
+    "فكر": "فكرت",
+    "وسع": "وسعت",
+    "نزل": "نزلت",
+    "صرخ": "صرخت",
+    "اتعلم": "اتعلمت",
+    "ساب": "سابت",
+    "راح": "راحت",
+    "لف": "لفت",
+    "قسم": "قسمت",
+    "عمل": "عملت",
+    "همس": "همست",
+    "قرب": "قربت",
+    "خطف": "خطفت",
+    "استأذن": "استأذنت",
+    "انتبه": "انتبهت",
+    "استخبى": "استخبت",
+    "شاور": "شاورت",
+    "دلق": "دلقت",
+    "عرف": "عرفت",
+    "ساعده": "ساعدها",
+    "كدب": "كدبت",
+    "حط": "حطت",
+    "حضنه": "حضنته",
+    "زعل": "زعلت", 
+    "عاش": "عاشت",
+    
+    # Verbs (Present)
+    "بيحب": "بتحب",
+    "بيلعب": "بتلعب",
+    "بيسلم": "بتسلم",
+    "بيستخبى": "بتستخبى",
+    "بيمد": "بتمد",
+    "بيقف": "بتقف",
+    "بيمشي": "بتمشي",
+    "بيتوازن": "بتتوازن",
+    "بيدور": "بتدور",
+    "بيفتش": "بتفتش",
+    "بيبعد": "بتبعد",
+    "بيجري": "بتجري",
+    "بيقول": "بتقول",
+    "بيصرخ": "بتصرخ",
+    "بيعيط": "بتعيط",
+    "بيشارك": "بتشارك",
+    "بيديها": "بتديها",
+    "بيرتبهم": "بترتبهم",
+    "بيتخيل": "بتتخيل",
+    "بيحضر": "بتحضر",
+    
+    # Imperative / Future
+    "تعالى": "تعالي",
+    "هيقابلهم": "هتقابلهم",
+    "مبقاش": "مبقتش",
+    "ماجاش": "ماجاتش",
+    "مستخباش": "مستخبتش",
+
+    # Verbs (Y-prefix -> T-prefix)
+    "يضحك": "تضحك",
+    "يبتسم": "تبتسم",
+    "يقول": "تقول",
+    "يروح": "تروح",
+    "يسيبه": "تسيبه", 
+    "يعمل": "تعمل",
+    "ينقذ": "تنقذ",
+    "يكون": "تكون",
+    "يصحى": "تصحى",
+    "يزعل": "تزعل",
+    "يقدر": "تقدر",
+    "يرتاح": "ترتاح",
+    "يعوز": "تعوز",
+    "يطلبها": "تطلبها",
+    "يضرب": "تضرب",
+    "يطبطب": "تطبطب",
+    "يشدها": "تشدها",
+    "يأذيها": "تأذيها",
+    "ياخد": "تاخد",
+    "يشده": "تشده",
+    "يخطفه": "تخطفه",
+    "يجيب": "تجيب",
+    "يحس": "تحس",
+    "يخاف": "تخاف",
+    "يجيبه": "تجيبه",
+    "يحضر": "تحضر",
+    "يساعد": "تساعد",
+    "يشيل": "تشيل",
+    "يرتب": "ترتب",
+    "يكلم": "تكلم",
+    "يسمع": "تسمع",
+    "يحترم": "تحترم"
+}
+
+# Tashkeel removal regex
+_TASHKEEL_RE = re.compile(r'[\u0617-\u061A\u064B-\u0652]')
+
+# Split a word into (prefix waw/fa/ba, body, trailing punctuation)
+_WORD_PARTS_RE = re.compile(r"^([وفب]?)(.*?)([\.,!؟:\"]*)$")
+
+_ALEF_TABLE = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا"})
+
+
+@lru_cache(maxsize=16384)
+def _feminize_word(word):
+    """Feminine form of a single whitespace-delimited word (memoized per word)."""
+    match = _WORD_PARTS_RE.match(word)
+    if not match:
+        return word
+    prefix, body, suffix = match.groups()
+
+    # Remove tashkeel and normalize alef for lookup
+    clean_body = _TASHKEEL_RE.sub("", body).translate(_ALEF_TABLE)
+
+    # Strategy 1: Check FULL word
+    replacement = MASCULINE_TO_FEMININE.get(prefix.translate(_ALEF_TABLE) + clean_body)
+    if replacement is not None:
+        return replacement + suffix
+
+    # Strategy 2: Check BODY only
+    replacement = MASCULINE_TO_FEMININE.get(clean_body)
+    if replacement is not None:
+        return prefix + replacement + suffix
+
+    # Strategy 3: Check "Al-" + body
+    if clean_body.startswith("ال"):
+        replacement = MASCULINE_TO_FEMININE.get(clean_body[2:])
+        if replacement is not None:
+            return prefix + "ال" + replacement + suffix
+
+    return word
+
+
+def feminize_text(text):
+    """
+    Adapts a page of Arabic text from masculine to feminine in one pass over
+    its words. Words repeat heavily across pages and stories, so each distinct
+    word is resolved once and served from the cache afterwards.
+    """
+    return " ".join([_feminize_word(word) for word in text.split()])
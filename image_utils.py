@@ -1,10 +1,230 @@
-from PIL import Image, ImageDraw, ImageFont, ImageFilter
+from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageStat
 import os
 import requests
+from requests.adapters import HTTPAdapter
 import base64
+import html
+import shutil
+import time
+import hashlib
+import threading
+import multiprocessing
 from io import BytesIO
+from functools import lru_cache
+from typing import NamedTuple, Optional
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 import arabic_reshaper
 from bidi.algorithm import get_display
+from story_catalog import VALUE_ALIASES
+# ---------------------------------------------------------------------------
+# تحميل الصور من الروابط (جلسة مشتركة + كاش لكل كتاب)
+# ---------------------------------------------------------------------------
+
+FETCH_MAX_BYTES = 25 * 1024 * 1024   # أقصى حجم لرسمة يتم تحميلها
+FETCH_TIMEOUT = 15
+FETCH_DIR = "/tmp"
+FETCH_WORKERS = 4   # تحميلات متوازية لكل كتاب (prefetch)
+
+_http = requests.Session()
+_http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_http.mount("http://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+
+class FetchMetrics:
+    """مقاييس التحميل على مستوى العملية"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.downloads = 0
+        self.failures = 0
+        self.bytes = 0
+        self.total_ms = 0.0
+        self.cache_hits = 0
+
+    def record(self, size, elapsed_ms, ok=True):
+        with self._lock:
+            if ok:
+                self.downloads += 1
+                self.bytes += size
+                self.total_ms += elapsed_ms
+            else:
+                self.failures += 1
+
+    def hit(self):
+        with self._lock:
+            self.cache_hits += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "downloads": self.downloads,
+                "failures": self.failures,
+                "bytes": self.bytes,
+                "avg_ms": round(self.total_ms / self.downloads, 1) if self.downloads else 0,
+                "cache_hits": self.cache_hits
+            }
+
+_fetch_metrics = FetchMetrics()
+
+def get_fetch_stats():
+    return _fetch_metrics.snapshot()
+
+def _iter_body(response, chunk_size=64 * 1024):
+    """
+    أجزاء جسم الرد فور وصولها: iter_content في urllib3 2.x ينتظر حتى يمتلئ الجزء كاملاً،
+    فلا تُفحص المهلة أثناء تحميل بطيء. read1 يرجع بما وصل (إن كان متاحاً).
+    """
+    read1 = getattr(response.raw, "read1", None)
+    if read1 is None:
+        yield from response.iter_content(chunk_size=chunk_size)
+        return
+    while True:
+        chunk = read1(chunk_size, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
+def fetch_bytes(url, max_bytes=FETCH_MAX_BYTES, timeout=FETCH_TIMEOUT):
+    """
+    تحميل رابط عبر الجلسة المشتركة مع حد أقصى للحجم والوقت (يتوقف التحميل فور تجاوز الحد)
+
+    timeout في requests يحد كل اتصال أو قراءة على حدة فقط، فسيرفر يرسل البيانات
+    ببطء شديد يُبقي التحميل مفتوحاً بلا نهاية؛ لذلك نفس المهلة تُطبق على التحميل كاملاً.
+    """
+    started = time.perf_counter()
+    deadline = started + timeout
+    try:
+        with _http.get(url, timeout=timeout, stream=True) as response:
+            if response.status_code != 200:
+                print(f"❌ Image download failed: HTTP {response.status_code}")
+                _fetch_metrics.record(0, 0, ok=False)
+                return None
+
+            declared = response.headers.get("Content-Length")
+            if declared and declared.isdigit() and int(declared) > max_bytes:
+                print(f"❌ Image too large: {declared} bytes")
+                _fetch_metrics.record(0, 0, ok=False)
+                return None
+
+            buffer = BytesIO()
+            for chunk in _iter_body(response):
+                buffer.write(chunk)
+                if buffer.tell() > max_bytes:
+                    print(f"❌ Image exceeded {max_bytes} bytes while downloading")
+                    _fetch_metrics.record(0, 0, ok=False)
+                    return None
+                if time.perf_counter() > deadline:
+                    print(f"❌ Image download exceeded {timeout}s, aborting")
+                    _fetch_metrics.record(0, 0, ok=False)
+                    return None
+            data = buffer.getvalue()
+            elapsed = (time.perf_counter() - started) * 1000
+            _fetch_metrics.record(len(data), elapsed)
+            print(f"⬇️ Fetched {len(data) // 1024} KB in {elapsed:.0f} ms")
+            return data
+    except Exception as e:
+        print(f"❌ Error fetching {url[:60]}: {e}")
+        _fetch_metrics.record(0, 0, ok=False)
+        return None
+
+# صيغ تُحفظ كما هي عند تحويل الرابط لملف محلي
+LOCAL_IMAGE_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png"}
+
+class ImageFetchJob:
+    """
+    كاش لكتاب واحد: كل رسمة بعيدة تُحمّل مرة واحدة فقط.
+    - prefetch(urls): بدء التحميل في الخلفية (بالتوازي عبر الجلسة المشتركة)
+    - localize(url): ملف محلي بنفس المحتوى، لتمريره لعمليات الرسم وللـ PDF
+    """
+
+    def __init__(self, workers=FETCH_WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._url_locks = {}
+        self._bytes = {}    # url -> bytes
+        self._paths = {}    # url -> local path
+        self._pending = {}  # url -> Future (تحميل جارٍ في الخلفية)
+        self._executor = None
+
+    def _url_lock(self, url):
+        with self._lock:
+            return self._url_locks.setdefault(url, threading.Lock())
+
+    def _fetch(self, url):
+        with self._url_lock(url):
+            data = self._bytes.get(url)
+            if data is not None:
+                _fetch_metrics.hit()
+                return data
+            path = self._paths.get(url)
+            if path:
+                _fetch_metrics.hit()
+                with open(path, "rb") as f:
+                    return f.read()
+            data = fetch_bytes(url)
+            if data is not None:
+                self._bytes[url] = data
+            return data
+
+    def prefetch(self, sources):
+        """بدء تحميل الروابط وحفظها محلياً في الخلفية؛ localize بعدها ينتظر التحميل الجاري فقط"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-fetch")
+            for source in sources:
+                if isinstance(source, str) and source.startswith("http") \
+                        and source not in self._paths and source not in self._pending:
+                    self._pending[source] = self._executor.submit(self._localize, source)
+
+    def localize(self, source):
+        """
+        تحويل الرابط لمسار ملف محلي (المسارات المحلية تُعاد كما هي).
+        None إذا فشل التحميل أو لم يكن الملف صورة صالحة.
+        """
+        if not (isinstance(source, str) and source.startswith("http")):
+            return source
+        pending = self._pending.get(source)
+        if pending is not None:
+            return pending.result()
+        return self._localize(source)
+
+    def _localize(self, source):
+        path = self._paths.get(source)
+        if path:
+            _fetch_metrics.hit()
+            return path
+        data = self._fetch(source)
+        if data is None:
+            return None
+        base = os.path.join(FETCH_DIR, f"fetch_{hashlib.sha1(source.encode()).hexdigest()[:16]}")
+        try:
+            img = Image.open(BytesIO(data))
+            extension = LOCAL_IMAGE_EXTENSIONS.get(img.format)
+            if extension:
+                # نفس الملف كما وصل (الامتداد مهم: الـ PDF يحدد الصيغة منه)
+                path = base + extension
+                with open(path, "wb") as f:
+                    f.write(data)
+            else:
+                # صيغ لا يقرؤها الـ PDF (مثل WebP) تُرمّز مرة واحدة هنا
+                path = save_image(img.convert("RGB"), base, ENCODE_PDF).path
+        except (OSError, Image.UnidentifiedImageError) as e:
+            # ملف تالف أو ليس صورة: الصفحة تكمل بدون الرسمة بدلاً من إفشال الكتاب كله
+            print(f"❌ Downloaded file is not a valid image ({source}): {e}")
+            return None
+        with self._url_lock(source):
+            self._paths[source] = path
+            self._bytes.pop(source, None)  # المحتوى صار على القرص
+        return path
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)  # التحميلات الجارية تنتهي قبل تفريغ الكاش
+        with self._lock:
+            self._pending.clear()
+            self._bytes.clear()
+
 def get_image_source(source):
     """
     دالة ذكية لفتح الصورة سواء كانت رابط URL أو مسار ملف محلي (مثل مخرجات Flux)
@@ -12,8 +232,8 @@ def get_image_source(source):
     try:
         # إذا كان المدخل رابط يبدأ بـ http
         if isinstance(source, str) and source.startswith("http"):
-            response = requests.get(source, timeout=15)
-            return Image.open(BytesIO(response.content))
+            data = fetch_bytes(source)
+            return Image.open(BytesIO(data)) if data else None
         
         # إذا كان مسار ملف موجود على السيرفر (/tmp/...)
         elif isinstance(source, str) and os.path.exists(source):
@@ -28,9 +248,55 @@ def get_image_source(source):
         print(f"❌ Error in get_image_source: {e}")
         return None
 # ---------------------------------------------------------------------------
+# تحميل وتجهيز صور إيصالات الدفع قبل إرسالها لنموذج الرؤية
+# ---------------------------------------------------------------------------
+
+SCREENSHOT_MAX_BYTES = 10 * 1024 * 1024   # أقصى حجم مسموح لتحميل الصورة
+SCREENSHOT_MAX_SIDE = 1280                # أطول ضلع بعد التصغير (النص يبقى مقروءاً)
+SCREENSHOT_JPEG_QUALITY = 80
+
+def download_image_bytes(url, max_bytes=SCREENSHOT_MAX_BYTES, timeout=15):
+    """
+    تحميل صورة من رابط مع حد أقصى للحجم والوقت (يتوقف التحميل فور تجاوز الحد)
+    """
+    return fetch_bytes(url, max_bytes=max_bytes, timeout=timeout)
+
+def normalize_screenshot(image_bytes, max_side=SCREENSHOT_MAX_SIDE, quality=SCREENSHOT_JPEG_QUALITY):
+    """
+    تصغير الصورة وإعادة ترميزها JPEG مضغوط مع الحفاظ على وضوح النص،
+    وحساب بصمة (SHA-256) للصورة بعد التجهيز لاكتشاف الصور المكررة
+
+    Returns:
+        (jpeg_bytes, digest) أو (None, None) في حالة الفشل
+    """
+    try:
+        img = Image.open(BytesIO(image_bytes))
+        img.draft("RGB", (max_side, max_side))  # تصغير سريع أثناء فك ترميز JPEG
+        img = img.convert("RGB")
+        if max(img.size) > max_side:
+            img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        digest = hashlib.sha256(img.tobytes()).hexdigest()
+
+        buffer = BytesIO()
+        img.save(buffer, format="JPEG", quality=quality, optimize=True)
+        return buffer.getvalue(), digest
+    except Exception as e:
+        print(f"❌ Error in normalize_screenshot: {e}")
+        return None, None
+
+# ---------------------------------------------------------------------------
 # 1. محرك النصوص العربية (إصلاح الحروف الناقصة والروابط)
 # ---------------------------------------------------------------------------
 
+# نفس نصوص الصفحات وأسماء الأطفال تتكرر بين المستخدمين، فالتشكيل والقياس يُحفظان
+SHAPING_CACHE_SIZE = 4096
+MEASURE_CACHE_SIZE = 8192
+
+# سطح قياس مشترك (نفس fontmode الخاص بصور RGB) لحساب الأبعاد بدون رسم
+_measure_draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+
+@lru_cache(maxsize=SHAPING_CACHE_SIZE)
 def _prepare_arabic_text(text: str) -> str:
     """تحضير النص ليكون مقروءاً وصحيحاً برمجياً مع دعم كامل للحروف والروابط"""
     if not text: return ""
@@ -39,118 +305,479 @@ def _prepare_arabic_text(text: str) -> str:
     reshaped_text = arabic_reshaper.reshape(text)
     return get_display(reshaped_text)
 
+@lru_cache(maxsize=MEASURE_CACHE_SIZE)
+def _text_bbox(shaped_text, font, stroke_width=0):
+    """أبعاد النص المُشكّل (مثل draw.textbbox عند (0, 0)) مع كاش بمفتاح (النص، الخط)"""
+    return _measure_draw.textbbox((0, 0), shaped_text, font=font, stroke_width=stroke_width)
+
+@lru_cache(maxsize=MEASURE_CACHE_SIZE)
+def _text_length(shaped_text, font):
+    """عرض النص المُشكّل (مثل draw.textlength) مع كاش بمفتاح (النص، الخط)"""
+    return _measure_draw.textlength(shaped_text, font=font)
+
+def get_text_cache_stats():
+    """إحصائيات كاش التشكيل والقياس"""
+    return {
+        "shaping": _prepare_arabic_text.cache_info()._asdict(),
+        "bbox": _text_bbox.cache_info()._asdict(),
+        "length": _text_length.cache_info()._asdict(),
+    }
+
+FONTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+FONT_CACHE_SIZE = 64  # عدد كائنات FreeTypeFont المحفوظة (عائلة، وزن، حجم)
+
+class FontManager:
+    """
+    إدارة الخطوط على مستوى العملية:
+    - ترتيب الخطوط المرشحة يُحسم مرة واحدة لكل وزن
+    - ملف كل خط يُقرأ من القرص مرة واحدة وتتشاركه كل الأحجام
+    - كائنات FreeTypeFont محفوظة في LRU بمفتاح (العائلة، الوزن، الحجم)
+    """
+
+    def __init__(self, fonts_dir=FONTS_DIR, cache_size=FONT_CACHE_SIZE):
+        self.fonts_dir = fonts_dir
+        self._lock = threading.Lock()
+        self._font_bytes = {}  # path -> bytes
+        self._resolved = {}    # (family, weight) -> path أو None
+        self._load = lru_cache(maxsize=cache_size)(self._load_font)
+
+    @staticmethod
+    def _normalize_weight(weight):
+        return "bold" if (weight or "").lower() == "bold" else "regular"
+
+    def _candidates(self, family, weight):
+        suffix = "-Bold.ttf" if weight == "bold" else "-Regular.ttf"
+        # قائمة الخطوط بترتيب الأفضلية (NotoSansArabic يدعم كل الحروف العربية بدون نقص)
+        candidates = [
+            # المحاولة 1: NotoSansArabic (يدعم جميع Arabic Presentation Forms بدون استثناء)
+            os.path.join(self.fonts_dir, f"NotoSansArabic{suffix}"),
+            # المحاولة 2: خط Geeza Pro (ممتاز على Mac فقط)
+            "/System/Library/Fonts/GeezaPro.ttc",
+            # المحاولة 3: Almarai و Cairo (قد تكون فيهما حروف ناقصة)
+            os.path.join(self.fonts_dir, f"Almarai{suffix}"),
+            os.path.join(self.fonts_dir, f"Cairo{suffix}"),
+            # المحاولة 4: خط Arial (احتياطي)
+            "/System/Library/Fonts/Supplemental/Arial.ttf",
+        ]
+        if family:
+            candidates.insert(0, os.path.join(self.fonts_dir, f"{family}{suffix}"))
+        return candidates
+
+    def _read_bytes(self, path):
+        data = self._font_bytes.get(path)
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+            self._font_bytes[path] = data
+        return data
+
+    def resolve(self, family=None, weight="bold"):
+        """مسار أول خط صالح للعائلة والوزن (يُحسم مرة واحدة)"""
+        weight = self._normalize_weight(weight)
+        key = (family, weight)
+        if key in self._resolved:
+            return self._resolved[key]
+
+        with self._lock:
+            if key in self._resolved:
+                return self._resolved[key]
+            resolved = None
+            for font_path in self._candidates(family, weight):
+                try:
+                    if os.path.exists(font_path):
+                        ImageFont.truetype(BytesIO(self._read_bytes(font_path)), 12)
+                        resolved = font_path
+                        print(f"✅ Loaded Arabic font: {os.path.basename(font_path)} ({weight})")
+                        break
+                except Exception as e:
+                    self._font_bytes.pop(font_path, None)
+                    print(f"⚠️ Failed to load {font_path}: {e}")
+            if resolved is None:
+                print("⚠️ Using default PIL font (NO ARABIC SUPPORT)")
+            self._resolved[key] = resolved
+            return resolved
+
+    def _load_font(self, family, weight, size):
+        path = self.resolve(family, weight)
+        if path is None:
+            return ImageFont.load_default()
+        return ImageFont.truetype(BytesIO(self._font_bytes[path]), size)
+
+    def get(self, size, weight="bold", family=None):
+        return self._load(family, self._normalize_weight(weight), int(size))
+
+    def cache_info(self):
+        return self._load.cache_info()
+
+fonts = FontManager()
+
 def _get_arabic_font(size: int, weight: str = "bold") -> ImageFont.FreeTypeFont:
     """تحميل الخطوط مع ضمان دعم كامل للحروف العربية - NotoSansArabic أولاً (أفضل توافق)"""
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    fonts_dir = os.path.join(base_dir, "fonts")
-    suffix = "-Bold.ttf" if weight.lower() == "bold" else "-Regular.ttf"
-
-    # قائمة الخطوط بترتيب الأفضلية (NotoSansArabic يدعم كل الحروف العربية بدون نقص)
-    font_candidates = [
-        # المحاولة 1: NotoSansArabic (يدعم جميع Arabic Presentation Forms بدون استثناء)
-        os.path.join(fonts_dir, f"NotoSansArabic{suffix}"),
-        # المحاولة 2: خط Geeza Pro (ممتاز على Mac فقط)
-        "/System/Library/Fonts/GeezaPro.ttc",
-        # المحاولة 3: Almarai و Cairo (قد تكون فيهما حروف ناقصة)
-        os.path.join(fonts_dir, f"Almarai{suffix}"),
-        os.path.join(fonts_dir, f"Cairo{suffix}"),
-        # المحاولة 4: خط Arial (احتياطي)
-        "/System/Library/Fonts/Supplemental/Arial.ttf",
-    ]
-
-    for font_path in font_candidates:
-        try:
-            if os.path.exists(font_path):
-                font = ImageFont.truetype(font_path, size)
-                print(f"✅ Loaded Arabic font: {os.path.basename(font_path)}")
-                return font
-        except Exception as e:
-            print(f"⚠️ Failed to load {font_path}: {e}")
-            continue
-
-    print("⚠️ Using default PIL font (NO ARABIC SUPPORT)")
-    return ImageFont.load_default()
-
-def _detect_best_position(img):
-    """تحليل الصورة للعثور على أفضل مساحة (أغمق مساحة) للنص الأصفر"""
-    try:
-        w, h = img.size
-        # فحص الجزء العلوي (أول 30%) والجزء السفلي (آخر 30%)
-        top_slice = img.crop((0, 0, w, int(h * 0.3))).convert("L")
-        bottom_slice = img.crop((0, int(h * 0.7), w, h)).convert("L")
-        
-        top_bright = sum(top_slice.getdata()) / (w * int(h * 0.3))
-        bottom_bright = sum(bottom_slice.getdata()) / (w * (h - int(h * 0.7)))
-        
-        # نختار المنطقة الأغمق ليكون النص الأصفر بارزاً جداً
-        return "TOP" if top_bright < bottom_bright else "BOTTOM"
-    except:
-        return "BOTTOM"
+    return fonts.get(size, weight)
+
+# ---------------------------------------------------------------------------
+# محرك تخطيط السطور (Line Layout)
+# ---------------------------------------------------------------------------
+
+LAYOUT_CACHE_SIZE = 512
+
+class TextLine(NamedTuple):
+    text: str       # النص المنطقي للسطر
+    shaped: str     # النص بعد التشكيل وترتيب العرض (جاهز للرسم)
+    bbox: tuple     # أبعاد الحبر عند (0, 0) شاملة الحدود (stroke)
+
+    @property
+    def width(self):
+        return self.bbox[2] - self.bbox[0]
+
+class TextLayout:
+    """
+    نتيجة تخطيط فقرة: السطور المُشكّلة وأبعادها، جاهزة للرسم على أي صورة.
+    نفس الكائن يُعاد استخدامه (من الكاش) لكل صفحة تحمل نفس النص والخط.
+    """
+
+    def __init__(self, lines, font, line_height, stroke_width=0):
+        self.lines = tuple(lines)
+        self.font = font
+        self.line_height = line_height
+        self.stroke_width = stroke_width
+        self.width = max((line.width for line in self.lines), default=0)
+        self.height = len(self.lines) * line_height
+
+    def __len__(self):
+        return len(self.lines)
+
+    def draw(self, draw, canvas_width, start_y, fill, stroke_fill=None):
+        """رسم السطور في منتصف الصورة أفقياً بدءاً من start_y"""
+        for i, line in enumerate(self.lines):
+            lx = (canvas_width - line.width) // 2 - line.bbox[0]
+            ly = start_y + (i * self.line_height)
+            draw.text((lx, ly), line.shaped, font=self.font, fill=fill,
+                      stroke_width=self.stroke_width, stroke_fill=stroke_fill)
+
+def _break_lines(words, advances, space, max_width, ink_width, slack):
+    """
+    تقسيم الكلمات لسطور (greedy) في وقت خطي:
+    عرض السطر يُقدّر بمجموع عروض الكلمات + المسافات، بدون إعادة قياس السطر كاملاً.
+    التقدير يختلف عن عرض الحبر الفعلي ببضع نقاط (حواف الحروف)، لذلك إذا كان
+    ضمن slack من الحد يُقاس السطر المرشح فعلياً بـ ink_width (نفس قاعدة القياس القديمة).
+    """
+    lines = []
+    start = 0
+    line_width = 0
+    for i, advance in enumerate(advances):
+        if i > start:
+            estimate = line_width + space + advance
+            if abs(estimate - max_width) <= slack:
+                overflow = ink_width(" ".join(words[start:i + 1])) > max_width
+            else:
+                overflow = estimate > max_width
+            if overflow:
+                lines.append(" ".join(words[start:i]))
+                start = i
+                line_width = advance
+                continue
+        line_width += advance if i == start else space + advance
+    if start < len(words):
+        lines.append(" ".join(words[start:]))
+    return lines
+
+@lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def layout_text(text, font, max_width=None, line_height=None, stroke_width=0):
+    """
+    تخطيط نص عربي لسطور لا يتجاوز عرضها max_width
+
+    كل كلمة تُشكّل وتُقاس مرة واحدة (بالكاش المشترك)، ثم يُقسَّم النص في
+    مرور واحد، ثم يُشكّل كل سطر نهائي مرة واحدة للرسم.
+
+    Args:
+        max_width: أقصى عرض للسطر (None = سطر واحد)
+        line_height: المسافة بين بدايات السطور (الافتراضي: ارتفاع الخط)
+        stroke_width: سمك الحدود (يدخل في أبعاد الحبر للتوسيط)
+    """
+    words = text.split()
+    if max_width is None or len(words) < 2:
+        lines = [" ".join(words)]
+    else:
+        advances = [_text_length(_prepare_arabic_text(word), font) for word in words]
+        space = _text_length(" ", font)
+
+        def ink_width(line):
+            box = _text_bbox(_prepare_arabic_text(line), font)
+            return box[2] - box[0]
+
+        # عرض الحبر بدون الحدود (stroke) كما في التقسيم القديم، حتى تبقى نفس السطور
+        lines = _break_lines(words, advances, space, max_width, ink_width, slack=font.size // 2)
+
+    text_lines = []
+    for line in lines:
+        shaped = _prepare_arabic_text(line)
+        text_lines.append(TextLine(line, shaped, _text_bbox(shaped, font, stroke_width)))
+
+    if line_height is None:
+        ascent, descent = font.getmetrics()
+        line_height = ascent + descent
+    return TextLayout(text_lines, font, line_height, stroke_width)
+
+# نصوص الغلاف: العنوان ("بطل/بطلة <القيمة>") واسم الطفل
+COVER_TEXT_MAX_SIZE = 90
+COVER_TEXT_MIN_SIZE = 40
+COVER_TEXT_MAX_WIDTH = 700   # ترك مساحة كافية على الجوانب (162px من كل جهة)
+COVER_TEXT_STROKE = 10
+COVER_TITLE_PREFIXES = ("بطل", "بطلة")
+
+def _largest_fitting(make_layout, fits, min_size, max_size):
+    """بحث ثنائي عن أكبر حجم خط يحقق fits (العرض يزيد مع الحجم)"""
+    best = None
+    low, high = min_size, max_size
+    while low <= high:
+        size = (low + high) // 2
+        layout = make_layout(size)
+        if fits(layout):
+            best = layout
+            low = size + 1
+        else:
+            high = size - 1
+    return best
+
+@lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def fit_text(text, max_width, max_size=COVER_TEXT_MAX_SIZE, min_size=COVER_TEXT_MIN_SIZE,
+             weight="bold", stroke_width=0, max_lines=2):
+    """
+    أكبر حجم خط يجعل النص في سطر واحد أضيق من max_width.
+    إذا لم يتسع حتى بأصغر حجم (اسم طويل جداً) يُقسَّم على max_lines سطور.
+
+    Returns:
+        TextLayout جاهز للرسم
+    """
+    def single(size):
+        return layout_text(text, fonts.get(size, weight), stroke_width=stroke_width)
+
+    def multi(size):
+        return layout_text(text, fonts.get(size, weight), max_width=max_width, stroke_width=stroke_width)
+
+    layout = _largest_fitting(single, lambda l: l.width < max_width, min_size, max_size)
+    if layout is None and max_lines > 1:
+        layout = _largest_fitting(
+            multi, lambda l: l.width < max_width and len(l) <= max_lines, min_size, max_size
+        ) or multi(min_size)
+    return layout or single(min_size)
+
+def fit_cover_text(text):
+    return fit_text(text, COVER_TEXT_MAX_WIDTH, stroke_width=COVER_TEXT_STROKE)
+
+def precompute_title_fits(values=None):
+    """حساب مقاسات عناوين الغلاف مسبقاً (القيم ثابتة ومعروفة) عند بدء التشغيل"""
+    for value in values if values is not None else VALUE_ALIASES:
+        for prefix in COVER_TITLE_PREFIXES:
+            fit_cover_text(f"{prefix} {value}")
+
+# ---------------------------------------------------------------------------
+# اختيار مكان النص (Text Placement)
+# ---------------------------------------------------------------------------
+
+PLACEMENT_SAMPLE = 64          # التحليل يتم على نسخة مصغرة 64×64 من الإضاءة
+PLACEMENT_DETAIL_WEIGHT = 0.5  # وزن التفاصيل (التباين) مقابل الإضاءة في التقييم
+PLACEMENT_STEPS = 8            # عدد المواضع المجربة في كل نطاق
+
+def _placement_map(img):
+    """خريطة إضاءة مصغرة (L) للصورة - كل بكسل فيها متوسط مربع من الصورة الأصلية"""
+    return img.resize((PLACEMENT_SAMPLE, PLACEMENT_SAMPLE), Image.BOX).convert("L")
+
+def _score_region(lum_map, box, scale_x, scale_y):
+    """أقل = أفضل: منطقة غامقة (ليبرز النص الأصفر) وقليلة التفاصيل"""
+    x0, y0, x1, y1 = box
+    crop = lum_map.crop((
+        int(x0 * scale_x), int(y0 * scale_y),
+        max(int(x0 * scale_x) + 1, -int(-x1 * scale_x)), max(int(y0 * scale_y) + 1, -int(-y1 * scale_y))
+    ))
+    stat = ImageStat.Stat(crop)
+    return stat.mean[0] / 255 + PLACEMENT_DETAIL_WEIGHT * stat.stddev[0] / 128
+
+def find_text_region(img, box_width, box_height, y_ranges, lum_map=None):
+    """
+    البحث عن أفضل مكان لكتلة نص متمركزة أفقياً
+
+    Args:
+        box_width, box_height: أبعاد كتلة النص
+        y_ranges: قائمة (أعلى y، أدنى y) لبداية الكتلة، مثل [(60, 250), (700, 860)]
+        lum_map: خريطة الإضاءة المصغرة (لإعادة استخدامها بين عدة كتل)
+
+    Returns:
+        (x0, y0, x1, y1) بإحداثيات الصورة الأصلية
+    """
+    w, h = img.size
+    lum_map = lum_map or _placement_map(img)
+    scale_x, scale_y = lum_map.width / w, lum_map.height / h
+    x0 = max(0, (w - box_width) // 2)
+    x1 = min(w, x0 + box_width)
+
+    best = None
+    for y_min, y_max in y_ranges:
+        y_min = max(0, min(y_min, h - box_height))
+        y_max = max(y_min, min(y_max, h - box_height))
+        for i in range(PLACEMENT_STEPS + 1):
+            y = y_min + (y_max - y_min) * i // PLACEMENT_STEPS
+            box = (x0, y, x1, min(h, y + box_height))
+            score = _score_region(lum_map, box, scale_x, scale_y)
+            if best is None or score < best[0]:
+                best = (score, box)
+            if y_max == y_min:
+                break
+    return best[1]
+
+# ---------------------------------------------------------------------------
+# سياسة الترميز (Encoding Policy) حسب وجهة الصورة
+# ---------------------------------------------------------------------------
+
+ENCODE_MESSENGER = "messenger"  # معاينة ترسل في المحادثة: حجم صغير ورفع سريع
+ENCODE_PDF = "pdf"              # صفحات تُجمّع في الـ PDF: JPEG عالي الجودة (يُضمَّن كما هو)
+ENCODE_ARCHIVE = "archive"      # نسخة محفوظة بدون فقد
+ENCODE_DRAFT = "draft"          # معاينة أولية سريعة (تُستبدل بالنسخة النهائية)
+
+class EncodingProfile(NamedTuple):
+    format: str
+    extension: str
+    options: dict
+
+ENCODING_PROFILES = {
+    ENCODE_MESSENGER: EncodingProfile("JPEG", ".jpg", {"quality": 85, "optimize": True, "progressive": True}),
+    ENCODE_PDF: EncodingProfile("JPEG", ".jpg", {"quality": 92, "subsampling": 0, "optimize": True}),
+    ENCODE_ARCHIVE: EncodingProfile("WEBP", ".webp", {"lossless": True, "method": 4}),
+    ENCODE_DRAFT: EncodingProfile("JPEG", ".jpg", {"quality": 70, "progressive": True}),
+}
+
+class EncodeResult(NamedTuple):
+    path: str
+    format: str
+    bytes: int
+    encode_ms: float
+
+_last_encode = threading.local()
+
+def encoded_path(output_path, destination):
+    """مسار الملف بالامتداد الصحيح لصيغة الوجهة (مثل cover.png ← cover.jpg)"""
+    return os.path.splitext(output_path)[0] + ENCODING_PROFILES[destination].extension
+
+def save_image(img, output_path, destination=ENCODE_PDF) -> EncodeResult:
+    """
+    ترميز الصورة وحفظها حسب الوجهة، مع قياس زمن الترميز وحجم الملف
+
+    Returns:
+        EncodeResult (المسار الفعلي قد يختلف امتداده عن output_path)
+    """
+    profile = ENCODING_PROFILES[destination]
+    path = encoded_path(output_path, destination)
+    started = time.perf_counter()
+    img.save(path, format=profile.format, **profile.options)
+    result = EncodeResult(path, profile.format, os.path.getsize(path), (time.perf_counter() - started) * 1000)
+    _last_encode.result = result
+    print(f"🗜️ Encoded {os.path.basename(path)} ({destination}): {result.bytes // 1024} KB in {result.encode_ms:.0f} ms")
+    return result
+
+def last_encode_result() -> Optional[EncodeResult]:
+    """آخر ترميز تم في هذا الخيط (لإرفاقه بنتيجة مهمة الرسم)"""
+    return getattr(_last_encode, "result", None)
 
 # ---------------------------------------------------------------------------
 # 2. وظائف إنشاء الصور (تحسين البروز والوضوح)
 # ---------------------------------------------------------------------------
 
-def create_cover_page(image_url, value, child_name, gender, output_path):
-    """إنشاء الغلاف بملء الصفحة مع نصوص صفراء فائقة الوضوح"""
+# التمويه يتم على نسخة مصغرة بهذا المعامل ثم تُكبّر (التمويه القوي لا يحتاج دقة كاملة)
+BACKGROUND_BLUR_SCALE = 8
+
+def make_blurred_background(source, size, radius=30, lighten=0.6, scale=BACKGROUND_BLUR_SCALE):
+    """
+    خلفية مموهة ومفتحة من الرسمة:
+    تصغير ← تمويه بنصف قطر مُصغّر بنفس النسبة ← تكبير ← تفتيح في مرور واحد (جدول ألوان)
+    بدلاً من تمويه الصورة بدقتها الكاملة ثم دمجها مع طبقة بيضاء بنفس الحجم.
+    """
+    width, height = size
+    small_size = (max(1, width // scale), max(1, height // scale))
+    img = source.convert("RGB")
+    # BOX = متوسط المربع، وهو كافٍ لأن التمويه بعده يمحو أي تفاصيل
+    small = img.resize(small_size, Image.BOX)
+    small = small.filter(ImageFilter.GaussianBlur(radius=radius * small_size[0] / width))
+    # التفتيح: v * (1 - lighten) + 255 * lighten لكل قناة
+    lut = [int(round(v * (1 - lighten) + 255 * lighten)) for v in range(256)] * 3
+    return small.point(lut).resize((width, height), Image.BILINEAR)
+
+COVER_FINAL = "final"
+COVER_DRAFT = "draft"
+
+class CoverProfile(NamedTuple):
+    output_size: int      # ضلع الصورة الناتجة (التخطيط دائماً على 1024)
+    resample: int         # طريقة تحجيم الرسمة
+    blur_radius: float    # تمويه الخلفية (0 = بدون)
+    lighten: float        # نسبة التفتيح بالأبيض مع التمويه
+    destination: str      # سياسة الترميز
+
+COVER_PROFILES = {
+    # الغلاف النهائي من رسمة FLUX بالدقة الكاملة
+    COVER_FINAL: CoverProfile(1024, Image.LANCZOS, 0, 0.0, ENCODE_PDF),
+    # مسودة فورية (مثلاً من صورة الطفل) بنفس العنوان والاسم، ترسل قبل انتهاء الرسم
+    COVER_DRAFT: CoverProfile(512, Image.BILINEAR, 12, 0.15, ENCODE_DRAFT),
+}
+
+def create_cover_page(image_url, value, child_name, gender, output_path, destination=None, profile=COVER_FINAL,
+                      preview_path=None):
+    """
+    إنشاء الغلاف بملء الصفحة مع نصوص صفراء فائقة الوضوح
+
+    Args:
+        destination: سياسة الترميز (الافتراضي حسب profile)
+        profile: COVER_FINAL أو COVER_DRAFT (مسودة سريعة منخفضة الدقة)
+        preview_path: نسخة إضافية بترميز المحادثة (ENCODE_MESSENGER) من نفس الرسم،
+            لإرسالها للمستخدم بينما يبقى output_path بترميز الـ PDF
+
+    Returns:
+        مسار الملف الناتج (بامتداد صيغة الوجهة) أو None
+    """
     try:
         width, height = 1024, 1024
+        cover_profile = COVER_PROFILES[profile]
         art_source = get_image_source(image_url)
         if not art_source: return None
         
-        img = art_source.convert("RGB").resize((width, height), Image.LANCZOS)
+        if cover_profile.blur_radius:
+            img = make_blurred_background(art_source, (width, height),
+                                          radius=cover_profile.blur_radius, lighten=cover_profile.lighten)
+        else:
+            img = art_source.convert("RGB").resize((width, height), cover_profile.resample)
         draw = ImageDraw.Draw(img)
+        lum_map = _placement_map(img)
         
-        title_font = _get_arabic_font(115, weight="bold")
-        name_font = _get_arabic_font(105, weight="bold")
-
         main_fill = (255, 235, 0)
         stroke_color = (0, 0, 0) # أسود للحدود لضمان البروز
 
         # 1. العنوان المسطح في الأعلى
         prefix = "بطلة" if gender == "بنت" else "بطل"
         top_text = f"{prefix} {value}"
-        reshaped_top = _prepare_arabic_text(top_text)
         
-        # تصغير الخط تلقائياً وتوسيع الهوامش لضمان عدم اختفاء أي حرف (مثل القاف في الصدق)
-        current_title_size = 90 # تقليل الحجم الابتدائي قليلاً
-        max_title_width = 700   # ترك مساحة كافية على الجوانب (162px من كل جهة)
+        # أكبر خط يتسع للعنوان مع هوامش كافية لضمان عدم اختفاء أي حرف (مثل القاف في الصدق)
+        title_layout = fit_cover_text(top_text)
         
-        while current_title_size > 40:
-            title_font = _get_arabic_font(current_title_size, weight="bold")
-            bbox = draw.textbbox((0, 0), reshaped_top, font=title_font, stroke_width=10)
-            tw = bbox[2] - bbox[0]
-            if tw < max_title_width:
-                break
-            current_title_size -= 5
-            
-        tx, ty = (width - tw) // 2 - bbox[0], 80
-        draw.text((tx, ty), reshaped_top, font=title_font, fill=main_fill, 
-                  stroke_width=10, stroke_fill=stroke_color)
+        # مكان العنوان: أهدأ موضع قريب من أعلى الصفحة
+        _, title_y, _, _ = find_text_region(img, title_layout.width, title_layout.height,
+                                            y_ranges=[(50, 140)], lum_map=lum_map)
+        title_layout.draw(draw, width, title_y, fill=main_fill, stroke_fill=stroke_color)
 
-        # 2. اسم الطفل في الأسفل
-        reshaped_name = _prepare_arabic_text(child_name)
-        
-        current_name_size = 90
-        while current_name_size > 40:
-            name_font = _get_arabic_font(current_name_size, weight="bold")
-            n_bbox = draw.textbbox((0, 0), reshaped_name, font=name_font, stroke_width=10)
-            nw = n_bbox[2] - n_bbox[0]
-            if nw < max_title_width:
-                break
-            current_name_size -= 5
-            
-        nx, ny = (width - nw) // 2 - n_bbox[0], 860
-        draw.text((nx, ny), reshaped_name, font=name_font, fill=main_fill,
-                  stroke_width=10, stroke_fill=stroke_color)
+        # 2. اسم الطفل في الأسفل (الأسماء الطويلة جداً تنقسم على سطرين)
+        name_layout = fit_cover_text(child_name)
+        _, name_y, _, _ = find_text_region(img, name_layout.width, name_layout.height,
+                                           y_ranges=[(800, 880)], lum_map=lum_map)
+        name_layout.draw(draw, width, name_y, fill=main_fill, stroke_fill=stroke_color)
 
-        img.save(output_path, quality=100, subsampling=0) 
-        return output_path
+        if cover_profile.output_size != width:
+            img = img.resize((cover_profile.output_size, cover_profile.output_size), Image.BILINEAR)
+        if preview_path:
+            save_image(img, preview_path, ENCODE_MESSENGER)
+        return save_image(img, output_path, destination or cover_profile.destination).path
     except Exception as e:
         print(f"❌ Error in create_cover_page: {e}")
         return None
 
-def overlay_text_on_image(image_url, text, output_path):
+def overlay_text_on_image(image_url, text, output_path, destination=ENCODE_MESSENGER):
     """توزيع النص بذكاء في المساحات الفارغة بلون أصفر وبروز عالٍ"""
     try:
         width, height = 1024, 1024
@@ -159,8 +786,6 @@ def overlay_text_on_image(image_url, text, output_path):
         
         img = art_source.convert("RGB").resize((width, height), Image.LANCZOS)
         
-        # تحديد أفضل مكان للنص
-        position = _detect_best_position(img)
         draw = ImageDraw.Draw(img)
         
         font = _get_arabic_font(45, weight="bold")
@@ -168,44 +793,24 @@ def overlay_text_on_image(image_url, text, output_path):
         stroke_color = (0, 0, 0)
         
         # تقسيم النص لسطور
-        lines = []
-        words = text.split()
-        current_line = []
-        for word in words:
-            current_line.append(word)
-            test_line = " ".join(current_line)
-            if draw.textlength(_prepare_arabic_text(test_line), font=font) > 820:
-                current_line.pop()
-                lines.append(" ".join(current_line))
-                current_line = [word]
-        lines.append(" ".join(current_line))
-        
-        line_height = 60
-        total_height = len(lines) * line_height
+        layout = layout_text(text, font, max_width=820, line_height=60, stroke_width=10)
         
-        # اختيار الإحداثيات بناءً على ذكاء المساحة
-        if position == "TOP":
-            start_y = 60
-        else:
-            start_y = height - total_height - 100
+        # اختيار أغمق وأهدأ مساحة في الثلث العلوي أو السفلي (بعيداً عن وسط الرسمة)
+        bottom_y = height - layout.height - 100
+        _, start_y, _, _ = find_text_region(
+            img, layout.width + 40, layout.height,
+            y_ranges=[(60, int(height * 0.3)), (int(height * 0.7) - layout.height, bottom_y)]
+        )
         
-        for i, line in enumerate(lines):
-            line_reshaped = _prepare_arabic_text(line)
-            lw = draw.textlength(line_reshaped, font=font)
-            lx = (width - lw) // 2
-            ly = start_y + (i * line_height)
-            
-            # رسم النص بحدود سميكة جداً لضمان القراءة
-            draw.text((lx, ly), line_reshaped, font=font, fill=main_fill,
-                      stroke_width=10, stroke_fill=stroke_color)
+        # رسم النص بحدود سميكة جداً لضمان القراءة
+        layout.draw(draw, width, start_y, fill=main_fill, stroke_fill=stroke_color)
 
-        img.save(output_path, quality=100, subsampling=0)
-        return output_path
+        return save_image(img, output_path, destination).path
     except Exception as e:
         print(f"❌ Error in overlay_text_on_image: {e}")
         return None
 
-def create_text_page(text, output_path, background_source=None):
+def create_text_page(text, output_path, background_source=None, destination=ENCODE_PDF):
     """
     إنشاء صفحة نصية بجمالية عالية - تستخدم نسخة مموهة ومفتحة من الرسمة كخلفية
     لضمان "التلوين الكامل" وأن كل صفحة تحتوي على الصورة بشكل كامل
@@ -217,12 +822,8 @@ def create_text_page(text, output_path, background_source=None):
         if background_source:
             bg_img = get_image_source(background_source)
             if bg_img:
-                img = bg_img.convert("RGB").resize((width, height), Image.LANCZOS)
-                # تطبيق تمويه قوي جداً لجعل النص مقروءاً ولإعطاء شعور فني
-                img = img.filter(ImageFilter.GaussianBlur(radius=30))
-                # تفتيح الصورة لجعلها خلفية هادئة (Overlay white at 60% opacity)
-                overlay = Image.new('RGB', (width, height), (255, 255, 255))
-                img = Image.blend(img, overlay, 0.6)
+                # تمويه قوي جداً لجعل النص مقروءاً ولإعطاء شعور فني، ثم تفتيح (أبيض 60%)
+                img = make_blurred_background(bg_img, (width, height), radius=30, lighten=0.6)
             else:
                 img = Image.new("RGB", (width, height), color=(245, 245, 245))
         else:
@@ -238,77 +839,250 @@ def create_text_page(text, output_path, background_source=None):
         SAFE_MARGIN = 120 
         max_width = width - (SAFE_MARGIN * 2) 
 
-        lines = []
-        words = text.split()
-        current_line = []
-        
-        for word in words:
-            current_line.append(word)
-            test_line = " ".join(current_line)
-            reshaped_test = _prepare_arabic_text(test_line)
-            
-            bbox = draw.textbbox((0, 0), reshaped_test, font=font)
-            test_width = bbox[2] - bbox[0]
-            
-            if test_width > max_width:
-                current_line.pop()
-                lines.append(" ".join(current_line))
-                current_line = [word]
+        layout = layout_text(text, font, max_width=max_width, line_height=100)
+        start_y = (height - layout.height) // 2
         
-        if current_line:
-            lines.append(" ".join(current_line))
+        # رسم ظل خفيف جداً للنص لزيادة الفخامة والوضوح
+        # layout.draw(draw, width + 2, start_y + 1, fill=(200, 200, 200))
+        layout.draw(draw, width, start_y, fill=text_color)
             
-        line_height = 100
-        total_text_height = len(lines) * line_height
-        start_y = (height - total_text_height) // 2
-        
-        for i, line in enumerate(lines):
-            reshaped_line = _prepare_arabic_text(line)
-            bbox = draw.textbbox((0, 0), reshaped_line, font=font)
-            w_line = bbox[2] - bbox[0]
-            
-            lx = (width - w_line) // 2 - bbox[0]
-            ly = start_y + (i * line_height)
-            
-            # رسم ظل خفيف جداً للنص لزيادة الفخامة والوضوح
-            # draw.text((lx+1, ly+1), reshaped_line, font=font, fill=(200, 200, 200))
-            draw.text((lx, ly), reshaped_line, font=font, fill=text_color)
-            
-        img.save(output_path, quality=100)
-        return output_path
+        return save_image(img, output_path, destination).path
         
     except Exception as e:
         print(f"❌ Error in create_text_page: {e}")
         return None
-def create_html_flipbook(image_paths, child_name, output_path):
+# ضلع كل صفحة في المعاينة المزدوجة التي تُرسل في المحادثة أثناء تجهيز الكتاب
+SPREAD_PAGE_SIZE = 512
+
+def create_page_spread(art_source, text_page_source, output_path, page_size=SPREAD_PAGE_SIZE,
+                       destination=ENCODE_MESSENGER):
     """
-    إنشاء ملف HTML تفاعلي يحتوي على القصة كاملة مع تأثير تقليب الصفحات
-    يتم دمج الصور داخل الملف (Base64) ليعمل بدون إنترنت أو روابط خارجية
+    معاينة مصغرة لصفحتين متقابلتين (الرسمة يساراً والنص يميناً كما في الكتاب)
+    تُرسل للمستخدم فور اكتمال الصفحة. إذا لم تتوفر صفحة النص تُرسل الرسمة وحدها.
     """
     try:
-        pages_html = ""
-        for i, img_path in enumerate(image_paths):
-            with open(img_path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-            
-            # الغلاف أول صفحة، ثم النص، ثم الرسم (الترتيب العربي الصحيح)
-            page_type = "cover" if i == 0 else ("text" if i % 2 != 0 else "art")
-            
-            pages_html += f"""
-            <div class="page" data-density="{"hard" if page_type == "cover" else "soft"}">
-                <div class="page-content">
-                    <img src="data:image/png;base64,{encoded_string}" alt="Page {i}">
-                </div>
-            </div>
-            """
-
-        html_template = f"""
-<!DOCTYPE html>
+        pages = []
+        for source in (art_source, text_page_source):
+            page = get_image_source(source) if source else None
+            if page is not None:
+                # ملفات JPEG تُفك مباشرة بدقة أقل (أسرع بكثير من فك الصورة كاملة ثم تصغيرها)
+                page.draft("RGB", (page_size, page_size))
+                pages.append(page.convert("RGB").resize((page_size, page_size), Image.BILINEAR))
+        if not pages: return None
+
+        img = Image.new("RGB", (page_size * len(pages), page_size), (255, 255, 255))
+        for i, page in enumerate(pages):
+            img.paste(page, (i * page_size, 0))
+        return save_image(img, output_path, destination).path
+    except Exception as e:
+        print(f"❌ Error in create_page_spread: {e}")
+        return None
+
+# ---------------------------------------------------------------------------
+# 3. خدمة الرسم (Render Service) - تجميع الصفحات في عمليات منفصلة
+# ---------------------------------------------------------------------------
+
+# عدد عمليات الرسم. 0 = الرسم داخل نفس العملية.
+# الافتراضي صغير: os.cpu_count() داخل الحاويات (Railway) يعيد أنوية الجهاز المضيف كلها،
+# وكل عامل يحمّل PIL والخطوط وفهرس القصص في ذاكرته
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(min(os.cpu_count() or 1, 2))))
+# تشغيل العمال مع بدء السيرفر؛ وإلا يبدؤون عند أول صفحة
+RENDER_WARM = os.getenv("RENDER_WARM", "true").lower() in ("1", "true", "yes")
+
+RENDER_COVER = "cover"
+RENDER_TEXT = "text"
+RENDER_OVERLAY = "overlay"
+RENDER_SPREAD = "spread"
+
+class PageSpec(NamedTuple):
+    """وصف صفحة للرسم (قابل للإرسال لعملية أخرى: مسارات وروابط فقط، بدون صور مفتوحة)"""
+    kind: str                   # RENDER_COVER / RENDER_TEXT / RENDER_OVERLAY / RENDER_SPREAD
+    output_path: str
+    text: str = ""
+    art: Optional[str] = None   # مسار أو رابط الرسمة (خلفية صفحة النص اختيارية)
+    value: str = ""             # للغلاف
+    child_name: str = ""        # للغلاف
+    gender: str = ""            # للغلاف
+    destination: Optional[str] = None  # ENCODE_* (الافتراضي حسب نوع الصفحة)
+    profile: str = COVER_FINAL  # للغلاف: COVER_FINAL أو COVER_DRAFT
+    facing: Optional[str] = None  # للمعاينة المزدوجة: مسار صفحة النص المقابلة للرسمة
+    preview_path: Optional[str] = None  # للغلاف: نسخة بترميز المحادثة بجانب output_path
+
+class RenderResult(NamedTuple):
+    kind: str
+    output_path: Optional[str]  # الملف المُرمّز الناتج، أو None عند الفشل
+    render_ms: float            # زمن الرسم داخل العامل
+    total_ms: float             # من الإرسال حتى استلام النتيجة (يشمل الانتظار في الطابور)
+    worker_pid: int
+    output_bytes: int = 0
+    encode_ms: float = 0.0
+    preview_path: Optional[str] = None  # نسخة المحادثة (إن طُلبت في PageSpec)
+
+def _warm_render_worker():
+    """تجهيز العامل: تحميل الخطوط وحساب مقاسات عناوين الغلاف مرة واحدة"""
+    fonts.get(45, "bold")
+    fonts.get(52, "regular")
+    precompute_title_fits()
+
+def _render_page(spec: PageSpec) -> RenderResult:
+    started = time.perf_counter()
+    _last_encode.result = None
+    options = {"destination": spec.destination} if spec.destination else {}
+    if spec.kind == RENDER_COVER:
+        output = create_cover_page(spec.art, spec.value, spec.child_name, spec.gender, spec.output_path,
+                                   profile=spec.profile, preview_path=spec.preview_path, **options)
+    elif spec.kind == RENDER_TEXT:
+        output = create_text_page(spec.text, spec.output_path, background_source=spec.art, **options)
+    elif spec.kind == RENDER_OVERLAY:
+        output = overlay_text_on_image(spec.art, spec.text, spec.output_path, **options)
+    elif spec.kind == RENDER_SPREAD:
+        output = create_page_spread(spec.art, spec.facing, spec.output_path, **options)
+    else:
+        print(f"❌ Unknown render job kind: {spec.kind}")
+        output = None
+    elapsed = (time.perf_counter() - started) * 1000
+    encoded = last_encode_result() if output else None
+    return RenderResult(
+        spec.kind, output, elapsed, elapsed, os.getpid(),
+        output_bytes=encoded.bytes if encoded else 0,
+        encode_ms=encoded.encode_ms if encoded else 0.0,
+        preview_path=encoded_path(spec.preview_path, ENCODE_MESSENGER) if output and spec.preview_path else None
+    )
+
+class _RenderFuture(Future):
+    """
+    نتيجة صفحة مرسلة للرسم. إذا فشل العامل تُرسم الصفحة داخل العملية
+    عند أول طلب للنتيجة، في خيط الطالب.
+    """
+
+    def __init__(self, spec: PageSpec, submitted: float):
+        super().__init__()
+        self._spec = spec
+        self._submitted = submitted
+        self._fallback_lock = threading.Lock()
+        self._fallback = None
+
+    def finish(self, result: Optional[RenderResult]):
+        """None = فشل العامل"""
+        if result is not None:
+            result = result._replace(total_ms=(time.perf_counter() - self._submitted) * 1000)
+        self.set_result(result)
+
+    def result(self, timeout=None) -> RenderResult:
+        result = super().result(timeout)
+        if result is not None:
+            return result
+        with self._fallback_lock:
+            if self._fallback is None:
+                fallback = _render_page(self._spec)
+                self._fallback = fallback._replace(total_ms=(time.perf_counter() - self._submitted) * 1000)
+            return self._fallback
+
+class RenderService:
+    """
+    رسم الصفحات (الغلاف، صفحات النص، النص فوق الرسمة) في مجموعة عمليات
+    حتى لا ينافس العمل الثقيل على المعالج خيوط الشبكة، ولتستخدم كل الأنوية.
+    """
+
+    def __init__(self, max_workers=RENDER_WORKERS):
+        self.max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _pool(self):
+        if self.max_workers <= 0:
+            return None
+        with self._lock:
+            if self._executor is None:
+                # spawn بدلاً من fork: العملية الأم فيها خيوط (FastAPI / ThreadPool)
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_warm_render_worker
+                )
+            return self._executor
+
+    def warm(self):
+        """تشغيل العمال مسبقاً (وتحميل الخطوط فيها) حتى لا تدفع أول صفحة تكلفة البدء"""
+        pool = self._pool()
+        if pool is not None:
+            for _ in range(self.max_workers):
+                pool.submit(_warm_render_worker)
+
+    def submit(self, spec: PageSpec) -> Future:
+        """إرسال صفحة للرسم، والنتيجة RenderResult"""
+        result_future = _RenderFuture(spec, time.perf_counter())
+
+        pool = self._pool()
+        if pool is None:
+            result_future.finish(_render_page(spec))
+            return result_future
+
+        def finish(job):
+            try:
+                result_future.finish(job.result())
+            except Exception as e:
+                # عامل انهار (BrokenProcessPool) أو خطأ غير متوقع: الصفحة تُرسم داخل العملية
+                # في خيط من يطلب النتيجة، وليس في خيط متابعة الـ pool
+                print(f"⚠️ Render worker failed ({e}), {spec.kind} will render inline")
+                self._reset(pool)
+                result_future.finish(None)
+
+        pool.submit(_render_page, spec).add_done_callback(finish)
+        return result_future
+
+    def render(self, spec: PageSpec) -> RenderResult:
+        return self.submit(spec).result()
+
+    def render_many(self, specs) -> list:
+        """رسم مجموعة صفحات بالتوازي، والنتائج بنفس ترتيب specs"""
+        futures = [self.submit(spec) for spec in specs]
+        return [f.result() for f in futures]
+
+    def _reset(self, failed_pool):
+        """إيقاف الـ pool المعطوب مرة واحدة (المهام الفاشلة الأخرى من نفس الـ pool لا تعيد الإيقاف)"""
+        with self._lock:
+            if self._executor is not failed_pool:
+                return
+            self._executor = None
+        failed_pool.shutdown(wait=False)
+
+    def shutdown(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+_render_service = None
+_render_service_lock = threading.Lock()
+
+def get_render_service() -> RenderService:
+    """خدمة الرسم المشتركة للعملية (العمال يبدؤون عند أول صفحة)"""
+    global _render_service
+    if _render_service is None:
+        with _render_service_lock:
+            if _render_service is None:
+                _render_service = RenderService()
+    return _render_service
+
+# ---------------------------------------------------------------------------
+# 4. كتاب HTML تفاعلي (Flipbook)
+# ---------------------------------------------------------------------------
+
+# مكتبة تقليب الصفحات محفوظة داخل المشروع (vendor) والرابط الخارجي احتياطي فقط
+FLIPBOOK_VENDOR_JS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vendor", "page-flip.browser.js")
+FLIPBOOK_CDN_JS = "https://cdn.jsdelivr.net/npm/page-flip@2.0.7/dist/js/page-flip.browser.js"
+FLIPBOOK_VARIANT_WIDTHS = (480, 800)  # نسخ أصغر للشاشات الصغيرة (srcset)
+FLIPBOOK_EAGER_PAGES = 2              # الصفحات الأولى تُحمّل فوراً والباقي عند الحاجة
+
+IMAGE_MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp", "GIF": "image/gif"}
+
+_FLIPBOOK_HEAD = """<!DOCTYPE html>
 <html lang="ar" dir="rtl">
 <head>
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
-    <title>قصة {child_name}</title>
+    <title>قصة {title}</title>
     <style>
         body { margin: 0; background: #1a1a1a; display: flex; flex-direction: column; align-items: center; justify-content: center; min-height: 100vh; font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; color: white; }
         .header { margin-bottom: 20px; }
@@ -325,25 +1099,117 @@ def create_html_flipbook(image_paths, child_name, output_path):
     </style>
 </head>
 <body>
-    <div class="header"><h1>📖 قصة {child_name}</h1></div>
-    <div id="book-container"><div id="book">{pages_html}</div></div>
-    <div class="controls">
-        <button onclick="book.flipPrev()">السابق</button>
-        <button onclick="book.flipNext()">التالي</button>
-    </div>
-    <script src="https://cdn.jsdelivr.net/npm/page-flip@2.0.7/dist/js/page-flip.browser.js"></script>
-    <script>
+    <div class="header"><h1>📖 قصة {title}</h1></div>
+    <div id="book-container"><div id="book">
+"""
+
+_FLIPBOOK_TAIL = """    <script>
         const bookElement = document.getElementById('book');
-        const book = new St.PageFlip(bookElement, {{
+        const book = new St.PageFlip(bookElement, {
             width: 800, height: 800, size: "stretch", showCover: true, useMouseOver: false
-        }});
+        });
         book.loadFromHTML(document.querySelectorAll('.page'));
     </script>
 </body>
 </html>
 """
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(html_template)
+
+_FLIPBOOK_CONTROLS = """    </div></div>
+    <div class="controls">
+        <button onclick="book.flipPrev()">السابق</button>
+        <button onclick="book.flipNext()">التالي</button>
+    </div>
+"""
+
+def _write_base64(out, path, chunk_size=3 * 64 * 1024):
+    """كتابة الملف كـ Base64 على دفعات (مضاعفات 3 بايت حتى تتصل الأجزاء بدون padding)"""
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            out.write(base64.b64encode(chunk).decode("ascii"))
+
+def _flipbook_page_assets(img_path, index, assets_dir, assets_url, variant_widths):
+    """
+    نسخ الصفحة لمجلد الملفات + نسخ مصغرة منها
+
+    Returns:
+        (src, srcset)
+    """
+    with Image.open(img_path) as img:
+        width = img.width
+        extension = ENCODING_PROFILES[ENCODE_MESSENGER].extension
+        name = f"page_{index:03d}"
+        original = f"{name}{os.path.splitext(img_path)[1].lower() or extension}"
+        shutil.copyfile(img_path, os.path.join(assets_dir, original))
+
+        srcset = []
+        for variant_width in sorted(variant_widths):
+            if variant_width >= width:
+                break
+            variant = img.convert("RGB")
+            variant.thumbnail((variant_width, variant_width * img.height // width), Image.LANCZOS)
+            saved = save_image(variant, os.path.join(assets_dir, f"{name}_{variant_width}"), ENCODE_MESSENGER)
+            srcset.append(f"{assets_url}/{os.path.basename(saved.path)} {variant_width}w")
+        srcset.append(f"{assets_url}/{original} {width}w")
+    return f"{assets_url}/{original}", ", ".join(srcset)
+
+def create_html_flipbook(image_paths, child_name, output_path, embed=False,
+                         variant_widths=FLIPBOOK_VARIANT_WIDTHS):
+    """
+    إنشاء ملف HTML تفاعلي يحتوي على القصة كاملة مع تأثير تقليب الصفحات.
+    الملف يُكتب تدريجياً (صفحة بصفحة) فالذاكرة لا تكبر مع عدد الصفحات.
+
+    Args:
+        embed: True = ملف واحد يعمل بدون إنترنت (الصور Base64 والمكتبة داخله)
+               False = الصور في مجلد <اسم الملف>_assets بجانبه مع تحميل كسول ونسخ مصغرة
+        variant_widths: عروض النسخ المصغرة (في وضع الملفات الخارجية)
+    """
+    try:
+        stem = os.path.splitext(os.path.basename(output_path))[0]
+        assets_url = f"{stem}_assets"
+        assets_dir = os.path.join(os.path.dirname(os.path.abspath(output_path)), assets_url)
+        if not embed:
+            os.makedirs(assets_dir, exist_ok=True)
+
+        with open(output_path, "w", encoding="utf-8") as out:
+            out.write(_FLIPBOOK_HEAD.replace("{title}", html.escape(child_name)))
+
+            for i, img_path in enumerate(image_paths):
+                # الغلاف أول صفحة، ثم النص، ثم الرسم (الترتيب العربي الصحيح)
+                density = "hard" if i == 0 else "soft"
+                loading = "eager" if i < FLIPBOOK_EAGER_PAGES else "lazy"
+                out.write(f'        <div class="page" data-density="{density}">\n'
+                          f'            <div class="page-content">\n')
+
+                if embed:
+                    with Image.open(img_path) as img:
+                        mime = IMAGE_MIME_TYPES.get(img.format, "image/png")
+                    out.write(f'                <img alt="Page {i}" src="data:{mime};base64,')
+                    _write_base64(out, img_path)
+                    out.write('">\n')
+                else:
+                    src, srcset = _flipbook_page_assets(img_path, i, assets_dir, assets_url, variant_widths)
+                    out.write(f'                <img alt="Page {i}" src="{src}" srcset="{srcset}" '
+                              f'sizes="(max-width: 1000px) 95vw, 1000px" loading="{loading}" decoding="async">\n')
+
+                out.write('            </div>\n        </div>\n')
+
+            out.write(_FLIPBOOK_CONTROLS)
+
+            if os.path.exists(FLIPBOOK_VENDOR_JS):
+                if embed:
+                    with open(FLIPBOOK_VENDOR_JS, "r", encoding="utf-8") as js:
+                        # "</script" داخل المكتبة كان سيُنهي الوسم مبكراً
+                        out.write("    <script>\n" + js.read().replace("</script", "<\\/script") + "\n    </script>\n")
+                else:
+                    shutil.copyfile(FLIPBOOK_VENDOR_JS, os.path.join(assets_dir, "page-flip.browser.js"))
+                    out.write(f'    <script src="{assets_url}/page-flip.browser.js"></script>\n')
+            else:
+                print(f"⚠️ {FLIPBOOK_VENDOR_JS} not found (run fetch_vendor.py), falling back to CDN")
+                out.write(f'    <script src="{FLIPBOOK_CDN_JS}"></script>\n')
+            out.write(_FLIPBOOK_TAIL)
         return output_path
     
     except Exception as e:
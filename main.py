@@ -2,16 +2,24 @@ from fastapi import FastAPI, Request, BackgroundTasks, HTTPException, Response
 from fastapi.responses import PlainTextResponse, HTMLResponse
 from fastapi.staticfiles import StaticFiles
 import os, uvicorn, logging, requests, base64, time, json, shutil, uuid
+from concurrent.futures import ThreadPoolExecutor
 
 # استيراد الدوال من الملفات المساعدة
 from dotenv import load_dotenv
 load_dotenv() # Load environment variables from .env file early
 
-from messenger_api import send_text_message, send_quick_replies, send_file, send_image
+from messenger_api import send_text_message, send_quick_replies, send_file, send_image, OrderedDelivery
 from pdf_utils import create_pdf
-from openai_service import verify_payment_screenshot, generate_storybook_page, create_character_reference
-from image_utils import overlay_text_on_image, create_cover_page, create_text_page
+from openai_service import verify_payment_screenshot, generate_storybook_page, generate_story_images, create_character_reference, claim_transaction_id, IMAGE_CONCURRENCY
+from payment_service import generate_payment_link, verify_callback_hmac
+from transaction_ledger import get_ledger
+from provider_router import get_router
+from image_utils import (
+    download_image_bytes, normalize_screenshot, get_render_service, PageSpec, RENDER_COVER, RENDER_TEXT,
+    RENDER_SPREAD, RENDER_WARM, encoded_path, ENCODE_PDF, ENCODE_MESSENGER, ENCODE_DRAFT, COVER_DRAFT, ImageFetchJob
+)
 from story_manager import StoryManager
+from story_catalog import get_catalog
 
 # إعداد السجلات لمراقبة أداء البوت
 logging.basicConfig(level=logging.INFO)
@@ -19,9 +27,33 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+# تحميل فهرس القصص مرة واحدة عند بدء التشغيل بدلاً من قراءة JSON مع كل طلب
+get_catalog()
+
+@app.on_event("startup")
+def start_render_workers():
+    # عمليات رسم الصفحات تبدأ مع السيرفر (وليس عند استيراد الملف داخل العمال)
+    if RENDER_WARM:
+        get_render_service().warm()
+    # وضع التجربة المجانية مفعّل: لا أحد يستدعي request_payment، فعميل Paymob غير مستخدم
+    # ولا داعي لحجز طلبات مسبقاً. عند تفعيل الدفع (مع استيراد prefetch_orders من payment_service):
+    # prefetch_orders([STORY_PRICE_EGP, PACK_PRICE_EGP, VIDEO_PRICE_EGP])
+
+@app.on_event("shutdown")
+def stop_render_workers():
+    get_render_service().shutdown()
+
 # متغيرات البيئة (تأكد من ضبطها في Railway)
 VERIFY_TOKEN = os.getenv("VERIFY_TOKEN", "my_verify_token")
 PAYMENT_NUMBER = os.getenv("INSTAPAY_HANDLE", "01060746538")
+# الأسعار بالجنيه (القصة / باقة الـ 3 قصص / الفيديو)
+STORY_PRICE_EGP = 25
+PACK_PRICE_EGP = 60
+VIDEO_PRICE_EGP = 100
+# اختيارات المستخدم التي تُحفظ مع طلب Paymob لتنفيذه بعد التأكيد (حتى بعد إعادة التشغيل)
+ORDER_STATE_KEYS = ("child_name", "gender", "age_group", "selected_value", "char_desc")
+# التحقق من إيصال التحويل بنموذج الرؤية (معطّل: كل إيصال يُقبل يدوياً حالياً)
+AI_PAYMENT_VERIFICATION = os.getenv("AI_PAYMENT_VERIFICATION", "false").lower() in ("1", "true", "yes")
 user_state = {}
 
 @app.get("/")
@@ -179,6 +211,59 @@ async def webhook_handler(request: Request, background_tasks: BackgroundTasks):
         logger.error(f"Webhook Error: {e}")
         return {"status": "error"}
 
+@app.post("/paymob/callback")
+async def paymob_callback(request: Request, background_tasks: BackgroundTasks):
+    """
+    إشعار Paymob بالمعاملة بعد معالجتها (Transaction processed callback)
+    يؤكد الدفع مباشرة بدلاً من انتظار صورة التحويل وفحصها بنموذج الرؤية
+    """
+    try:
+        data = await request.json()
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=400, detail="Invalid payload")
+
+    transaction = data.get("obj") or {}
+    if not verify_callback_hmac(transaction, request.query_params.get("hmac", "")):
+        logger.warning("⚠️ Paymob callback with invalid HMAC rejected")
+        raise HTTPException(status_code=403, detail="Invalid HMAC")
+
+    if data.get("type") != "TRANSACTION" or transaction.get("pending") or not transaction.get("success"):
+        return {"status": "ignored"}
+
+    order_id = (transaction.get("order") or {}).get("id")
+    order = get_ledger().lookup_order(order_id) if order_id else None
+    if not order:
+        logger.error(f"❌ Paymob callback for unknown order: {order_id}")
+        return {"status": "unknown_order"}
+
+    # نفس المعاملة قد تصل أكثر من مرة (إعادة إرسال من Paymob)
+    if not claim_transaction_id(f"paymob:{transaction.get('id')}"):
+        return {"status": "duplicate"}
+
+    sender_id, payment_step, order_state = order
+    logger.info(f"💳 Paymob payment confirmed: order {order_id} → {sender_id}")
+    background_tasks.add_task(handle_confirmed_payment, sender_id, payment_step, order_state)
+    return {"status": "ok"}
+
+def request_payment(sender_id, amount_egp, payment_step, child_name):
+    """
+    إرسال رابط دفع Paymob (يتأكد الدفع تلقائياً عبر /paymob/callback)،
+    أو تعليمات التحويل اليدوي وانتظار صورة الإيصال إذا لم يتوفر الرابط.
+    غير مستخدمة حالياً (وضع التجربة المجانية): كل مسارات الدفع معلّقة وتستدعيها عند التفعيل.
+    """
+    user_state[sender_id]["step"] = payment_step
+    order_state = {key: user_state[sender_id].get(key) for key in ORDER_STATE_KEYS}
+    link = generate_payment_link(amount_egp, {"first_name": child_name}, sender_id=sender_id,
+                                 product=payment_step, context=order_state)
+    if link:
+        send_text_message(sender_id, f"💳 لإكمال طلب {child_name}، ادفعي {amount_egp} جنيه من هنا:\n{link}\n\nسيبدأ التجهيز تلقائياً فور تأكيد الدفع! 🚀")
+    else:
+        send_text_message(sender_id, (f"💰 لإكمال قصة {child_name}، يرجى تحويل {amount_egp} جنيه عبر:\n"
+                                      f"📍 فودافون كاش أو إنستا باي: {PAYMENT_NUMBER}\n"
+                                      f"📸 ثم أرسلي صورة التحويل هنا فوراً!"))
+
 def start_processing(sender_id, messaging_event, background_tasks):
     message = messaging_event["message"]
     
@@ -216,16 +301,10 @@ def start_processing(sender_id, messaging_event, background_tasks):
             process_pack_generation(sender_id)
             return
 
-            # user_state[sender_id]["step"] = "waiting_for_pack_payment"
+            # عند إيقاف وضع التجربة: رابط دفع Paymob (أو التحويل اليدوي إذا لم يتوفر الرابط)
             # child_name = user_state[sender_id].get("child_name", "الطفل")
-            # msg = (
-            #     f"🎉 اختيار ممتاز! باقة الـ 3 مغامرات لـ {child_name} 📚\n"
-            #     f"السعر: ٦٠ جنيه فقط (بدل ١٢٠!)\n\n"
-            #     f"من فضلك حولي المبلغ الآن على:\n"
-            #     f"📍 {PAYMENT_NUMBER}\n"
-            #     f"وابعتي صورة التحويل هنا عشان نبدأ فوراً! 🚀"
-            # )
-            # send_text_message(sender_id, msg)
+            # send_text_message(sender_id, f"🎉 اختيار ممتاز! باقة الـ 3 مغامرات لـ {child_name} 📚\nالسعر: ٦٠ جنيه فقط (بدل ١٢٠!)")
+            # request_payment(sender_id, PACK_PRICE_EGP, "waiting_for_pack_payment", child_name)
             # return
 
         # --- 2. طلب الفيديو (Hero Movie) ---
@@ -245,18 +324,15 @@ def start_processing(sender_id, messaging_event, background_tasks):
                     pass
             return
 
-            # user_state[sender_id]["step"] = "waiting_for_video_payment"
+            # عند إيقاف وضع التجربة: رابط دفع Paymob (أو التحويل اليدوي إذا لم يتوفر الرابط)
             # child_name = user_state[sender_id].get("child_name", "الطفل")
-            # msg = (
+            # send_text_message(sender_id, (
             #     f"🎬 اختيار رائع! {child_name} هيكون بطل فيلمه الخاص! ✨\n"
             #     f"فيديو احترافي بصوره واسمه ومؤثرات صوتية.\n"
             #     f"السعر: ١٠٠ جنيه فقط (بدل ٢٠٠)\n"
-            #     f"⏱️ الاستلام: خلال ٢٤ ساعة\n\n"
-            #     f"من فضلك حولي المبلغ الآن على:\n"
-            #     f"📍 {PAYMENT_NUMBER}\n"
-            #     f"وابعتي صورة التحويل هنا لتأكيد الحجز! 🎟️"
-            # )
-            # send_text_message(sender_id, msg)
+            #     f"⏱️ الاستلام: خلال ٢٤ ساعة"
+            # ))
+            # request_payment(sender_id, VIDEO_PRICE_EGP, "waiting_for_video_payment", child_name)
             # return
 
         if text.lower() == "start":
@@ -363,61 +439,86 @@ def process_pack_generation(sender_id):
     # 3. Final Success Message
     send_text_message(sender_id, "🎁 كل القصص وصلت! استمتعوا بـ 'باقة المغامرات' معاً! 🥰")
 
+def handle_confirmed_payment(sender_id, payment_step=None, order_state=None):
+    """
+    ينقل المستخدم مباشرة للتوليد بعد تأكيد الدفع
+    (من صورة التحويل أو من إشعار Paymob)
+
+    order_state: اختيارات المستخدم المحفوظة مع طلب Paymob، وهي المرجع لما تم دفعه
+    (حالة المحادثة في الذاكرة قد تضيع بإعادة تشغيل السيرفر)
+    """
+    if sender_id not in user_state:
+        user_state[sender_id] = {"step": "start"}
+    if order_state:
+        user_state[sender_id].update({key: value for key, value in order_state.items() if value is not None})
+    if payment_step:
+        user_state[sender_id]["step"] = payment_step
+
+    step = user_state[sender_id].get("step")
+    
+    # CASE A: Pack Payment (60 EGP)
+    if step == "waiting_for_pack_payment":
+        send_text_message(sender_id, "✅ تم استلام دفع الباقة! جاري تجهيز الـ 3 قصص حالاً... 📚✨")
+        
+        # Admin Notification (Pack)
+        child_name = user_state[sender_id].get("child_name", "الطفل")
+        admin_msg = f"🔔 NEW ORDER: Story Pack (3 Stories) 📚\nUser: {child_name} ({sender_id})\nStatus: PAID 60 EGP\nAction: Auto-generating stories..."
+        logger.critical(admin_msg)
+        
+        admin_id = os.getenv("ADMIN_ID")
+        if admin_id:
+            try:
+                send_text_message(admin_id, admin_msg)
+            except:
+                pass
+
+        process_pack_generation(sender_id)
+    
+    # CASE B: Video Payment (100 EGP)
+    elif step == "waiting_for_video_payment":
+        child_name = user_state[sender_id].get("child_name", "الطفل")
+        success_msg = (
+            f"✅ تم تأكيد حجز الفيديو لـ {child_name}! 🎬\n"
+            f"جاري العمل على المونتاج والمؤثرات...\n"
+            f"سيصلك الفيديو خلال 24 ساعة على هذا الشات. شكراً لثقتك! ❤️"
+        )
+        send_text_message(sender_id, success_msg)
+        
+        # Admin Notification
+        admin_msg = f"🔔 NEW ORDER: Video Request 🎥\nUser: {child_name} ({sender_id})\nStatus: PAID 100 EGP\nAction: Create Video manually."
+        logger.critical(admin_msg)
+        admin_id = os.getenv("ADMIN_ID")
+        if admin_id:
+            try:
+                send_text_message(admin_id, admin_msg)
+            except:
+                pass
+
+    # CASE C: Single Story Payment
+    else:
+        send_text_message(sender_id, "✅ تم تأكيد الدفع بنجاح! نبدأ الآن رسم القصة كاملة... (سيستغرق عدة دقائق)")
+        value = user_state[sender_id].get("selected_value")
+        process_story_generation(sender_id, value, is_preview=False, is_pack=False)
+
 def process_payment_verification(sender_id, image_url):
     try:
-        response = requests.get(image_url)
-        base64_img = base64.b64encode(response.content).decode("utf-8")
-        
-        # Enforce AI Verification
-        # is_valid, reason = verify_payment_screenshot(base64_img, PAYMENT_NUMBER, use_ai_verification=True)
-        is_valid, reason = True, "Manual Override - Temporary"
+        if AI_PAYMENT_VERIFICATION:
+            # تحميل محدود الحجم والوقت، ثم تصغير الصورة وحساب بصمتها قبل نموذج الرؤية
+            raw_bytes = download_image_bytes(image_url)
+            if not raw_bytes:
+                send_text_message(sender_id, "❌ لم نتمكن من تحميل صورة التحويل. يرجى إرسالها مرة أخرى.")
+                return
+            jpeg_bytes, screenshot_hash = normalize_screenshot(raw_bytes)
+            base64_img = base64.b64encode(jpeg_bytes or raw_bytes).decode("utf-8")
+            is_valid, reason = verify_payment_screenshot(
+                base64_img, PAYMENT_NUMBER, use_ai_verification=True, screenshot_hash=screenshot_hash
+            )
+        else:
+            # بدون التحقق الآلي لا حاجة لتحميل الصورة أصلاً
+            is_valid, reason = True, "Manual Override - Temporary"
         
         if is_valid:
-            step = user_state[sender_id].get("step")
-            
-            # CASE A: Pack Payment (60 EGP)
-            if step == "waiting_for_pack_payment":
-                send_text_message(sender_id, "✅ تم استلام دفع الباقة! جاري تجهيز الـ 3 قصص حالاً... 📚✨")
-                
-                # Admin Notification (Pack)
-                child_name = user_state[sender_id].get("child_name", "الطفل")
-                admin_msg = f"🔔 NEW ORDER: Story Pack (3 Stories) 📚\nUser: {child_name} ({sender_id})\nStatus: PAID 60 EGP\nAction: Auto-generating stories..."
-                logger.critical(admin_msg)
-                
-                admin_id = os.getenv("ADMIN_ID")
-                if admin_id:
-                    try:
-                        send_text_message(admin_id, admin_msg)
-                    except:
-                        pass
-
-                process_pack_generation(sender_id)
-            
-            # CASE B: Video Payment (100 EGP)
-            elif step == "waiting_for_video_payment":
-                child_name = user_state[sender_id].get("child_name", "الطفل")
-                success_msg = (
-                    f"✅ تم تأكيد حجز الفيديو لـ {child_name}! 🎬\n"
-                    f"جاري العمل على المونتاج والمؤثرات...\n"
-                    f"سيصلك الفيديو خلال 24 ساعة على هذا الشات. شكراً لثقتك! ❤️"
-                )
-                send_text_message(sender_id, success_msg)
-                
-                # Admin Notification
-                admin_msg = f"🔔 NEW ORDER: Video Request 🎥\nUser: {child_name} ({sender_id})\nStatus: PAID 100 EGP\nAction: Create Video manually."
-                logger.critical(admin_msg)
-                admin_id = os.getenv("ADMIN_ID")
-                if admin_id:
-                    try:
-                        send_text_message(admin_id, admin_msg)
-                    except:
-                        pass
-
-            # CASE C: Single Story Payment
-            else:
-                send_text_message(sender_id, "✅ تم تأكيد الدفع بنجاح! نبدأ الآن رسم القصة كاملة... (سيستغرق عدة دقائق)")
-                value = user_state[sender_id].get("selected_value")
-                process_story_generation(sender_id, value, is_preview=False, is_pack=False)
+            handle_confirmed_payment(sender_id)
         else:
             # Send detailed reason for rejection
             send_text_message(sender_id, f"❌ عذراً، لم نتمكن من قبول الدفع.\nالسبب: {reason}\nيرجى التأكد من إرسال إيصال صحيح وحديث.")
@@ -460,22 +561,17 @@ def process_story_generation(sender_id, value, is_preview=False, is_pack=False):
             core_value=value
         ) 
 
-        value_map = {
-            "الشجاعة": "courage.json", 
-            "الصدق": "honesty.json", 
-            "التعاون": "cooperation.json", 
-            "الاحترام": "respect.json" 
-        }
-        
-        json_filename = value_map.get(value)
-        pages_prompts = manager.generate_story_prompts(json_filename, data.get("age_group"))
+        pages_prompts = manager.generate_story_prompts(value, data.get("age_group"))
         
         if not pages_prompts:
             send_text_message(sender_id, "⚠️ عذراً، محتوى هذه القصة قيد التحديث. يرجى اختيار قيمة أخرى.")
             return
 
         total_pages = len(pages_prompts)
-        cover_path = f"/tmp/cover_{sender_id}.png"
+        # الغلاف يُرسم مرة واحدة ويُرمّز مرتين: نسخة خفيفة للمحادثة ونسخة الـ PDF للكتاب
+        cover_path = encoded_path(f"/tmp/cover_{sender_id}.png", ENCODE_PDF)
+        # نفس نموذج الرسم لكل صفحات الكتاب (الغلاف والصفحات) لضمان اتساق الأسلوب
+        book_key = f"{sender_id}:{value}"
 
         # --- حالة المعاينة: توليد الغلاف فقط ---
         if is_preview:
@@ -483,18 +579,42 @@ def process_story_generation(sender_id, value, is_preview=False, is_pack=False):
             # برومبت الغلاف المحسن لنموذج FLUX - محايد لترك التفاصيل لـ char_desc
             cover_prompt = f"Professional children's book cover illustration for a story about {child_name} learning about {value}. Soft digital watercolor washes, delicate colored pencil detailing, dreamy cozy bedtime story aesthetic with warm glowing light. Masterpiece quality."
             
-            cover_url = generate_storybook_page(char_desc, cover_prompt, gender=gender, age_group=data.get("age_group", "3-4"), is_cover=True)
+            preview_started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=1) as cover_pool:
+                cover_future = cover_pool.submit(
+                    generate_storybook_page, char_desc, cover_prompt, gender=gender,
+                    age_group=data.get("age_group", "3-4"), is_cover=True, book_key=book_key
+                )
+
+                # مسودة فورية منخفضة الدقة من صورة الطفل بالعنوان والاسم أثناء رسم الغلاف الحقيقي
+                photo_url = data.get("photo_url")
+                if photo_url:
+                    draft = get_render_service().render(PageSpec(
+                        RENDER_COVER, encoded_path(f"/tmp/cover_draft_{sender_id}.png", ENCODE_DRAFT),
+                        art=photo_url, value=value, child_name=child_name, gender=gender, profile=COVER_DRAFT
+                    ))
+                    if draft.output_path:
+                        send_image(sender_id, draft.output_path)
+                        send_text_message(sender_id, "🎨 دي لمحة سريعة من الغلاف... جاري رسمه بالكامل الآن ✨")
+                        logger.info(f"⏱️ Time to first image (draft cover): {time.monotonic() - preview_started:.1f}s")
+
+                cover_url = cover_future.result()
             
             if cover_url:
                 # استدعاء الدالة المعدلة لكتابة "بطل/بطلة القيمة" واسم الطفل
-                if create_cover_page(cover_url, value, child_name, gender, cover_path):
-                    send_image(sender_id, cover_path)
+                cover = get_render_service().render(PageSpec(
+                    RENDER_COVER, cover_path, art=cover_url, value=value, child_name=child_name, gender=gender,
+                    preview_path=encoded_path(f"/tmp/cover_preview_{sender_id}.png", ENCODE_MESSENGER)
+                ))
+                logger.info(
+                    f"🖼️ Cover rendered in {cover.render_ms:.0f} ms (total {cover.total_ms:.0f} ms, "
+                    f"{cover.output_bytes // 1024} KB encoded in {cover.encode_ms:.0f} ms)"
+                )
+                if cover.output_path:
+                    send_image(sender_id, cover.preview_path or cover.output_path)
+                    logger.info(f"⏱️ Time to final cover: {time.monotonic() - preview_started:.1f}s")
                     time.sleep(1)
-                    msg = (f"💰 لإكمال قصة {child_name}، يرجى تحويل 25 جنيه عبر:\n"
-                           f"📍 فودافون كاش أو إنستا باي: {PAYMENT_NUMBER}\n"
-                           f"📸 ثم أرسلي صورة التحويل هنا فوراً!")
-                    # user_state[sender_id]["step"] = "waiting_for_payment"
-                    # send_text_message(sender_id, msg)
+                    # request_payment(sender_id, STORY_PRICE_EGP, "waiting_for_payment", child_name)
                     
                     # BYPASS PAYMENT (FREE MODE)
                     send_text_message(sender_id, "✨ جاري تكملة القصة كاملة فوراً (تجربة مجانية)! 🚀")
@@ -508,27 +628,83 @@ def process_story_generation(sender_id, value, is_preview=False, is_pack=False):
         # --- حالة التوليد الكامل: رسم الصفحات وتجميع الـ PDF ---
         generated_images = [cover_path] if os.path.exists(cover_path) else []
         
-        for i, p in enumerate(pages_prompts):
-            page_num = i + 1
-            send_text_message(sender_id, f"⏳ جاري رسم الصفحة {page_num} من {total_pages}...")
-            
-            # 1. توليد صورة الرسم (الخلفية)
-            img_result = generate_storybook_page(char_desc, p["prompt"], gender=gender, age_group=data.get("age_group", "3-4"))
-            
-            if not img_result:
-                send_text_message(sender_id, f"⚠️ تأخرت الصفحة {page_num}.. أحاول مرة أخرى.")
-                img_result = generate_storybook_page(char_desc, p["prompt"], gender=gender, age_group=data.get("age_group", "3-4"))
-
-            if img_result:
-                # أ. إنشاء وإضافة صفحة النص (مع استخدام الرسمة كخلفية مموهة لضمان التلوين الكامل)
-                text_page_path = f"/tmp/text_{sender_id}_{i}.png"
-                create_text_page(p["text"], text_page_path, background_source=img_result)
-                generated_images.append(text_page_path)
-
-                # ب. إضافة صفحة الرسم (لتكون على اليسار مقابلة للنص)
-                generated_images.append(img_result)
-            else:
-                send_text_message(sender_id, f"❌ فشل توليد الصفحة {page_num}. سنكمل القصة بما توفر.")
+        send_text_message(sender_id, f"⏳ جاري رسم صفحات القصة ({total_pages} صفحات)...")
+        
+        # 1. توليد صور الرسم لكل الصفحات بالتوازي (مع إعادة محاولة للصفحة المتأخرة)
+        # 2. وكل رسمة تكتمل تُرسل فوراً لعمليات الرسم لتجهيز صفحة النص الخاصة بها
+        # (مع استخدام الرسمة كخلفية مموهة لضمان التلوين الكامل)
+        render_service = get_render_service()
+        fetch_job = ImageFetchJob()  # كل رسمة بعيدة (URL) تُحمّل مرة واحدة للكتاب كله
+        # تحميل الرسمة ورسم صفحة النص خارج خيط استقبال النتائج، حتى لا تنتظر الصفحات بعضها
+        page_pool = ThreadPoolExecutor(max_workers=IMAGE_CONCURRENCY, thread_name_prefix="page-prep")
+        page_jobs = {}
+        generation_started = time.monotonic()
+
+        # 3. كل صفحة تكتمل (الرسمة + صفحة النص) تُرسل فوراً كمعاينة مصغرة بترتيب القراءة،
+        # والصفحة التي تسبق دورها تنتظر حتى تُرسل الصفحات قبلها. الـ PDF يأتي في النهاية.
+        def deliver_page(index, page_job):
+            if page_job is None:
+                send_text_message(sender_id, f"❌ فشل توليد الصفحة {index + 1}. سنكمل القصة بما توفر.")
+                return
+            art_path, text_page = page_job.result()
+            spread = render_service.render(PageSpec(
+                RENDER_SPREAD, encoded_path(f"/tmp/spread_{sender_id}_{index}.png", ENCODE_MESSENGER),
+                art=art_path, facing=text_page.output_path
+            ))
+            if spread.output_path:
+                send_image(sender_id, spread.output_path)
+                logger.info(f"📤 Page {index + 1}/{total_pages} delivered after {time.monotonic() - generation_started:.1f}s")
+
+        delivery = OrderedDelivery(total_pages, deliver_page)
+
+        def prepare_page(index, result):
+            # نفس الملف المحلي يستخدم كخلفية لصفحة النص ثم في المعاينة والـ PDF
+            # (None إذا كان الملف المحمّل تالفاً: صفحة النص تُرسم بدون خلفية)
+            art_path = fetch_job.localize(result["image_path"])
+            text_page = render_service.render(PageSpec(
+                RENDER_TEXT, f"/tmp/text_{sender_id}_{index}.png",
+                text=result["text"], art=art_path
+            ))
+            return art_path, text_page
+
+        def render_text_page(result):
+            index = result["index"]
+            if not result["image_path"]:
+                delivery.complete(index, None)
+                return
+            fetch_job.prefetch([result["image_path"]])  # التحميل يبدأ فوراً ولو كانت خيوط التجهيز مشغولة
+            page_jobs[index] = page_pool.submit(prepare_page, index, result)
+            delivery.complete(index, page_jobs[index])
+
+        try:
+            # صفحات StoryManager مجمّعة بالفعل ضمن الحد، فتُرسل كما هي
+            results = generate_story_images(
+                pages_prompts, char_desc, gender=gender, age_group=data.get("age_group", "3-4"),
+                book_key=book_key, on_result=render_text_page, precompiled=True
+            )
+
+            for i, result in enumerate(results):
+                if result["image_path"]:
+                    art_path, text_page = page_jobs[i].result()
+
+                    # أ. إضافة صفحة النص
+                    if text_page.output_path:
+                        generated_images.append(text_page.output_path)
+
+                    # ب. إضافة صفحة الرسم (لتكون على اليسار مقابلة للنص)
+                    if art_path:
+                        generated_images.append(art_path)
+
+            # الـ PDF يُرسل بعد آخر صفحة
+            delivery.join()
+        finally:
+            delivery.cancel()
+            page_pool.shutdown(wait=True)
+            fetch_job.close()
+            # الكتاب انتهى: لا حاجة لتثبيت نموذج الرسم له بعد الآن
+            router = get_router()
+            router.release(book_key)
+            logger.debug(f"🔌 Provider stats: {router.snapshot()}")
 
         if len(generated_images) > 1:
             send_text_message(sender_id, "✅ اكتملت الرسومات! جاري تجهيز القصة لك... 📚")
@@ -2,6 +2,8 @@ import requests
 import os
 import json
 import logging
+import threading
+from concurrent.futures import Future
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -121,6 +123,8 @@ def send_image(sender_id, image_path):
     mime_type = "image/png"
     if image_path.lower().endswith(".jpg") or image_path.lower().endswith(".jpeg"):
         mime_type = "image/jpeg"
+    elif image_path.lower().endswith(".webp"):
+        mime_type = "image/webp"
         
     try:
         files = {
@@ -135,3 +139,51 @@ def send_image(sender_id, image_path):
             logger.info(f"Image sent to {sender_id}")
     except Exception as e:
         logger.error(f"Exception sending image: {e}")
+
+
+class OrderedDelivery:
+    """
+    Delivers a book's pages to the user in reading order as they finish.
+
+    Pages may complete in any order; each one is buffered until every page
+    before it has been delivered. A single background thread calls
+    deliver(index, item) in order, so slow sends never block rendering.
+    item is None for a page that failed.
+    """
+
+    def __init__(self, count, deliver):
+        self._slots = [Future() for _ in range(count)]
+        self._deliver = deliver
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="page-delivery", daemon=True)
+        self._thread.start()
+
+    def complete(self, index, item=None):
+        """Marks page index as ready (safe to call from any thread, once per page)."""
+        with self._lock:
+            slot = self._slots[index]
+            if not slot.done():
+                slot.set_result(item)
+
+    def _run(self):
+        for index, slot in enumerate(self._slots):
+            item = slot.result()
+            if self._cancelled:
+                return
+            try:
+                self._deliver(index, item)
+            except Exception as e:
+                logger.error(f"Exception delivering page {index + 1}: {e}")
+
+    def join(self, timeout=None):
+        """Waits until every page has been delivered."""
+        self._thread.join(timeout)
+
+    def cancel(self):
+        """Stops delivery (e.g. the book failed) and releases the delivery thread."""
+        with self._lock:
+            self._cancelled = True
+            for slot in self._slots:
+                if not slot.done():
+                    slot.set_result(None)
@@ -7,11 +7,17 @@ import base64
 import json
 import os
 import uuid
+import time
 import logging
-from typing import Optional, Dict, List, Tuple
+from typing import Optional, Dict, List, Tuple, Iterator, Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from dotenv import load_dotenv
 
+from transaction_ledger import get_ledger
+from provider_router import get_router, KIND_IMAGE, KIND_VISION, KIND_PAYMENT
+from prompt_compiler import PromptCompiler, PromptSection
+
 # ============================================================================
 # 🔧 Logging Configuration
 # ============================================================================
@@ -26,6 +32,11 @@ logger = logging.getLogger(__name__)
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")  # للـ Vision API (اختياري)
 
+_prompt_compiler = PromptCompiler()
+
+# أقصى عدد طلبات رسم متزامنة لكل كتاب
+IMAGE_CONCURRENCY = int(os.getenv("IMAGE_CONCURRENCY", "4"))
+
 # ============================================================================
 # 🎨 Character Profile System
 # ============================================================================
@@ -284,6 +295,13 @@ def _save_image_from_data(image_data: str) -> Optional[str]:
         return None
 
 
+def _response_cost(response_data: dict) -> Optional[float]:
+    """استخراج التكلفة الفعلية من usage (إن أرسلها المزود)"""
+    usage = response_data.get("usage") or {}
+    cost = usage.get("cost")
+    return float(cost) if isinstance(cost, (int, float)) else None
+
+
 def prepare_prompt_safe(
     prompt: str, 
     child_name: Optional[str] = None,
@@ -425,27 +443,16 @@ def create_character_reference(
     # استخدام GPT-4 Vision للتحليل (عبر OpenAI المباشر أو OpenRouter)
     # ============================================================================
     
-    api_key = OPENAI_API_KEY
-    api_base = "https://api.openai.com/v1/chat/completions"
-    model_name = "gpt-4o"
-    headers = {
-        "Content-Type": "application/json"
-    }
-
-    # تحديد المزود (OpenAI vs OpenRouter)
-    if api_key:
-        headers["Authorization"] = f"Bearer {api_key}"
-    elif OPENROUTER_API_KEY:
-        api_key = OPENROUTER_API_KEY
-        api_base = "https://openrouter.ai/api/v1/chat/completions"
-        model_name = "google/gemini-2.0-flash-001" # Switching to Gemini 2.0 Flash for better vision analysis
-        headers["Authorization"] = f"Bearer {api_key}"
-        headers["HTTP-Referer"] = os.getenv("APP_URL", "https://kids-stories.app")
-        headers["X-Title"] = "Kids Story Generator"
-    else:
+    # اختيار نموذج الرؤية عبر الموجّه (حسب الأداء الحيّ والمفاتيح المتاحة)
+    backend = get_router().select(KIND_VISION)
+    if not backend:
         logger.warning("⚠️ No API Key found for analysis.")
         return "ERROR_REFUSAL"
 
+    model_name = backend.model
+    headers = backend.build_headers()
+    started = time.monotonic()
+
     try:
         logger.info(f"👁️ Analyzing character with {model_name}...")
         
@@ -493,7 +500,7 @@ Start directly with the description.
         }
         
         response = requests.post(
-            api_base,
+            backend.api_base,
             headers=headers,
             json=payload,
             timeout=45
@@ -501,6 +508,7 @@ Start directly with the description.
         
         if response.status_code == 200:
             data = response.json()
+            get_router().record_success(backend, time.monotonic() - started, _response_cost(data))
             ai_description = data["choices"][0]["message"]["content"].strip()
             
             # التحقق من الرفض (Safety Refusal Detection)
@@ -526,10 +534,12 @@ Start directly with the description.
             
             return enhanced_desc
         else:
+            get_router().record_failure(backend, time.monotonic() - started)
             logger.error(f"❌ Vision API error: {response.status_code} - {response.text}")
             return "ERROR_REFUSAL"
             
     except Exception as e:
+        get_router().record_failure(backend, time.monotonic() - started)
         logger.error(f"❌ AI analysis failed: {e}", exc_info=True)
         return "ERROR_REFUSAL"
 
@@ -575,10 +585,14 @@ def generate_storybook_page(
     gender: str = "ولد", 
     age_group: str = "3-4",
     is_cover: bool = False,
-    timeout: int = 120
+    timeout: int = 120,
+    book_key: Optional[str] = None,
+    stats: Optional[Dict] = None,
+    precompiled: bool = False
 ) -> Optional[str]:
     """
     توليد صفحة قصة باستخدام FLUX Klein 4b عبر OpenRouter
+    (أو أفضل نموذج صور سليم يختاره موجّه المزودين)
     
     Args:
         char_desc (str): وصف الشخصية المفصل (من create_character_reference)
@@ -588,6 +602,10 @@ def generate_storybook_page(
         age_group (str): العمر
         is_cover (bool): هل هذه صفحة الغلاف
         timeout (int): وقت الانتظار بالثواني
+        book_key (str, optional): مفتاح الكتاب لتثبيت نفس النموذج لكل صفحاته
+        stats (dict, optional): يُملأ بالنموذج المستخدم وزمن الطلب والتكلفة
+        precompiled (bool): prompt مجمّع مسبقاً (StoryManager.build_full_prompt) فيه
+            الأسلوب والشخصية والمشهد ضمن الحد، فيُرسل كما هو بدون تغليف أو تجميع ثانٍ
     
     Returns:
         Optional[str]: مسار الملف المؤقت أو رابط URL، أو None في حالة الفشل
@@ -648,34 +666,46 @@ def generate_storybook_page(
             "low contrast, no 3D effects, clean paper grain texture"
         )
         
-        # ✅ Complete prompt with FLUX structure + Character Consistency
-        # REORDERED: Action/Scene comes FIRST to ensure the story event is the main focus
-        full_prompt = (
-            f"Create a {style} children's storybook illustration. "
-            f"ACTION SHOT: {safe_prompt}. "  # ← Action/Scene is now PRIORITY #1
-            f"The main character is: {char_desc}. " 
-            f"Composition: {composition}. "
-            f"Lighting: {lighting_style}. "
-            f"Quality: {quality}. "
-            f"CRITICAL: The character MUST match the exact description provided, "
-            f"with precise attention to skin tone, hair style, hair color, and all facial features. "
-            f"NO variations from the character description."
-        )
+        if precompiled:
+            # الـ prompt جاهز ومحسوب ضمن الحد مرة واحدة في StoryManager
+            full_prompt = safe_prompt
+            prompt_chars = raw_chars = len(full_prompt)
+        else:
+            # ✅ Complete prompt with FLUX structure + Character Consistency
+            # REORDERED: Action/Scene comes FIRST to ensure the story event is the main focus
+            # The compiler drops clauses already present in the scene prompt (e.g. the
+            # StoryManager style/character blocks) and keeps the result within budget.
+            compiled = _prompt_compiler.compile([
+                PromptSection("", "Create a children's storybook illustration.", priority=0, required=True),
+                PromptSection("ACTION SHOT", safe_prompt, priority=0, required=True),  # ← Action/Scene is now PRIORITY #1
+                PromptSection("The main character is", char_desc, priority=1, required=True, shrinkable=True),
+                PromptSection("Style", style, priority=2),
+                PromptSection("Composition", composition, priority=5),
+                PromptSection("Lighting", lighting_style, priority=4),
+                PromptSection("Quality", quality, priority=3),
+                PromptSection("CRITICAL", (
+                    "The character MUST match the exact description provided, "
+                    "with precise attention to skin tone, hair style, hair color, and all facial features. "
+                    "NO variations from the character description."
+                ), priority=2),
+            ])
+            full_prompt = compiled.text
+            prompt_chars, raw_chars = compiled.chars, compiled.raw_chars
         
-        logger.info(f"🎨 Generating image with FLUX Klein 4b...")
+        backend = get_router().select(KIND_IMAGE, sticky_key=book_key)
+        if not backend:
+            logger.error("❌ No image backend available")
+            return None
+        
+        logger.info(f"🎨 Generating image with {backend.model}...")
         logger.info(f"👤 Character: {char_desc[:100]}...")
-        logger.debug(f"📝 Full Prompt Length: {len(full_prompt)} characters")
+        logger.debug(f"📝 Full Prompt Length: {prompt_chars} characters (raw {raw_chars})")
         
         # إعداد الطلب
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": os.getenv("APP_URL", "https://kids-stories.app"),
-            "X-Title": "Kids Story Generator"
-        }
+        headers = backend.build_headers()
         
         payload = {
-            "model": "black-forest-labs/flux.2-klein-4b", 
+            "model": backend.model, 
             "messages": [
                 {
                     "role": "user", 
@@ -685,12 +715,18 @@ def generate_storybook_page(
         }
         
         # إرسال الطلب
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=timeout
-        )
+        started = time.monotonic()
+        try:
+            response = requests.post(
+                backend.api_base,
+                headers=headers,
+                json=payload,
+                timeout=timeout
+            )
+        except requests.exceptions.RequestException:
+            get_router().record_failure(backend, time.monotonic() - started)
+            raise
+        elapsed = time.monotonic() - started
         
         # معالجة الاستجابة
         if response.status_code == 200:
@@ -704,18 +740,29 @@ def generate_storybook_page(
                 result = _save_image_from_data(image_data)
                 
                 if result:
-                    logger.info(f"✅ Image generated successfully!")
+                    cost = _response_cost(data)
+                    get_router().record_success(backend, elapsed, cost)
+                    if stats is not None:
+                        stats.update({
+                            "model": backend.model,
+                            "latency": elapsed,
+                            "cost": cost if cost is not None else backend.cost_per_call
+                        })
+                    logger.info(f"✅ Image generated successfully! ({backend.model}, {elapsed:.1f}s)")
                     return result
                 else:
+                    get_router().record_failure(backend, elapsed)
                     logger.error("❌ Failed to save/process image")
                     return None
             else:
+                get_router().record_failure(backend, elapsed)
                 logger.warning("⚠️ No valid image data found in response")
                 logger.debug(f"Response keys: {list(data.keys())}")
                 if data.get("choices"):
                     logger.debug(f"Message keys: {list(data['choices'][0].get('message', {}).keys())}")
                 return None
         else:
+            get_router().record_failure(backend, elapsed)
             logger.error(f"❌ OpenRouter API Error: {response.status_code}")
             logger.error(f"Response: {response.text[:300]}")
             return None
@@ -731,23 +778,118 @@ def generate_storybook_page(
         return None
 
 
+def iter_story_images(
+    story_pages: List[Dict],
+    char_desc: str,
+    child_name: Optional[str] = None,
+    gender: str = "ولد",
+    age_group: str = "3-4",
+    max_workers: Optional[int] = None,
+    retries: int = 1,
+    book_key: Optional[str] = None,
+    precompiled: bool = False
+) -> Iterator[Dict]:
+    """
+    توليد صور القصة بالتوازي وإرجاع كل صفحة فور اكتمالها (بترتيب الاكتمال)
+    
+    Args:
+        story_pages: قائمة صفحات القصة
+        char_desc: وصف الشخصية المفصل (من create_character_reference)
+        child_name: اسم الطفل
+        gender: الجنس
+        age_group: العمر
+        max_workers: أقصى عدد طلبات متزامنة (IMAGE_CONCURRENCY افتراضياً)
+        retries: عدد مرات إعادة المحاولة للصفحة الفاشلة
+        book_key: مفتاح الكتاب لتثبيت نفس نموذج الرسم
+        precompiled: الـ prompts مجمّعة بالفعل ضمن الحد (StoryManager.generate_story_prompts)
+            فتُرسل كما هي دون تغليف جديد
+    
+    Yields:
+        نتيجة كل صفحة: index, page_number, success, image_path, text,
+        elapsed (زمن الصفحة بالثواني), cost, model, attempts
+    """
+    total = len(story_pages)
+    if not total:
+        return
+    
+    workers = max(1, min(max_workers or IMAGE_CONCURRENCY, total))
+    logger.info(f"📚 Generating {total} story images ({workers} in parallel) with consistent character...")
+    logger.info(f"👤 Using character: {char_desc[:80]}...")
+    
+    def render(idx: int, page: Dict) -> Dict:
+        page_num = page.get("page_number", page.get("page", idx + 1))
+        prompt = page.get("prompt", "") or page.get("magic_image_prompt", "")
+        started = time.monotonic()
+        stats = {}
+        image_path = None
+        attempts = 0
+        
+        while image_path is None and attempts <= retries:
+            attempts += 1
+            image_path = generate_storybook_page(
+                char_desc=char_desc,  # ✅ Same character for all pages
+                prompt=prompt,
+                child_name=child_name,
+                gender=gender,
+                age_group=age_group,
+                book_key=book_key,
+                stats=stats,
+                precompiled=precompiled
+            )
+        
+        return {
+            "index": idx,
+            "page_number": page_num,
+            "success": image_path is not None,
+            "image_path": image_path,
+            "text": page.get("text", ""),
+            "elapsed": time.monotonic() - started,
+            "cost": stats.get("cost", 0.0),
+            "model": stats.get("model"),
+            "attempts": attempts
+        }
+    
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="story-image") as pool:
+        futures = [pool.submit(render, idx, page) for idx, page in enumerate(story_pages)]
+        for future in as_completed(futures):
+            result = future.result()
+            status = "✅" if result["success"] else "❌"
+            logger.info(
+                f"{status} Page {result['page_number']}/{total}: "
+                f"{'Success' if result['success'] else 'Failed'} in {result['elapsed']:.1f}s"
+            )
+            yield result
+
+
 def generate_story_images(
     story_pages: List[Dict],
     char_desc: str,
     child_name: Optional[str] = None,
-    gender: str = "ولد"
+    gender: str = "ولد",
+    age_group: str = "3-4",
+    max_workers: Optional[int] = None,
+    retries: int = 1,
+    book_key: Optional[str] = None,
+    on_result: Optional[Callable[[Dict], None]] = None,
+    precompiled: bool = False
 ) -> List[Dict]:
     """
-    توليد صور لقصة كاملة مع ضمان اتساق الشخصية
+    توليد صور لقصة كاملة مع ضمان اتساق الشخصية (بالتوازي)
     
     Args:
         story_pages: قائمة صفحات القصة
         char_desc: وصف الشخصية المفصل (من create_character_reference)
         child_name: اسم الطفل
         gender: الجنس
+        age_group: العمر
+        max_workers: أقصى عدد طلبات متزامنة
+        retries: عدد مرات إعادة المحاولة للصفحة الفاشلة
+        book_key: مفتاح الكتاب لتثبيت نفس نموذج الرسم
+        on_result: دالة تُستدعى مع نتيجة كل صفحة فور اكتمالها
+        precompiled: الـ prompts مجمّعة بالفعل (صفحات StoryManager) فلا تُجمّع مرة أخرى
     
     Returns:
-        قائمة نتائج التوليد
+        قائمة نتائج التوليد بترتيب الصفحات
     
     Example:
         >>> # Create character once
@@ -766,37 +908,20 @@ def generate_story_images(
         >>> results = generate_story_images(pages, char_desc, "لوجى")
     """
     results = []
-    total = len(story_pages)
     
-    logger.info(f"📚 Generating {total} story images with consistent character...")
-    logger.info(f"👤 Using character: {char_desc[:80]}...")
+    for result in iter_story_images(
+        story_pages, char_desc, child_name=child_name, gender=gender, age_group=age_group,
+        max_workers=max_workers, retries=retries, book_key=book_key, precompiled=precompiled
+    ):
+        results.append(result)
+        if on_result:
+            on_result(result)
     
-    for idx, page in enumerate(story_pages, 1):
-        page_num = page.get("page_number", idx)
-        prompt = page.get("prompt", "") or page.get("magic_image_prompt", "")
-        
-        logger.info(f"🎨 Processing page {page_num}/{total}")
-        
-        image_path = generate_storybook_page(
-            char_desc=char_desc,  # ✅ Same character for all pages
-            prompt=prompt,
-            child_name=child_name,
-            gender=gender,
-            is_cover=(idx == 1)
-        )
-        
-        results.append({
-            "page_number": page_num,
-            "success": image_path is not None,
-            "image_path": image_path,
-            "text": page.get("text", "")
-        })
-        
-        status = "✅" if image_path else "❌"
-        logger.info(f"{status} Page {page_num}: {'Success' if image_path else 'Failed'}")
+    results.sort(key=lambda r: r["index"])
     
     success_count = sum(1 for r in results if r["success"])
-    logger.info(f"📊 Results: {success_count}/{total} images generated")
+    total_cost = sum(r["cost"] or 0.0 for r in results)
+    logger.info(f"📊 Results: {success_count}/{len(results)} images generated (cost ${total_cost:.4f})")
     
     return results
 
@@ -809,12 +934,18 @@ def verify_payment_screenshot(
     image_b64: str, 
     target_number: str,
     use_ai_verification: bool = False,
-    min_amount: float = 50.0
+    min_amount: float = 50.0,
+    screenshot_hash: Optional[str] = None
 ) -> Tuple[bool, str]:
     """
     التحقق من لقطة شاشة الدفع (InstaPay / Vodafone Cash)
     مع التحقق من عدم تكرار رقم المعاملة (Transaction ID)
     
+    Args:
+        image_b64: صورة الإيصال (يُفضّل بعد normalize_screenshot لتقليل حجم الطلب)
+        screenshot_hash: بصمة الصورة بعد التجهيز؛ الصورة المكررة يُحكم عليها
+            من السجل مباشرة بدون استدعاء نموذج الرؤية
+    
     Returns:
         (is_valid, reason_message)
     """
@@ -826,15 +957,19 @@ def verify_payment_screenshot(
         logger.info("✅ Payment checking bypassed (Optimization Mode)")
         return True, "Payment auto-approved (AI verification disabled)"
     
-    # التحقق من API Key (OpenRouter or OpenAI)
-    api_key = OPENROUTER_API_KEY or OPENAI_API_KEY
-    if not api_key:
+    # صورة سبق فحصها: لا حاجة لاستدعاء النموذج مرة أخرى
+    cached = _cached_screenshot_verdict(screenshot_hash)
+    if cached:
+        return cached
+    
+    # اختيار نموذج قراءة الإيصال عبر الموجّه
+    backend = get_router().select(KIND_PAYMENT)
+    if not backend:
         logger.warning("⚠️ No API Key found, skipping verification")
         return True, "Auto-approved (No API Key)"
     
-    is_openrouter = bool(OPENROUTER_API_KEY)
-    api_url = "https://openrouter.ai/api/v1/chat/completions" if is_openrouter else "https://api.openai.com/v1/chat/completions"
-    model_name = "google/gemini-2.0-flash-001" if is_openrouter else "gpt-4o"
+    model_name = backend.model
+    started = time.monotonic()
     
     try:
         logger.info(f"👁️ Analyzing payment screenshot with {model_name}...")
@@ -843,13 +978,8 @@ def verify_payment_screenshot(
         if not image_b64.startswith("data:"):
             image_b64 = f"data:image/jpeg;base64,{image_b64}"
         
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        if is_openrouter:
-            headers["HTTP-Referer"] = os.getenv("APP_URL", "https://kids-stories.app")
+        headers = backend.build_headers()
+        if "X-Title" in headers:
             headers["X-Title"] = "Kids Story Payment Verification"
         
         # طلب JSON محدد لاستخراج رقم المعاملة
@@ -887,7 +1017,7 @@ def verify_payment_screenshot(
         }
         
         response = requests.post(
-            api_url,
+            backend.api_base,
             headers=headers,
             json=payload,
             timeout=30
@@ -895,6 +1025,7 @@ def verify_payment_screenshot(
         
         if response.status_code == 200:
             data = response.json()
+            get_router().record_success(backend, time.monotonic() - started, _response_cost(data))
             content = data["choices"][0]["message"]["content"]
             result_json = json.loads(content)
             
@@ -903,15 +1034,20 @@ def verify_payment_screenshot(
             if result_json.get("status") == "VALID":
                 tx_id = result_json.get("transaction_id", "UNKNOWN")
                 
-                # Check for duplicate transaction ID
-                if is_duplicate_transaction(tx_id):
-                    reason = f"Duplicate Transaction ID detected: {tx_id}"
+                # Check and record the transaction ID in one atomic step
+                if not claim_transaction_id(tx_id):
+                    reason = f"Duplicate or unrecorded Transaction ID: {tx_id}"
                     logger.warning(f"❌ {reason}")
                     return False, reason
                 
-                # Save transaction ID
-                save_transaction_id(tx_id)
+                # نفس الصورة قد تصل مرتين في نفس اللحظة (ورقم المعاملة UNKNOWN لا يُتتبع)،
+                # فالقبول لمن سجّله فقط
                 msg = f"Payment verified and recorded: {tx_id}"
+                if not _record_screenshot_verdict(screenshot_hash, True, msg):
+                    reason = "Duplicate screenshot: this receipt was already used"
+                    logger.warning(f"❌ {reason}")
+                    return False, reason
+                
                 logger.info(f"✅ {msg}")
                 return True, msg
             else:
@@ -919,48 +1055,80 @@ def verify_payment_screenshot(
                 logger.warning(f"❌ Payment rejected by AI: {reason}")
                 return False, reason
         else:
+            get_router().record_failure(backend, time.monotonic() - started)
             logger.error(f"❌ Vision API error: {response.status_code}")
             return True, "Auto-approved due to API error"
             
+    except requests.exceptions.RequestException as e:
+        get_router().record_failure(backend, time.monotonic() - started)
+        logger.error(f"❌ Payment verification error: {e}")
+        return True, f"Auto-approved due to exception: {str(e)}"
     except Exception as e:
         logger.error(f"❌ Payment verification error: {e}")
         return True, f"Auto-approved due to exception: {str(e)}"
 
 # --- Helper Functions for Transaction Tracking ---
 
-TRACKING_FILE = "used_transactions.json"
-
 def is_duplicate_transaction(tx_id: str) -> bool:
-    if tx_id == "UNKNOWN": return False # Can't track unknown IDs
-    
-    if not os.path.exists(TRACKING_FILE):
-        return False
-        
     try:
-        with open(TRACKING_FILE, "r") as f:
-            used_ids = json.load(f)
-            return tx_id in used_ids
-    except:
-        return False
+        return get_ledger().contains(tx_id)
+    except Exception as e:
+        logger.error(f"Failed to check transaction ID: {e}")
+        return True
 
 def save_transaction_id(tx_id: str):
-    if tx_id == "UNKNOWN": return
+    try:
+        get_ledger().claim(tx_id)
+    except Exception as e:
+        logger.error(f"Failed to save transaction ID: {e}")
+
+def _cached_screenshot_verdict(screenshot_hash: Optional[str]) -> Optional[Tuple[bool, str]]:
+    """
+    إيصال سبق قبوله يُرفض الآن لأن معاملته استُخدمت بالفعل.
+    الأحكام بالرفض لا تُحفظ (ولا تُستخدم إن وُجدت في السجل) حتى يمكن إعادة
+    المحاولة مع صورة أخطأ النموذج في قراءتها.
+    """
+    if not screenshot_hash:
+        return None
+    try:
+        verdict = get_ledger().get_screenshot_verdict(screenshot_hash)
+    except Exception as e:
+        logger.error(f"Failed to read screenshot verdict: {e}")
+        return None
+    if not verdict or not verdict[0]:
+        return None
     
-    used_ids = []
-    if os.path.exists(TRACKING_FILE):
-        try:
-            with open(TRACKING_FILE, "r") as f:
-                used_ids = json.load(f)
-        except:
-            used_ids = []
-            
-    used_ids.append(tx_id)
+    reason = "Duplicate screenshot: this receipt was already used"
+    logger.info(f"♻️ Screenshot seen before, skipping vision call: {reason}")
+    return False, reason
+
+def _record_screenshot_verdict(screenshot_hash: Optional[str], is_valid: bool, reason: str) -> bool:
+    """
+    Returns:
+        True إذا سجّل هذا الاستدعاء الحكم، False إذا كانت الصورة مقبولة ومسجلة بالفعل
+        أو تعذّر التسجيل (لا قبول بدون تسجيل)
+    """
+    if not screenshot_hash:
+        return True
+    try:
+        return get_ledger().record_screenshot_verdict(screenshot_hash, is_valid, reason)
+    except Exception as e:
+        logger.error(f"Failed to record screenshot verdict: {e}")
+        return False
+
+def claim_transaction_id(tx_id: str) -> bool:
+    """
+    فحص وتسجيل رقم المعاملة في خطوة ذرّية واحدة
     
+    Returns:
+        True إذا كان الرقم جديداً (تم تسجيله الآن)، False إذا كان مكرراً
+        أو تعذّر تسجيله (تعطل السجل لا يفتح الباب لإعادة استخدام المعاملات)
+    """
     try:
-        with open(TRACKING_FILE, "w") as f:
-            json.dump(used_ids, f)
+        return get_ledger().claim(tx_id)
     except Exception as e:
-        logger.error(f"Failed to save transaction ID: {e}")
+        logger.error(f"❌ Failed to record transaction ID {tx_id}, rejecting for manual review: {e}")
+        return False
 
 
 # ============================================================================
@@ -1,118 +1,341 @@
 import os
+import hmac
+import time
+import hashlib
 import requests
 import logging
+import threading
+from requests.adapters import HTTPAdapter
+
+from transaction_ledger import get_ledger
 
 logger = logging.getLogger(__name__)
 
 PAYMOB_API_KEY = os.getenv("PAYMOB_API_KEY")
 PAYMOB_INTEGRATION_ID = os.getenv("PAYMOB_INTEGRATION_ID")
 PAYMOB_IFRAME_ID = os.getenv("PAYMOB_IFRAME_ID")
+PAYMOB_HMAC_SECRET = os.getenv("PAYMOB_HMAC_SECRET")
 
-def get_auth_token():
-    """
-    Step 1: Get Authentication Token from Paymob.
-    """
-    try:
-        if not PAYMOB_API_KEY:
-            logger.error("PAYMOB_API_KEY is not set.")
-            return None
-            
-        response = requests.post(
-            "https://accept.paymob.com/api/auth/tokens",
-            json={"api_key": PAYMOB_API_KEY},
-            timeout=10
-        )
-        response.raise_for_status()
-        return response.json().get("token")
-    except Exception as e:
-        logger.error(f"Error getting Paymob auth token: {e}")
-        return None
+PAYMOB_BASE_URL = "https://accept.paymob.com/api"
 
-def register_order(auth_token, amount_cents):
+# Paymob auth tokens are valid for one hour; refresh well before that.
+AUTH_TOKEN_TTL = int(os.getenv("PAYMOB_AUTH_TOKEN_TTL", "3600"))
+AUTH_TOKEN_REFRESH_MARGIN = 600
+
+# Number of orders kept pre-registered per amount (0 disables prefetching).
+ORDER_POOL_SIZE = int(os.getenv("PAYMOB_ORDER_POOL_SIZE", "3"))
+
+
+class PaymobClient:
     """
-    Step 2: Register an order.
+    Paymob API client with a pooled HTTP session, a cached auth token and
+    a small pool of pre-registered orders per amount, so the hot path of
+    link creation is a single payment-key request.
     """
-    try:
-        response = requests.post(
-            "https://accept.paymob.com/api/ecommerce/orders",
-            json={
+
+    def __init__(self, api_key=None, integration_id=None, iframe_id=None, order_pool_size=ORDER_POOL_SIZE):
+        self.api_key = api_key
+        self.integration_id = integration_id
+        self.iframe_id = iframe_id
+        self.order_pool_size = order_pool_size
+
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+        self._token = None
+        self._token_expires_at = 0.0
+        self._token_lock = threading.Lock()
+
+        self._orders = {}  # amount_cents -> [order_id, ...]
+        self._orders_lock = threading.Lock()
+        self._refilling = set()
+
+        self._timings = {}  # step -> {"count", "total", "last"}
+        self._timings_lock = threading.Lock()
+
+    # ------------------------------------------------------
+    # Timing
+    # ------------------------------------------------------
+
+    def _record_timing(self, step, started):
+        elapsed = time.monotonic() - started
+        with self._timings_lock:
+            stats = self._timings.setdefault(step, {"count": 0, "total": 0.0, "last": 0.0})
+            stats["count"] += 1
+            stats["total"] += elapsed
+            stats["last"] = elapsed
+        logger.info(f"Paymob {step} took {elapsed * 1000:.0f} ms")
+
+    def get_step_timings(self):
+        """
+        Returns per-step latency stats in milliseconds:
+        {step: {"count": n, "avg_ms": x, "last_ms": y}}
+        """
+        with self._timings_lock:
+            return {
+                step: {
+                    "count": s["count"],
+                    "avg_ms": round(s["total"] / s["count"] * 1000, 1),
+                    "last_ms": round(s["last"] * 1000, 1)
+                }
+                for step, s in self._timings.items()
+            }
+
+    def _post(self, step, path, payload):
+        started = time.monotonic()
+        try:
+            response = self.session.post(f"{PAYMOB_BASE_URL}{path}", json=payload, timeout=10)
+            response.raise_for_status()
+            return response.json()
+        finally:
+            self._record_timing(step, started)
+
+    # ------------------------------------------------------
+    # Step 1: Auth token (cached)
+    # ------------------------------------------------------
+
+    def get_auth_token(self, force_refresh=False):
+        """
+        Returns a cached auth token, requesting a new one only when the
+        current token is missing or close to expiry.
+        """
+        with self._token_lock:
+            if not force_refresh and self._token and time.monotonic() < self._token_expires_at:
+                return self._token
+            try:
+                if not self.api_key:
+                    logger.error("PAYMOB_API_KEY is not set.")
+                    return None
+
+                token = self._post("auth", "/auth/tokens", {"api_key": self.api_key}).get("token")
+                if token:
+                    self._token = token
+                    self._token_expires_at = time.monotonic() + AUTH_TOKEN_TTL - AUTH_TOKEN_REFRESH_MARGIN
+                return token
+            except Exception as e:
+                logger.error(f"Error getting Paymob auth token: {e}")
+                return None
+
+    # ------------------------------------------------------
+    # Step 2: Orders (optionally pre-registered)
+    # ------------------------------------------------------
+
+    def register_order(self, auth_token, amount_cents):
+        try:
+            data = self._post("register_order", "/ecommerce/orders", {
                 "auth_token": auth_token,
                 "delivery_needed": "false",
                 "amount_cents": amount_cents,
                 "currency": "EGP",
                 "items": []
-            },
-            timeout=10
-        )
-        response.raise_for_status()
-        return response.json().get("id")
-    except Exception as e:
-        logger.error(f"Error registering Paymob order: {e}")
-        return None
-
-def get_payment_key(auth_token, order_id, amount_cents, billing_data):
-    """
-    Step 3: Get Payment Key.
-    """
-    try:
-        if not PAYMOB_INTEGRATION_ID:
-            logger.error("PAYMOB_INTEGRATION_ID is not set.")
+            })
+            return data.get("id")
+        except Exception as e:
+            logger.error(f"Error registering Paymob order: {e}")
             return None
 
-        response = requests.post(
-            "https://accept.paymob.com/api/acceptance/payment_keys",
-            json={
+    def prefetch_orders(self, amount_cents, count=None):
+        """
+        Pre-registers orders for an amount so later link creation can skip
+        the order round trip.
+        """
+        count = self.order_pool_size if count is None else count
+        token = self.get_auth_token()
+        if not token:
+            return
+        with self._orders_lock:
+            missing = count - len(self._orders.get(amount_cents, []))
+        for _ in range(max(0, missing)):
+            order_id = self.register_order(token, amount_cents)
+            if not order_id:
+                break
+            with self._orders_lock:
+                self._orders.setdefault(amount_cents, []).append(order_id)
+
+    def prefetch_orders_async(self, amount_cents, count=None):
+        """Refills the order pool for an amount on a background thread."""
+        if self.order_pool_size <= 0:
+            return
+        with self._orders_lock:
+            if amount_cents in self._refilling:
+                return
+            self._refilling.add(amount_cents)
+
+        def refill():
+            try:
+                self.prefetch_orders(amount_cents, count)
+            finally:
+                with self._orders_lock:
+                    self._refilling.discard(amount_cents)
+
+        threading.Thread(target=refill, name="paymob-prefetch", daemon=True).start()
+
+    def take_order(self, auth_token, amount_cents):
+        """
+        Returns a pre-registered order when one is available, otherwise
+        registers one inline. The pool is refilled in the background.
+        """
+        with self._orders_lock:
+            pool = self._orders.get(amount_cents)
+            order_id = pool.pop(0) if pool else None
+        self.prefetch_orders_async(amount_cents)
+        if order_id:
+            return order_id
+        return self.register_order(auth_token, amount_cents)
+
+    # ------------------------------------------------------
+    # Step 3: Payment key
+    # ------------------------------------------------------
+
+    def get_payment_key(self, auth_token, order_id, amount_cents, billing_data):
+        try:
+            if not self.integration_id:
+                logger.error("PAYMOB_INTEGRATION_ID is not set.")
+                return None
+
+            data = self._post("payment_key", "/acceptance/payment_keys", {
                 "auth_token": auth_token,
                 "amount_cents": amount_cents,
-                "expiration": 3600, 
+                "expiration": 3600,
                 "order_id": order_id,
                 "billing_data": billing_data,
                 "currency": "EGP",
-                "integration_id": PAYMOB_INTEGRATION_ID
-            },
-            timeout=10
-        )
-        response.raise_for_status()
-        return response.json().get("token")
-    except Exception as e:
-        logger.error(f"Error getting Paymob payment key: {e}")
-        return None
-
-def generate_payment_link(amount_egp, user_info):
+                "integration_id": self.integration_id
+            })
+            return data.get("token")
+        except Exception as e:
+            logger.error(f"Error getting Paymob payment key: {e}")
+            return None
+
+    def iframe_url(self, payment_key):
+        if not self.iframe_id:
+            # If no iframe ID, maybe fallback to the simple processed link?
+            # But usually you need iframe ID. Let's return a direct link if possible or just iframe URL.
+            # Paymob frame URL: https://accept.paymob.com/api/acceptance/iframes/{iframe_id}?payment_token={payment_key}
+            return f"https://accept.paymob.com/api/acceptance/iframes/12345?payment_token={payment_key}" # Placeholder ID
+        return f"https://accept.paymob.com/api/acceptance/iframes/{self.iframe_id}?payment_token={payment_key}"
+
+
+paymob_client = PaymobClient(PAYMOB_API_KEY, PAYMOB_INTEGRATION_ID, PAYMOB_IFRAME_ID)
+
+
+def get_auth_token():
+    """
+    Step 1: Get Authentication Token from Paymob (cached until close to expiry).
+    """
+    return paymob_client.get_auth_token()
+
+def register_order(auth_token, amount_cents):
+    """
+    Step 2: Register an order.
+    """
+    return paymob_client.register_order(auth_token, amount_cents)
+
+def get_payment_key(auth_token, order_id, amount_cents, billing_data):
+    """
+    Step 3: Get Payment Key.
+    """
+    return paymob_client.get_payment_key(auth_token, order_id, amount_cents, billing_data)
+
+def prefetch_orders(amounts_egp):
+    """
+    Warms the auth token and pre-registers orders for the given prices
+    (e.g. at startup) in the background.
+    """
+    for amount_egp in amounts_egp:
+        paymob_client.prefetch_orders_async(int(amount_egp * 100))
+
+def generate_payment_link(amount_egp, user_info, sender_id=None, product=None, context=None):
     """
     Orchestrates the Paymob flow and returns the iframe URL.
+    With a cached token and a pre-registered order this is one round trip.
+
+    When sender_id is given, the order is mapped to that user so the
+    /paymob/callback endpoint can confirm the payment without a screenshot.
+    context (the user's choices for the order) is stored with it, so the
+    order can be fulfilled even if the conversation state was lost.
     """
-    token = get_auth_token()
+    started = time.monotonic()
+    token = paymob_client.get_auth_token()
     if not token: return None
-    
+
     amount_cents = int(amount_egp * 100)
-    order_id = register_order(token, amount_cents)
+    order_id = paymob_client.take_order(token, amount_cents)
     if not order_id: return None
-    
+
     # Needs valid billing data even if dummy
     billing_data = {
-        "apartment": "NA", 
-        "email": user_info.get("email", "user@example.com"), 
-        "floor": "NA", 
-        "first_name": user_info.get("first_name", "User"), 
-        "street": "NA", 
-        "building": "NA", 
-        "phone_number": user_info.get("phone_number", "+201000000000"), 
-        "shipping_method": "NA", 
-        "postal_code": "NA", 
-        "city": "Cairo", 
-        "country": "EG", 
-        "last_name": user_info.get("last_name", "Customer"), 
+        "apartment": "NA",
+        "email": user_info.get("email", "user@example.com"),
+        "floor": "NA",
+        "first_name": user_info.get("first_name", "User"),
+        "street": "NA",
+        "building": "NA",
+        "phone_number": user_info.get("phone_number", "+201000000000"),
+        "shipping_method": "NA",
+        "postal_code": "NA",
+        "city": "Cairo",
+        "country": "EG",
+        "last_name": user_info.get("last_name", "Customer"),
         "state": "NA"
     }
-    
-    payment_key = get_payment_key(token, order_id, amount_cents, billing_data)
-    if not payment_key: return None
-    
-    if not PAYMOB_IFRAME_ID:
-        # If no iframe ID, maybe fallback to the simple processed link?
-        # But usually you need iframe ID. Let's return a direct link if possible or just iframe URL.
-        # Paymob frame URL: https://accept.paymob.com/api/acceptance/iframes/{iframe_id}?payment_token={payment_key}
-        return f"https://accept.paymob.com/api/acceptance/iframes/12345?payment_token={payment_key}" # Placeholder ID
-        
-    return f"https://accept.paymob.com/api/acceptance/iframes/{PAYMOB_IFRAME_ID}?payment_token={payment_key}"
+
+    payment_key = paymob_client.get_payment_key(token, order_id, amount_cents, billing_data)
+    if not payment_key:
+        # The cached token may have been revoked early; retry once with a fresh one.
+        token = paymob_client.get_auth_token(force_refresh=True)
+        if not token: return None
+        payment_key = paymob_client.get_payment_key(token, order_id, amount_cents, billing_data)
+        if not payment_key: return None
+
+    if sender_id:
+        try:
+            get_ledger().record_order(order_id, sender_id, product, context)
+        except Exception as e:
+            logger.error(f"Failed to map Paymob order {order_id} to {sender_id}: {e}")
+            return None
+
+    paymob_client._record_timing("payment_link_total", started)
+    return paymob_client.iframe_url(payment_key)
+
+def get_step_timings():
+    return paymob_client.get_step_timings()
+
+# Fields of the processed-transaction callback covered by Paymob's HMAC, in order.
+CALLBACK_HMAC_FIELDS = [
+    "amount_cents", "created_at", "currency", "error_occured", "has_parent_transaction",
+    "id", "integration_id", "is_3d_secure", "is_auth", "is_capture", "is_refunded",
+    "is_standalone_payment", "is_voided", "order.id", "owner", "pending",
+    "source_data.pan", "source_data.sub_type", "source_data.type", "success"
+]
+
+def _callback_field(obj, path):
+    value = obj
+    for key in path.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, dict):
+        value = value.get("id")
+    return "" if value is None else str(value)
+
+def compute_callback_hmac(transaction_obj, secret=None):
+    """
+    HMAC-SHA512 of a Paymob transaction callback object, as documented by Paymob.
+    """
+    secret = secret or PAYMOB_HMAC_SECRET
+    message = "".join(_callback_field(transaction_obj, f) for f in CALLBACK_HMAC_FIELDS)
+    return hmac.new(secret.encode(), message.encode(), hashlib.sha512).hexdigest()
+
+def verify_callback_hmac(transaction_obj, received_hmac, secret=None):
+    """
+    Checks the hmac query parameter of a Paymob callback in constant time.
+    """
+    secret = secret or PAYMOB_HMAC_SECRET
+    if not secret:
+        logger.error("PAYMOB_HMAC_SECRET is not set; rejecting callback.")
+        return False
+    if not received_hmac or not isinstance(transaction_obj, dict):
+        return False
+    expected = compute_callback_hmac(transaction_obj, secret)
+    return hmac.compare_digest(expected, received_hmac.lower())
@@ -1,22 +1,215 @@
-from fpdf import FPDF
+"""
+PDF assembly for the storybook.
+
+Pages are written straight to the output file, one object at a time:
+- JPEG files are embedded as-is (DCTDecode), with no decode or re-encode.
+- Plain 8-bit PNG files embed their compressed IDAT data as-is (FlateDecode
+  with the PNG predictor). Other images are decoded once and deflated.
+- Identical image files (same bytes) are stored once and shared between pages.
+"""
+
 import os
+import zlib
+import struct
+import hashlib
+from io import BytesIO
+from typing import NamedTuple, Optional
+
+from PIL import Image
+
+PAGE_SIZE_MM = 210
+PAGE_SIZE_PT = PAGE_SIZE_MM * 72 / 25.4
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8"
+
+JPEG_COLOR_SPACES = {"L": "/DeviceGray", "RGB": "/DeviceRGB", "CMYK": "/DeviceCMYK"}
+
+
+class PdfImage(NamedTuple):
+    width: int
+    height: int
+    color_space: str
+    bits: int
+    filter: str
+    data: bytes
+    extra: str = ""  # additional dictionary entries (DecodeParms, Decode)
+
+
+def _jpeg_image(data: bytes) -> Optional[PdfImage]:
+    """The JPEG stream as-is; only the header is parsed (by Pillow) for size and colors."""
+    with Image.open(BytesIO(data)) as img:
+        color_space = JPEG_COLOR_SPACES.get(img.mode)
+        if color_space is None:
+            return None
+        extra = ""
+        if img.mode == "CMYK" and "adobe" in img.info:
+            # Adobe (Photoshop) CMYK JPEGs store inverted values
+            extra = "/Decode [1 0 1 0 1 0 1 0]"
+        return PdfImage(img.width, img.height, color_space, 8, "/DCTDecode", data, extra)
+
+
+def _png_image(data: bytes) -> Optional[PdfImage]:
+    """
+    The compressed IDAT data as-is, for 8-bit gray/RGB/palette PNGs without
+    interlacing or transparency. None for anything else.
+    """
+    pos = len(PNG_SIGNATURE)
+    header = None
+    palette = None
+    idat = []
+    while pos + 8 <= len(data):
+        length, chunk_type = struct.unpack(">I4s", data[pos:pos + 8])
+        body = data[pos + 8:pos + 8 + length]
+        pos += 12 + length
+        if chunk_type == b"IHDR":
+            header = struct.unpack(">IIBBBBB", body)
+        elif chunk_type == b"PLTE":
+            palette = body
+        elif chunk_type == b"tRNS":
+            return None
+        elif chunk_type == b"IDAT":
+            idat.append(body)
+        elif chunk_type == b"IEND":
+            break
+
+    if header is None or not idat:
+        return None
+    width, height, bits, color_type, _, _, interlace = header
+    if bits != 8 or interlace:
+        return None
+    if color_type == 0:
+        color_space, colors = "/DeviceGray", 1
+    elif color_type == 2:
+        color_space, colors = "/DeviceRGB", 3
+    elif color_type == 3 and palette:
+        color_space, colors = f"[/Indexed /DeviceRGB {len(palette) // 3 - 1} <{palette.hex()}>]", 1
+    else:
+        return None  # alpha channel
+    extra = f"/DecodeParms << /Predictor 15 /Colors {colors} /BitsPerComponent 8 /Columns {width} >>"
+    return PdfImage(width, height, color_space, 8, "/FlateDecode", b"".join(idat), extra)
+
+
+def _decoded_image(data: bytes) -> PdfImage:
+    """Fallback for other formats: decode once (transparency over white) and deflate."""
+    with Image.open(BytesIO(data)) as img:
+        if img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+            img = img.convert("RGBA")
+            background = Image.new("RGB", img.size, (255, 255, 255))
+            background.paste(img, mask=img.getchannel("A"))
+            img = background
+        elif img.mode not in ("L", "RGB"):
+            img = img.convert("RGB")
+        color_space = "/DeviceGray" if img.mode == "L" else "/DeviceRGB"
+        return PdfImage(img.width, img.height, color_space, 8, "/FlateDecode", zlib.compress(img.tobytes(), 6))
+
+
+def load_pdf_image(data: bytes) -> PdfImage:
+    """Picks the cheapest way to embed the image file's bytes."""
+    image = None
+    if data.startswith(JPEG_SIGNATURE):
+        image = _jpeg_image(data)
+    elif data.startswith(PNG_SIGNATURE):
+        image = _png_image(data)
+    return image or _decoded_image(data)
+
+
+class PdfWriter:
+    """
+    Minimal streaming PDF writer: one full-page image per page.
+
+    Objects are written to the file as pages are added; only the byte
+    offsets are kept in memory. Object 1 is the catalog and object 2 the
+    page tree, both written by close().
+    """
+
+    def __init__(self, f, page_size=PAGE_SIZE_PT):
+        self._f = f
+        self.page_size = page_size
+        self._offsets = {}
+        self._next_id = 3
+        self._pages = []
+        self._images = {}  # sha1 of the file -> (object id, resource name)
+        self._write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def _write(self, data: bytes):
+        self._f.write(data)
+
+    def _new_id(self) -> int:
+        obj_id = self._next_id
+        self._next_id += 1
+        return obj_id
+
+    def _object(self, obj_id: int, body: str, stream: Optional[bytes] = None):
+        self._offsets[obj_id] = self._f.tell()
+        self._write(f"{obj_id} 0 obj\n{body}\n".encode("latin-1"))
+        if stream is not None:
+            self._write(b"stream\n")
+            self._write(stream)
+            self._write(b"\nendstream\n")
+        self._write(b"endobj\n")
+
+    def _image(self, data: bytes):
+        key = hashlib.sha1(data).digest()
+        if key not in self._images:
+            image = load_pdf_image(data)
+            obj_id = self._new_id()
+            entries = [
+                "/Type /XObject /Subtype /Image", f"/Width {image.width} /Height {image.height}",
+                f"/ColorSpace {image.color_space} /BitsPerComponent {image.bits}",
+                f"/Filter {image.filter}", image.extra, f"/Length {len(image.data)}",
+            ]
+            self._object(obj_id, f"<< {' '.join(e for e in entries if e)} >>", image.data)
+            self._images[key] = (obj_id, f"I{len(self._images) + 1}")
+        return self._images[key]
+
+    def add_image_page(self, data: bytes):
+        """Adds a page filled with the image (stretched to the square page, like before)."""
+        image_id, name = self._image(data)
+        size = f"{self.page_size:.2f}"
+        content = f"q {size} 0 0 {size} 0 0 cm /{name} Do Q".encode("latin-1")
+        content_id = self._new_id()
+        self._object(content_id, f"<< /Length {len(content)} >>", content)
+        page_id = self._new_id()
+        self._object(page_id, (
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {size} {size}] "
+            f"/Resources << /XObject << /{name} {image_id} 0 R >> >> /Contents {content_id} 0 R >>"
+        ))
+        self._pages.append(page_id)
+
+    def add_image_file(self, path: str):
+        with open(path, "rb") as f:
+            self.add_image_page(f.read())
+
+    def close(self):
+        """Writes the page tree, catalog, cross-reference table and trailer."""
+        kids = " ".join(f"{page_id} 0 R" for page_id in self._pages)
+        self._object(2, f"<< /Type /Pages /Kids [{kids}] /Count {len(self._pages)} >>")
+        self._object(1, "<< /Type /Catalog /Pages 2 0 R >>")
+
+        xref_offset = self._f.tell()
+        lines = [f"xref\n0 {self._next_id}\n", "0000000000 65535 f \n"]
+        lines += [f"{self._offsets[obj_id]:010d} 00000 n \n" for obj_id in range(1, self._next_id)]
+        lines.append(f"trailer\n<< /Size {self._next_id} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n")
+        self._write("".join(lines).encode("latin-1"))
+
 
 def create_pdf(image_paths, output_path):
     """
     Combines a list of image paths into a single PDF.
     """
+    temp_path = output_path + ".part"
     try:
-        # Use custom square size 210x210 mm
-        pdf = FPDF(unit='mm', format=(210, 210))
-        for img_path in image_paths:
-            # Add a new page for each image
-            pdf.add_page()
-            # Standard square size 210 x 210 mm.
-            # We'll fill the square page with the image
-            pdf.image(img_path, x=0, y=0, w=210, h=210)
-            
-        pdf.output(output_path)
+        # Square 210 x 210 mm pages, each filled with its image
+        with open(temp_path, "wb") as f:
+            writer = PdfWriter(f)
+            for img_path in image_paths:
+                writer.add_image_file(img_path)
+            writer.close()
+        os.replace(temp_path, output_path)
         return output_path
     except Exception as e:
         print(f"Error creating PDF: {e}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
         return None
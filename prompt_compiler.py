@@ -0,0 +1,292 @@
+"""
+مُجمّع الـ Prompts (Prompt Compiler)
+
+يجمع أقسام الـ prompt (الأسلوب، الشخصية، المشهد، ...) في نص واحد مضغوط:
+- يحذف الجمل والعبارات المكررة بين الأقسام (مثل MASTER_STYLE ووصف الشخصية
+  اللذين كانا يتكرران بين StoryManager و generate_storybook_page)
+- يلتزم بحد أقصى لعدد الحروف (PROMPT_MAX_CHARS) بحذف الأقسام الأقل أهمية أولاً،
+  ثم تقصير الأقسام القابلة للاختصار (مثل وصف الشخصية)، دون المساس بالمشهد
+- يسجّل مقاييس حجم الـ prompt قبل وبعد الضغط
+- يجمّع الأقسام الثابتة لكتاب كامل مرة واحدة (PromptPrefix) مع hash ثابت
+"""
+
+import os
+import re
+import hashlib
+import logging
+import threading
+from typing import Optional, List, Dict
+
+logger = logging.getLogger(__name__)
+
+# الحد الافتراضي لطول الـ prompt النهائي بالحروف (0 = بدون حد)
+# كتاب عادي (وصف شخصية حتى ~1350 حرفاً) يبقى أقل من ~2750 حرفاً بكل أقسامه،
+# فالحد لا يتدخل إلا مع الأوصاف الطويلة بشكل غير طبيعي
+DEFAULT_MAX_CHARS = int(os.getenv("PROMPT_MAX_CHARS", "3000"))
+
+# أقل عدد كلمات لعبارة تُحذف لأنها موجودة ضمن عبارة أطول سبقتها
+MIN_SUBSUMED_WORDS = 3
+
+# تقدير تقريبي: ~4 حروف لكل token في النصوص الإنجليزية
+CHARS_PER_TOKEN = 4
+
+_BULLET_RE = re.compile(r"^\s*[-•*]\s*")
+_NORMALIZE_RE = re.compile(r"[^\w]+", re.UNICODE)
+
+
+class PromptSection:
+    """قسم واحد من الـ prompt"""
+
+    def __init__(self, label: str, body: str, priority: int = 5, required: bool = False,
+                 shrinkable: bool = False):
+        """
+        Args:
+            label: عنوان القسم (مثل "SCENE ACTION") أو "" بدون عنوان
+            body: محتوى القسم
+            priority: الأقل رقماً هو الأهم (يُحذف آخراً عند تجاوز الحد)
+            required: لا يُحذف أبداً عند تجاوز الحد
+            shrinkable: قسم إجباري يمكن اختصار آخره (عند آخر عبارة كاملة) إذا
+                بقي الـ prompt أطول من الحد بعد حذف الأقسام الاختيارية
+        """
+        self.label = label
+        self.body = body or ""
+        self.priority = priority
+        self.required = required
+        self.shrinkable = shrinkable
+
+
+class CompiledPrompt:
+    """نتيجة التجميع مع مقاييس الحجم"""
+
+    def __init__(self, text: str, raw_chars: int, dropped_sections: List[str], truncated: bool,
+                 prefix_hash: Optional[str] = None):
+        self.text = text
+        self.raw_chars = raw_chars
+        self.chars = len(text)
+        self.estimated_tokens = (self.chars + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+        self.dropped_sections = dropped_sections
+        self.truncated = truncated
+        self.prefix_hash = prefix_hash
+
+    def __str__(self):
+        return self.text
+
+
+def _normalize(clause: str) -> str:
+    return _NORMALIZE_RE.sub(" ", clause.lower()).strip()
+
+
+def _split_clauses(body: str) -> List[str]:
+    """
+    تقسيم النص إلى عبارات مع الإبقاء على علامات الترقيم الخاصة بكل عبارة.
+    لا يتم التقسيم داخل الأقواس، مثل "(low angle, side view, etc.)".
+    """
+    clauses = []
+    for line in body.splitlines():
+        line = _BULLET_RE.sub("", line).strip()
+        if not line:
+            continue
+
+        depth = 0
+        current = []
+        for i, ch in enumerate(line):
+            current.append(ch)
+            if ch == "(":
+                depth += 1
+            elif ch == ")":
+                depth = max(0, depth - 1)
+            elif ch in ",.;" and depth == 0 and (i + 1 == len(line) or line[i + 1].isspace()):
+                clauses.append("".join(current).strip())
+                current = []
+        tail = "".join(current).strip()
+        if tail:
+            # نهاية السطر بدون علامة ترقيم = نهاية عبارة (إلا العناوين المنتهية بـ ":")
+            clauses.append(tail if tail.endswith(":") else tail + ",")
+    return clauses
+
+
+def _join_clauses(clauses: List[str]) -> str:
+    text = " ".join(clauses)
+    if text.endswith(","):
+        text = text[:-1] + "."
+    return text
+
+
+def _total_chars(items) -> int:
+    lines = [line for _, line in items if line]
+    return sum(len(line) for line in lines) + max(0, len(lines) - 1)
+
+
+def _shrink_line(line: str, max_len: int, label: str) -> str:
+    """قص السطر عند آخر عبارة كاملة ضمن max_len ("" إذا لم يبق منه شيء بعد العنوان)"""
+    cut = line[:max(0, max_len)]
+    boundary = max(cut.rfind(". "), cut.rfind(", "))
+    head = len(label) + 2 if label else 0
+    if boundary < head:
+        return ""
+    return cut[:boundary] + "."
+
+
+class PromptPrefix:
+    """
+    أقسام ثابتة مجمّعة مسبقاً (مثل أسلوب الرسم ووصف الشخصية لكتاب كامل).
+    كل صفحة تضيف أقسامها فقط، ويستمر حذف التكرار من حيث توقف الـ prefix.
+    """
+
+    def __init__(self, compiler: "PromptCompiler", rendered, seen_keys, seen_text: str, raw_chars: int):
+        self._compiler = compiler
+        self._rendered = tuple(rendered)
+        self._seen_keys = frozenset(seen_keys)
+        self._seen_text = seen_text
+        self.raw_chars = raw_chars
+        self.text = "\n".join(line for _, line in self._rendered)
+        # مفتاح ثابت للـ prefix (للكاش أو لتثبيت مزوّد الخدمة)
+        self.hash = hashlib.sha256(self.text.encode("utf-8")).hexdigest()[:16]
+
+    def compile(self, sections: List[PromptSection]) -> CompiledPrompt:
+        """تجميع الأقسام الخاصة بالصفحة بعد الـ prefix"""
+        return self._compiler._compile(sections, prefix=self)
+
+
+class PromptCompiler:
+    """تجميع الأقسام في prompt واحد بدون تكرار وضمن حد الحجم"""
+
+    def __init__(self, max_chars: Optional[int] = None):
+        self.max_chars = DEFAULT_MAX_CHARS if max_chars is None else max_chars
+
+    def compile(self, sections: List[PromptSection]) -> CompiledPrompt:
+        return self._compile(sections)
+
+    def prefix(self, sections: List[PromptSection]) -> PromptPrefix:
+        """تجميع الأقسام الثابتة مرة واحدة لإعادة استخدامها مع كل صفحة"""
+        seen_keys = set()
+        rendered, seen_text = self._dedupe(sections, seen_keys, " ")
+        raw_chars = sum(len(s.label) + len(s.body) for s in sections)
+        return PromptPrefix(self, rendered, seen_keys, seen_text, raw_chars)
+
+    @staticmethod
+    def _dedupe(sections: List[PromptSection], seen_keys: set, seen_text: str):
+        # حذف التكرار: أول ظهور لأي عبارة هو الذي يبقى
+        # العبارات القصيرة (مثل "skin tone") تُحذف فقط إذا تكررت حرفياً،
+        # حتى لا تختفي من قوائم مثل "skin tone, hair style, hair color"
+        rendered = []  # (section, line)
+        for section in sections:
+            kept = []
+            for clause in _split_clauses(section.body):
+                key = _normalize(clause)
+                if not key:
+                    continue
+                if key in seen_keys:
+                    continue
+                if key.count(" ") + 1 >= MIN_SUBSUMED_WORDS and f" {key} " in seen_text:
+                    continue
+                seen_keys.add(key)
+                seen_text += key + " "
+                kept.append(clause)
+            if not kept:
+                continue
+            body = _join_clauses(kept)
+            line = f"{section.label}: {body}" if section.label else body
+            rendered.append((section, line))
+        return rendered, seen_text
+
+    def _compile(self, sections: List[PromptSection], prefix: Optional[PromptPrefix] = None) -> CompiledPrompt:
+        raw_chars = sum(len(s.label) + len(s.body) for s in sections)
+
+        # 1. حذف التكرار (استكمالاً لحالة الـ prefix إن وُجد)
+        if prefix is not None:
+            rendered, _ = self._dedupe(sections, set(prefix._seen_keys), prefix._seen_text)
+            rendered = list(prefix._rendered) + rendered
+            raw_chars += prefix.raw_chars
+        else:
+            rendered, _ = self._dedupe(sections, set(), " ")
+
+        # 2. الالتزام بالحد: حذف الأقسام الاختيارية الأقل أهمية أولاً
+        dropped = []
+        truncated = False
+        if self.max_chars:
+            optional = sorted(
+                (item for item in rendered if not item[0].required),
+                key=lambda item: item[0].priority,
+                reverse=True
+            )
+            for item in optional:
+                if _total_chars(rendered) <= self.max_chars:
+                    break
+                rendered.remove(item)
+                dropped.append(item[0].label or "untitled")
+
+            # 3. ثم اختصار الأقسام القابلة للاختصار (الأقل أهمية أولاً).
+            # الأقسام الإجبارية الأخرى (مثل المشهد) لا تُقص أبداً
+            shrinkable = sorted(
+                (i for i, (section, _) in enumerate(rendered) if section.shrinkable),
+                key=lambda i: rendered[i][0].priority,
+                reverse=True
+            )
+            for i in shrinkable:
+                excess = _total_chars(rendered) - self.max_chars
+                if excess <= 0:
+                    break
+                section, line = rendered[i]
+                rendered[i] = (section, _shrink_line(line, len(line) - excess, section.label))
+                truncated = True
+
+        text = "\n".join(line for _, line in rendered if line)
+        if dropped:
+            logger.warning(f"⚠️ Prompt over the {self.max_chars} budget, dropped sections: {dropped}")
+        if truncated:
+            logger.warning(f"⚠️ Prompt shortened to {len(text)} chars (budget {self.max_chars})")
+        if self.max_chars and len(text) > self.max_chars:
+            logger.warning(
+                f"⚠️ Prompt is {len(text)} chars, over the {self.max_chars} budget: "
+                f"required sections were kept whole"
+            )
+
+        compiled = CompiledPrompt(text, raw_chars, dropped, truncated,
+                                  prefix_hash=prefix.hash if prefix is not None else None)
+        _metrics.record(compiled)
+        logger.debug(
+            f"📝 Prompt compiled: {raw_chars} → {compiled.chars} chars "
+            f"(~{compiled.estimated_tokens} tokens), dropped={dropped}"
+        )
+        return compiled
+
+
+class PromptMetrics:
+    """مقاييس تراكمية لحجم الـ prompts على مستوى العملية"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.count = 0
+        self.raw_chars = 0
+        self.compiled_chars = 0
+        self.max_chars = 0
+        self.truncated = 0
+
+    def record(self, compiled: CompiledPrompt):
+        with self._lock:
+            self.count += 1
+            self.raw_chars += compiled.raw_chars
+            self.compiled_chars += compiled.chars
+            self.max_chars = max(self.max_chars, compiled.chars)
+            self.truncated += int(compiled.truncated)
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            avg = self.compiled_chars / self.count if self.count else 0
+            saved = 1 - (self.compiled_chars / self.raw_chars) if self.raw_chars else 0
+            return {
+                "prompts": self.count,
+                "avg_chars": round(avg, 1),
+                "avg_tokens": round(avg / CHARS_PER_TOKEN, 1),
+                "max_chars": self.max_chars,
+                "saved_ratio": round(saved, 3),
+                "truncated": self.truncated
+            }
+
+
+_metrics = PromptMetrics()
+
+
+def get_prompt_metrics() -> Dict:
+    return _metrics.snapshot()
@@ -0,0 +1,253 @@
+"""
+موجّه مزودي النماذج (Provider Router)
+
+يسجّل عدة نماذج للصور وللرؤية (Vision)، ويتابع لكل نموذج زمن الاستجابة
+ونسبة الأخطاء والتكلفة بشكل حيّ، ثم يختار لكل طلب أفضل نموذج سليم.
+يدعم التوجيه الثابت (Sticky) لكل كتاب حتى يبقى أسلوب الرسم متسقاً
+في جميع صفحات القصة.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional, Dict, List
+
+logger = logging.getLogger(__name__)
+
+OPENROUTER_API_BASE = "https://openrouter.ai/api/v1/chat/completions"
+OPENAI_API_BASE = "https://api.openai.com/v1/chat/completions"
+
+# أنواع الطلبات المدعومة (لكل نوع نماذجه وإحصائياته المستقلة)
+KIND_IMAGE = "image"
+KIND_VISION = "vision"      # تحليل صورة الطفل (وصف الشخصية)
+KIND_PAYMENT = "payment"    # قراءة إيصال التحويل
+
+# إعدادات الصحة (Circuit Breaker)
+FAILURE_THRESHOLD = 3       # عدد الأخطاء المتتالية قبل إيقاف النموذج مؤقتاً
+COOLDOWN_SECONDS = 60       # مدة الإيقاف المؤقت
+EWMA_ALPHA = 0.3            # وزن القياس الأحدث في المتوسط المتحرك
+MAX_STICKY_KEYS = 2048      # أقصى عدد كتب نتذكر نموذجها
+
+
+class ProviderBackend:
+    """نموذج واحد مسجّل لدى الموجّه مع إحصائياته الحيّة"""
+
+    def __init__(
+        self,
+        name: str,
+        kind: str,
+        model: str,
+        api_base: str,
+        api_key: Optional[str],
+        cost_per_call: float = 0.0,
+        expected_latency: float = 30.0,
+        extra_headers: Optional[Dict[str, str]] = None
+    ):
+        self.name = name
+        self.kind = kind
+        self.model = model
+        self.api_base = api_base
+        self.api_key = api_key
+        self.cost_per_call = cost_per_call
+        self.extra_headers = extra_headers or {}
+
+        # الإحصائيات الحيّة
+        self.latency_ewma = expected_latency
+        self.error_ewma = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.total_cost = 0.0
+        self.cooldown_until = 0.0
+
+    def build_headers(self) -> Dict[str, str]:
+        headers = {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+        headers.update(self.extra_headers)
+        return headers
+
+    def is_healthy(self, now: Optional[float] = None) -> bool:
+        return (now or time.monotonic()) >= self.cooldown_until
+
+    def score(self, cost_weight: float = 0.0) -> float:
+        """كلما قل الرقم كان النموذج أفضل (زمن متوقع مع عقوبة الأخطاء والتكلفة)"""
+        error_penalty = 1.0 + 4.0 * self.error_ewma
+        return self.latency_ewma * error_penalty + cost_weight * self.cost_per_call
+
+    def stats(self) -> Dict:
+        return {
+            "model": self.model,
+            "kind": self.kind,
+            "latency_ewma": round(self.latency_ewma, 3),
+            "error_rate": round(self.error_ewma, 3),
+            "calls": self.calls,
+            "failures": self.failures,
+            "total_cost": round(self.total_cost, 6),
+            "healthy": self.is_healthy()
+        }
+
+
+class ProviderRouter:
+    """اختيار أفضل نموذج سليم لكل طلب بناءً على الأداء الحيّ"""
+
+    def __init__(self, cost_weight: float = 0.0):
+        self.cost_weight = cost_weight
+        self._backends: Dict[str, ProviderBackend] = {}
+        self._sticky: "OrderedDict[tuple, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, backend: ProviderBackend) -> ProviderBackend:
+        with self._lock:
+            self._backends[backend.name] = backend
+        logger.info(f"🔌 Registered {backend.kind} backend: {backend.name} ({backend.model})")
+        return backend
+
+    def backends(self, kind: str) -> List[ProviderBackend]:
+        return [b for b in self._backends.values() if b.kind == kind and b.api_key]
+
+    def select(self, kind: str, sticky_key: Optional[str] = None) -> Optional[ProviderBackend]:
+        """
+        اختيار النموذج الأنسب
+
+        Args:
+            kind: KIND_IMAGE أو KIND_VISION أو KIND_PAYMENT
+            sticky_key: مفتاح الكتاب (مثلاً sender_id) لتثبيت نفس النموذج لكل صفحاته
+        """
+        with self._lock:
+            candidates = self.backends(kind)
+            if not candidates:
+                return None
+
+            now = time.monotonic()
+
+            # 1. التوجيه الثابت: نفس النموذج للكتاب ما دام سليماً
+            if sticky_key is not None:
+                pinned = self._backends.get(self._sticky.get((kind, sticky_key)))
+                if pinned and pinned.api_key and pinned.is_healthy(now):
+                    self._sticky.move_to_end((kind, sticky_key))
+                    return pinned
+
+            # 2. أفضل نموذج سليم، أو الأقرب للتعافي إذا كانت كلها متوقفة
+            healthy = [b for b in candidates if b.is_healthy(now)]
+            if healthy:
+                chosen = min(healthy, key=lambda b: b.score(self.cost_weight))
+            else:
+                chosen = min(candidates, key=lambda b: b.cooldown_until)
+
+            if sticky_key is not None:
+                self._sticky[(kind, sticky_key)] = chosen.name
+                self._sticky.move_to_end((kind, sticky_key))
+                while len(self._sticky) > MAX_STICKY_KEYS:
+                    self._sticky.popitem(last=False)
+
+            return chosen
+
+    def record_success(self, backend: ProviderBackend, latency: float, cost: Optional[float] = None):
+        with self._lock:
+            backend.calls += 1
+            backend.consecutive_failures = 0
+            backend.latency_ewma += EWMA_ALPHA * (latency - backend.latency_ewma)
+            backend.error_ewma += EWMA_ALPHA * (0.0 - backend.error_ewma)
+            backend.total_cost += cost if cost is not None else backend.cost_per_call
+
+    def record_failure(self, backend: ProviderBackend, latency: float):
+        with self._lock:
+            backend.calls += 1
+            backend.failures += 1
+            backend.consecutive_failures += 1
+            backend.latency_ewma += EWMA_ALPHA * (latency - backend.latency_ewma)
+            backend.error_ewma += EWMA_ALPHA * (1.0 - backend.error_ewma)
+            if backend.consecutive_failures >= FAILURE_THRESHOLD:
+                backend.cooldown_until = time.monotonic() + COOLDOWN_SECONDS
+                backend.consecutive_failures = 0
+                logger.warning(f"⚠️ Backend {backend.name} degraded, cooling down for {COOLDOWN_SECONDS}s")
+
+    def release(self, sticky_key: str):
+        """نسيان النموذج المثبت لكتاب بعد انتهائه"""
+        with self._lock:
+            for key in [k for k in self._sticky if k[1] == sticky_key]:
+                del self._sticky[key]
+
+    def snapshot(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {name: b.stats() for name, b in self._backends.items()}
+
+
+def _openrouter_headers(title: str) -> Dict[str, str]:
+    return {
+        "HTTP-Referer": os.getenv("APP_URL", "https://kids-stories.app"),
+        "X-Title": title
+    }
+
+
+def _env_models(var: str) -> List[str]:
+    return [m.strip() for m in os.getenv(var, "").split(",") if m.strip()]
+
+
+def build_default_router() -> ProviderRouter:
+    """
+    بناء الموجّه بالنماذج الافتراضية
+
+    يمكن إضافة نماذج صور أو رؤية إضافية عبر OpenRouter من خلال
+    متغيري البيئة IMAGE_MODELS و VISION_MODELS (قائمة مفصولة بفواصل).
+    """
+    openrouter_key = os.getenv("OPENROUTER_API_KEY")
+    openai_key = os.getenv("OPENAI_API_KEY")
+    router = ProviderRouter(cost_weight=float(os.getenv("ROUTER_COST_WEIGHT", "0")))
+
+    # نماذج الصور (أولها هو الافتراضي)
+    image_models = ["black-forest-labs/flux.2-klein-4b"] + _env_models("IMAGE_MODELS")
+    for i, model in enumerate(dict.fromkeys(image_models)):
+        router.register(ProviderBackend(
+            name=f"{KIND_IMAGE}:openrouter:{model}",
+            kind=KIND_IMAGE,
+            model=model,
+            api_base=OPENROUTER_API_BASE,
+            api_key=openrouter_key,
+            expected_latency=30.0 + i,  # عند التساوي نفضّل ترتيب التسجيل
+            extra_headers=_openrouter_headers("Kids Story Generator")
+        ))
+
+    # نماذج الرؤية: نفس النموذج يُسجّل لكل نوع باسم مختلف حتى لا تختلط إحصائياته.
+    # الترتيب الأولي كما كان قبل الموجّه: تحليل صورة الطفل يفضّل gpt-4o،
+    # وقراءة الإيصال تفضّل Gemini عبر OpenRouter
+    vision_models = ["google/gemini-2.0-flash-001"] + _env_models("VISION_MODELS")
+    for kind, openai_latency, openrouter_latency in ((KIND_VISION, 8.0, 9.0), (KIND_PAYMENT, 9.0, 8.0)):
+        router.register(ProviderBackend(
+            name=f"{kind}:openai:gpt-4o",
+            kind=kind,
+            model="gpt-4o",
+            api_base=OPENAI_API_BASE,
+            api_key=openai_key,
+            expected_latency=openai_latency
+        ))
+        for i, model in enumerate(dict.fromkeys(vision_models)):
+            router.register(ProviderBackend(
+                name=f"{kind}:openrouter:{model}",
+                kind=kind,
+                model=model,
+                api_base=OPENROUTER_API_BASE,
+                api_key=openrouter_key,
+                expected_latency=openrouter_latency + i,
+                extra_headers=_openrouter_headers("Kids Story Generator")
+            ))
+
+    return router
+
+
+_router: Optional[ProviderRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> ProviderRouter:
+    """الموجّه المشترك للعملية (يُنشأ عند أول استخدام)"""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = build_default_router()
+    return _router
@@ -0,0 +1,254 @@
+"""
+فهرس القصص (Story Catalog)
+
+يحمّل كل ملفات stories_content/*.json عند بدء التشغيل، ويتحقق من صحتها،
+ويبني فهرساً ثابتاً (immutable) بمفتاح (القيمة، الفئة العمرية). تعديل الملفات
+يظهر تلقائياً خلال STORY_RELOAD_INTERVAL ثانية دون إعادة تشغيل.
+صيغتا المذكر والمؤنث لكل صفحة تُحسبان مرة واحدة هنا، فلا يبقى وقت الطلب
+إلا استبدال اسم الطفل.
+تجهيز القصة يصبح بحثاً في dict بدلاً من قراءة ملف JSON مع كل طلب.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from types import MappingProxyType
+from typing import Optional, Dict, Tuple, NamedTuple, Mapping
+
+from gender_adaptation import feminize_text
+
+logger = logging.getLogger(__name__)
+
+CONTENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "stories_content")
+
+# كل كم ثانية يُفحص تغيّر ملفات المحتوى (stat فقط). قيمة سالبة = بدون إعادة تحميل
+RELOAD_INTERVAL = float(os.getenv("STORY_RELOAD_INTERVAL", "5"))
+
+# أسماء القيم بالعربية كما تظهر للمستخدم في main → اسم ملف المحتوى
+VALUE_ALIASES = {
+    "الشجاعة": "courage",
+    "الصدق": "honesty",
+    "التعاون": "cooperation",
+    "الاحترام": "respect",
+}
+
+
+# الموضع الوحيد المتغير في نص الصفحة
+NAME_SLOT = "{child_name}"
+
+
+class StoryPage(NamedTuple):
+    page_number: int
+    text: str               # النص بصيغة المذكر (كما في الملف)
+    text_feminine: str      # نفس النص بصيغة المؤنث (محسوب مسبقاً عند التحميل)
+    prompt: str
+
+    def render_text(self, child_name: str, feminine: bool) -> str:
+        """تجهيز نص الصفحة: اختيار الصيغة ثم استبدال اسم الطفل فقط"""
+        template = self.text_feminine if feminine else self.text
+        return template.replace(NAME_SLOT, child_name)
+
+
+class Story(NamedTuple):
+    key: str            # اسم الملف بدون الامتداد (مثل "courage")
+    value: str          # اسم القيمة كما في الملف (مثل "الشجاعة")
+    age_group: str
+    title: str
+    pages: Tuple[StoryPage, ...]
+
+
+class StoryContentError(ValueError):
+    """محتوى قصة غير صالح"""
+
+
+def parse_story_file(key: str, data: dict) -> Dict[str, Story]:
+    """
+    التحقق من محتوى ملف قصة وتحويله إلى Story لكل فئة عمرية
+
+    Raises:
+        StoryContentError: إذا كان المحتوى غير صالح
+    """
+    if not isinstance(data, dict):
+        raise StoryContentError(f"{key}: root must be an object")
+
+    age_groups = data.get("age_groups")
+    if not isinstance(age_groups, dict) or not age_groups:
+        raise StoryContentError(f"{key}: missing 'age_groups'")
+
+    value = data.get("value") or key
+    stories = {}
+    for age_group, age_data in age_groups.items():
+        pages_data = age_data.get("pages") if isinstance(age_data, dict) else None
+        if not isinstance(pages_data, list) or not pages_data:
+            raise StoryContentError(f"{key}/{age_group}: 'pages' must be a non-empty list")
+
+        pages = []
+        for i, page in enumerate(pages_data, 1):
+            if not isinstance(page, dict):
+                raise StoryContentError(f"{key}/{age_group}: page {i} must be an object")
+            text = page.get("text")
+            prompt = page.get("magic_image_prompt", page.get("prompt"))
+            if not isinstance(text, str) or not text.strip():
+                raise StoryContentError(f"{key}/{age_group}: page {i} has no 'text'")
+            if not isinstance(prompt, str):
+                raise StoryContentError(f"{key}/{age_group}: page {i} has no 'prompt'")
+            pages.append(StoryPage(page.get("page_number", i), text, feminize_text(text), prompt))
+
+        stories[age_group] = Story(key, value, age_group, age_data.get("story_title", ""), tuple(pages))
+    return stories
+
+
+class _LoadedFile(NamedTuple):
+    mtime_ns: int
+    size: int
+    digest: str
+    stories: Dict[str, Story]
+
+
+class StoryCatalog:
+    """
+    فهرس ثابت للقصص بمفتاح (القيمة، الفئة العمرية)
+
+    يعاد تحميل أي ملف تغيّر (mtime/الحجم ثم hash المحتوى) دون إعادة تشغيل
+    العمليات. الفهرس الجديد يُبنى بالكامل ثم يُستبدل دفعة واحدة، والملف
+    التالف يُرفض مع الإبقاء على آخر نسخة سليمة منه.
+    """
+
+    def __init__(self, content_dir: str = CONTENT_DIR, reload_interval: float = RELOAD_INTERVAL):
+        self.content_dir = content_dir
+        self.reload_interval = reload_interval
+        self._files: Dict[str, _LoadedFile] = {}
+        self._reload_lock = threading.Lock()
+        self._next_check = 0.0
+        self._index: Mapping[Tuple[str, str], Story] = MappingProxyType({})
+        self._aliases: Mapping[str, str] = MappingProxyType({})
+        self.reload()
+        logger.info(f"📚 Story catalog loaded: {len(self._index)} stories from {content_dir}")
+
+    def reload(self) -> bool:
+        """
+        فحص ملفات المحتوى وإعادة تحميل ما تغيّر منها
+
+        Returns:
+            True إذا تغيّر الفهرس
+        """
+        with self._reload_lock:
+            self._next_check = time.monotonic() + self.reload_interval
+            try:
+                filenames = sorted(f for f in os.listdir(self.content_dir) if f.endswith(".json"))
+            except OSError as e:
+                logger.error(f"❌ Cannot list story content {self.content_dir}: {e}")
+                return False
+
+            files = {}
+            changed = set(self._files) - set(filenames)  # ملفات حُذفت
+            for filename in filenames:
+                previous = self._files.get(filename)
+                loaded = self._load_file(filename, previous)
+                if loaded is not None:
+                    files[filename] = loaded
+                    if previous is None or loaded.digest != previous.digest:
+                        changed.add(filename)
+
+            initial = not self._files
+            self._files = files
+            if not changed:
+                return False
+
+            self._swap_index()
+            if not initial:
+                logger.info(f"🔄 Story catalog reloaded: {sorted(changed)}")
+            return True
+
+    def _load_file(self, filename: str, previous: Optional[_LoadedFile]) -> Optional[_LoadedFile]:
+        """تحميل ملف إذا تغيّر، أو إرجاع النسخة السابقة (None إذا لا توجد نسخة سليمة)"""
+        path = os.path.join(self.content_dir, filename)
+        st = None
+        try:
+            st = os.stat(path)
+            if previous and previous.mtime_ns == st.st_mtime_ns and previous.size == st.st_size:
+                return previous
+
+            with open(path, "rb") as f:
+                raw = f.read()
+            digest = hashlib.sha256(raw).hexdigest()
+            if previous and previous.digest == digest:
+                # لُمس الملف دون تغيير المحتوى
+                return previous._replace(mtime_ns=st.st_mtime_ns, size=st.st_size)
+
+            key = filename[:-len(".json")]
+            stories = parse_story_file(key, json.loads(raw.decode("utf-8")))
+            return _LoadedFile(st.st_mtime_ns, st.st_size, digest, stories)
+        except Exception as e:
+            if previous:
+                logger.error(f"❌ Rejected edit to {filename}, keeping last good version: {e}")
+                # تجنب إعادة قراءة نفس النسخة التالفة في كل فحص
+                if st is not None:
+                    return previous._replace(mtime_ns=st.st_mtime_ns, size=st.st_size)
+                return previous
+            logger.error(f"❌ Skipping invalid story file {filename}: {e}")
+            return None
+
+    def _swap_index(self):
+        index = {}
+        aliases = {}
+        for filename, loaded in self._files.items():
+            key = filename[:-len(".json")]
+            for age_group, story in loaded.stories.items():
+                index[(key, age_group)] = story
+            aliases[key] = key
+            aliases[filename] = key
+            aliases[next(iter(loaded.stories.values())).value] = key
+
+        for alias, key in VALUE_ALIASES.items():
+            if key in aliases:
+                aliases[alias] = key
+
+        # القارئ يرى إما الفهرس القديم كاملاً أو الجديد كاملاً
+        self._index, self._aliases = MappingProxyType(index), MappingProxyType(aliases)
+
+    def maybe_reload(self):
+        """فحص دوري رخيص (stat فقط) لا يتجاوز مرة كل reload_interval ثانية"""
+        if self.reload_interval < 0 or time.monotonic() < self._next_check:
+            return
+        if self._reload_lock.locked():
+            return  # فحص آخر جارٍ بالفعل
+        self.reload()
+
+    def resolve(self, value: str) -> Optional[str]:
+        """تحويل اسم القيمة (بالعربية) أو اسم الملف إلى مفتاح الفهرس"""
+        return self._aliases.get(value) if value else None
+
+    def get(self, value: str, age_group: str) -> Optional[Story]:
+        """
+        Args:
+            value: اسم القيمة بالعربية ("الشجاعة") أو اسم الملف ("courage.json")
+            age_group: الفئة العمرية ("3-4")
+        """
+        self.maybe_reload()
+        index, aliases = self._index, self._aliases
+        key = aliases.get(value) if value else None
+        return index.get((key, age_group)) if key else None
+
+    def keys(self):
+        return self._index.keys()
+
+    def __len__(self):
+        return len(self._index)
+
+
+_catalog: Optional[StoryCatalog] = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog() -> StoryCatalog:
+    """الفهرس المشترك للعملية (يُحمّل عند أول استخدام ويتجدد تلقائياً)"""
+    global _catalog
+    if _catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = StoryCatalog()
+    return _catalog
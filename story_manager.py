@@ -1,7 +1,9 @@
-import json
-import os
 import logging
 
+from prompt_compiler import PromptCompiler, PromptSection
+from story_catalog import get_catalog
+from gender_adaptation import feminize_text
+
 logger = logging.getLogger(__name__)
 
 # ==========================================================
@@ -17,6 +19,15 @@ Whimsical, heartwarming mood,
 No cinematic lighting, no 3D effects, no intense glowing highlights.
 """
 
+COMPOSITION_RULES = """
+Wide environmental shots,
+Detailed background setting visible,
+Dynamic camera angles (low angle, side view, etc.),
+Rule of thirds,
+Balanced framing,
+Rich scene details.
+"""
+
 ANTI_DRIFT_RULES = """
 CRITICAL CHARACTER CONSISTENCY RULES:
 
@@ -29,6 +40,8 @@ CRITICAL CHARACTER CONSISTENCY RULES:
 """
 
 
+_prompt_compiler = PromptCompiler()
+
 # ==========================================================
 # STORY MANAGER PRO VERSION
 # ==========================================================
@@ -41,6 +54,7 @@ class StoryManager:
         self.character_desc = ""
         self.personality_block = ""
         self.outfit_lock = ""
+        self._prompt_prefix = None
 
     # ------------------------------------------------------
     # Gender Adaptation Logic
@@ -52,253 +66,10 @@ class StoryManager:
         Covers common verbs, adjectives, and pronouns used in the stories.
         Now includes prefix handling (waw, fa) for better matching.
         """
-        import re 
-        
         if self.gender == "ولد":
             return text
-            
-        # Dictionary of Masculine -> Feminine replacements
-        replacements = {
-            # Nouns/Titles
-            "بطل": "بطلة",
-            "ولد": "بنت",
-            "صديق": "صديقة",
-            "ابني": "بنتي",
-            "يا حبيبي": "يا حبيبتي",
-            "حبيبي": "حبيبتي",
-            "مستكشف": "مستكشفة",
-            "شاطر": "شاطرة",
-            "صغير": "صغيرة",
-            "جميل": "جميلة",
-            "كبير": "كبيرة",
-            "مخضوض": "مخضوضة",
-            "آسف": "آسفة",
-            "غلطان": "غلطانة",
-
-            # Pronouns/Suffixes
-            "هو": "هي",
-            "هم": "هن",
-            "أنت": "أنتي",
-            "لك": "ليكي",
-            "بنفسه": "بنفسها",
-            "نفسه": "نفسها",
-            "لنفسه": "لنفسها",
-            "لوحده": "لوحدها",
-            "صاحبه": "صاحبتها",
-            "أخوه": "أخوها",
-            "جده": "جدها",
-            "إيده": "إيدها",
-            "رجله": "رجلها",
-            "بؤه": "بؤها",
-            "قلبه": "قلبها",
-            "حواليه": "حواليها",
-            "وراه": "وراها",
-            "مكانه": "مكانها",
-            "بيته": "بيتها",
-            "أصحابه": " أصحابها",
-            "سريره": "سريرها",
-            "شنطته": "شنطتها",
-            "لعبته": "لعبتها",
-            "هدومه": "هدومها",
-            "إنه": "إنها",
-            "له": "لها",
-            "عنده": "عندها",
-            "منه": "منها",
-            "شجاعته": "شجاعتها",
-
-            # Adjectives / States
-            "شجاع": "شجاعة",
-            "ذكي": "ذكية",
-            "متعاون": "متعاونة",
-            "مؤدب": "مؤدبة",
-            "محترم": "محترمة",
-            "لطيف": "لطيفة",
-            "حنين": "حنينة",
-            "مبسوط": "مبسوطة",
-            "فرحان": "فرحانة",
-            "زعلان": "زعلانة",
-            "خايف": "خايفة",
-            "تعبان": "تعبانة",
-            "وحيد": "وحيدة",
-            "جديد": "جديدة",
-            "طيب": "طيبة",
-            "واقف": "واقفة",
-            "قاعد": "قاعدة",
-            "ماسك": "ماسكة",
-            "نايم": "نايمة",
-            "جاهز": "جاهزة",
-            "مستعد": "مستعدة",
-            "عايز": "عايزة",
-            "واثقة": "واثقة", # Already fem usually but good to have
-            "سعيد": "سعيدة",
-            "رايح": "رايحة",
-
-            # Verbs (Past)
-            "قال": "قالت",
-            "كان": "كانت",
-            "حب": "حبت",
-            "حس": "حست",
-            "افتكر": "افتكرت",
-            "وقع": "وقعت",
-            "قرر": "قررت",
-            "طلع": "طلعت",
-            "عدى": "عدت",
-            "مد": "مدت",
-            "شد": "شدت",
-            "قدر": "قدرت",
-            "شاف": "شافت",
-            "أنقذ": "أنقذت",
-            "قام": "قامت",
-            "فتح": "فتحت",
-            "ضحك": "ضحكت",
-            "وقف": "وقفت",
-            "لبس": "لبست",
-            "ابتسم": "ابتسمت",
-            "وصل": "وصلت",
-            "لقاها": "لقتها",
-            "مشي": "مشيت",
-            "قعد": "قعدت",
-            "رجع": "رجعت",
-            "خلص": "خلصت",
-            "جاب": "جابت",
-            "بدأ": "بدأت",
-            "فكر": "فكرت",
-            "وسع": "وسعت",
-            "نزل": "نزلت",
-            "صرخ": "صرخت",
-            "اتعلم": "اتعلمت",
-            "ساب": "سابت",
-            "راح": "راحت",
-            "لف": "لفت",
-            "قسم": "قسمت",
-            "عمل": "عملت",
-            "همس": "همست",
-            "قرب": "قربت",
-            "خطف": "خطفت",
-            "استأذن": "استأذنت",
-            "انتبه": "انتبهت",
-            "استخبى": "استخبت",
-            "شاور": "شاورت",
-            "دلق": "دلقت",
-            "عرف": "عرفت",
-            "ساعده": "ساعدها",
-            "كدب": "كدبت",
-            "حط": "حطت",
-            "حضنه": "حضنته",
-            "زعل": "زعلت", 
-            "عاش": "عاشت",
-            
-            # Verbs (Present)
-            "بيحب": "بتحب",
-            "بيلعب": "بتلعب",
-            "بيسلم": "بتسلم",
-            "بيستخبى": "بتستخبى",
-            "بيمد": "بتمد",
-            "بيقف": "بتقف",
-            "بيمشي": "بتمشي",
-            "بيتوازن": "بتتوازن",
-            "بيدور": "بتدور",
-            "بيفتش": "بتفتش",
-            "بيبعد": "بتبعد",
-            "بيجري": "بتجري",
-            "بيقول": "بتقول",
-            "بيصرخ": "بتصرخ",
-            "بيعيط": "بتعيط",
-            "بيشارك": "بتشارك",
-            "بيديها": "بتديها",
-            "بيرتبهم": "بترتبهم",
-            "بيتخيل": "بتتخيل",
-            "بيحضر": "بتحضر",
-            
-            # Imperative / Future
-            "تعالى": "تعالي",
-            "هيقابلهم": "هتقابلهم",
-            "مبقاش": "مبقتش",
-            "ماجاش": "ماجاتش",
-            "مستخباش": "مستخبتش",
-
-            # Verbs (Y-prefix -> T-prefix)
-            "يضحك": "تضحك",
-            "يبتسم": "تبتسم",
-            "يقول": "تقول",
-            "يروح": "تروح",
-            "يسيبه": "تسيبه", 
-            "يعمل": "تعمل",
-            "ينقذ": "تنقذ",
-            "يكون": "تكون",
-            "يصحى": "تصحى",
-            "يزعل": "تزعل",
-            "يقدر": "تقدر",
-            "يرتاح": "ترتاح",
-            "يعوز": "تعوز",
-            "يطلبها": "تطلبها",
-            "يضرب": "تضرب",
-            "يطبطب": "تطبطب",
-            "يشدها": "تشدها",
-            "يأذيها": "تأذيها",
-            "ياخد": "تاخد",
-            "يشده": "تشده",
-            "يخطفه": "تخطفه",
-            "يجيب": "تجيب",
-            "يحس": "تحس",
-            "يخاف": "تخاف",
-            "يجيبه": "تجيبه",
-            "يحضر": "تحضر",
-            "يساعد": "تساعد",
-            "يشيل": "تشيل",
-            "يرتب": "ترتب",
-            "يكلم": "تكلم",
-            "يسمع": "تسمع",
-            "يحترم": "تحترم"
-        }
-        
-        words = text.split()
-        new_words = []
-        
-        # Tashkeel removal regex
-        tashkeel_pattern = re.compile(r'[\u0617-\u061A\u064B-\u0652]')
-        
-        for word in words:
-            # Clean punctuation for matching using Regex
-            match = re.match(r"^([وفب]?)(.*?)([\.,!؟:\"]*)$", word)
-            
-            if match:
-                prefix, body, suffix = match.groups()
-                
-                # Remove tashkeel from body for lookup
-                clean_body = tashkeel_pattern.sub("", body)
-                clean_full_core = prefix + clean_body
-                
-                # Normalization (Alef)
-                clean_body = clean_body.replace("أ", "ا").replace("إ", "ا").replace("آ", "ا")
-                clean_full_core = clean_full_core.replace("أ", "ا").replace("إ", "ا").replace("آ", "ا")
-
-                # Strategy 1: Check FULL word 
-                if clean_full_core in replacements:
-                    replacement = replacements[clean_full_core]
-                    new_word = replacement + suffix
-                    new_words.append(new_word)
-                    continue
-                
-                # Strategy 2: Check BODY only
-                if clean_body in replacements:
-                    replacement = replacements[clean_body]
-                    new_word = prefix + replacement + suffix
-                    new_words.append(new_word)
-                    continue
-                
-                # Strategy 3: Check "Al-" + body
-                if clean_body.startswith("ال") and clean_body[2:] in replacements:
-                    replacement = replacements[clean_body[2:]]
-                    new_word = prefix + "ال" + replacement + suffix
-                    new_words.append(new_word)
-                    continue
-
-                new_words.append(word)
-            else:
-                new_words.append(word)
-                
-        return " ".join(new_words)
+
+        return feminize_text(text)
 
     # ------------------------------------------------------
     # Inject Character DNA (from Vision)
@@ -307,6 +78,7 @@ class StoryManager:
     def inject_character_dna(self, dna_description: str):
         """Inject detailed physical description extracted from Vision"""
         self.character_desc = dna_description
+        self._prompt_prefix = None
 
     # ------------------------------------------------------
     # Inject Personality Memory
@@ -318,6 +90,7 @@ class StoryManager:
             traits = []
 
         traits_text = ", ".join(traits)
+        self._prompt_prefix = None
 
         self.personality_block = f"""
 CHARACTER PERSONALITY MEMORY:
@@ -339,6 +112,7 @@ Expressions and body language should reflect these traits.
         If 'extracted_outfit' is provided (from AI analysis), it uses that.
         Otherwise, it falls back to age-appropriate defaults.
         """
+        self._prompt_prefix = None
         if extracted_outfit:
             self.outfit_lock = f"Wearing {extracted_outfit}"
             return
@@ -356,79 +130,74 @@ Expressions and body language should reflect these traits.
     # Build Full Prompt (Ultra Pro)
     # ------------------------------------------------------
 
-    def build_full_prompt(self, base_prompt):
-
+    def _build_prompt_prefix(self):
+        """Compiles the per-book invariant sections once (style, rules, DNA, outfit, personality)."""
         character_block = self.character_desc if self.character_desc else "A cute child character"
 
-        return f"""
-{MASTER_STYLE}
-
-{ANTI_DRIFT_RULES}
-
-MAIN CHARACTER DNA (DO NOT MODIFY):
-
-{character_block}
-
-OUTFIT LOCK:
-{self.outfit_lock}
+        # الترتيب هنا هو ترتيب الظهور؛ priority تحدد ما يُحذف أولاً عند تجاوز الحد
+        return _prompt_compiler.prefix([
+            PromptSection("", MASTER_STYLE, priority=4),
+            PromptSection("", ANTI_DRIFT_RULES, priority=3),
+            # Over budget, the DNA is shortened (after the optional sections are dropped), never the scene
+            PromptSection("MAIN CHARACTER DNA (DO NOT MODIFY)", character_block, priority=1, required=True,
+                          shrinkable=True),
+            PromptSection("OUTFIT LOCK", self.outfit_lock, priority=2),
+            PromptSection("", self.personality_block, priority=6),
+        ])
+
+    @property
+    def prompt_prefix(self):
+        if self._prompt_prefix is None:
+            self._prompt_prefix = self._build_prompt_prefix()
+        return self._prompt_prefix
+
+    @property
+    def prefix_hash(self):
+        """Stable key of the book's invariant prompt prefix (changes only when DNA/outfit/personality change)."""
+        return self.prompt_prefix.hash
 
-{self.personality_block}
-
-SCENE ACTION:
-{base_prompt}
-
-COMPOSITION:
-Wide environmental shots,
-Detailed background setting visible,
-Dynamic camera angles (low angle, side view, etc.),
-Rule of thirds,
-Balanced framing,
-Rich scene details.
-"""
+    def build_full_prompt(self, base_prompt):
+        # Only the scene varies per page; the prefix is compiled once per book
+        return self.prompt_prefix.compile([
+            PromptSection("SCENE ACTION", base_prompt, priority=0, required=True),
+            PromptSection("COMPOSITION", COMPOSITION_RULES, priority=5),
+        ]).text
 
     # ------------------------------------------------------
     # Generate Story Prompts
     # ------------------------------------------------------
 
-    def generate_story_prompts(self, json_filename, age_group):
+    def generate_story_prompts(self, value, age_group):
+        """
+        Args:
+            value: اسم القيمة بالعربية ("الشجاعة") أو اسم ملف المحتوى ("courage.json")
+            age_group: الفئة العمرية
+        """
 
-        filepath = os.path.join("stories_content", json_filename)
+        story = get_catalog().get(value, age_group)
 
-        if not os.path.exists(filepath):
-            logger.error(f"❌ Error: Could not find {filepath}")
+        if not story:
+            logger.error(f"❌ No story found for value={value} age_group={age_group}")
             return None
 
         try:
-            with open(filepath, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-
-            age_data = data.get("age_groups", {}).get(age_group)
-
-            if not age_data:
-                logger.error(f"❌ Age group {age_group} not found in {json_filename}")
-                return None
-
             # Ensure we don't overwrite the outfit if it was already set externally
             # self.set_outfit_by_age(age_group) # Removed to preserve extracted outfit
 
             generated_pages = []
 
-            for page in age_data.get('pages', []):
-
-                raw_prompt = page.get('magic_image_prompt', page.get('prompt', ''))
+            for page in story.pages:
 
-                full_prompt = self.build_full_prompt(base_prompt=raw_prompt)
+                full_prompt = self.build_full_prompt(base_prompt=page.prompt)
 
-                # 1. Replace name first
-                display_text = page.get('text', '').replace("{child_name}", self.child_name)
-                
-                # 2. Apply gender adaptation (if girl)
-                display_text = self._apply_gender_replacements(display_text)
+                # Gender variants are precomputed by the catalog; only the name varies
+                display_text = page.render_text(self.child_name, feminine=self.gender != "ولد")
 
                 page_payload = {
-                    "page": page.get('page_number'),
+                    "page": page.page_number,
                     "text": display_text,
-                    "prompt": full_prompt
+                    "prompt": full_prompt,
+                    "prefix_hash": self.prefix_hash
                 }
 
                 generated_pages.append(page_payload)
@@ -436,5 +205,5 @@ Rich scene details.
             return generated_pages
 
         except Exception as e:
-            logger.error(f"❌ Error loading JSON: {e}")
+            logger.error(f"❌ Error preparing story pages: {e}")
             return None
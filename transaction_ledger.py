@@ -0,0 +1,205 @@
+"""
+سجل معاملات الدفع المستخدمة (Transaction Ledger)
+
+يحفظ أرقام المعاملات (وأحكام صور الإيصالات السابقة وطلبات Paymob) في قاعدة SQLite مفهرسة
+بدلاً من قائمة JSON كاملة تُقرأ وتُكتب مع كل عملية تحقق. البحث O(1) عبر الـ PRIMARY KEY، والكتابة
+إلحاقية (INSERT فقط) داخل transaction، والقفل بين العمليات (workers)
+تتولاه SQLite نفسها.
+"""
+
+import os
+import json
+import sqlite3
+import logging
+import threading
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+LEDGER_PATH = os.getenv("TRANSACTION_LEDGER_PATH", "used_transactions.db")
+LEGACY_TRACKING_FILE = "used_transactions.json"
+
+# رقم المعاملة الذي لا يمكن تتبعه (لم يستخرجه نموذج الرؤية)
+UNKNOWN_TX_ID = "UNKNOWN"
+
+
+class TransactionLedger:
+    """سجل إلحاقي لأرقام المعاملات مع فحص وتسجيل ذرّي في خطوة واحدة"""
+
+    def __init__(self, path: str = LEDGER_PATH, legacy_path: Optional[str] = LEGACY_TRACKING_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS used_transactions ("
+            "tx_id TEXT PRIMARY KEY, "
+            "recorded_at TEXT NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS screenshot_verdicts ("
+            "screenshot_hash TEXT PRIMARY KEY, "
+            "is_valid INTEGER NOT NULL, "
+            "reason TEXT NOT NULL, "
+            "recorded_at TEXT NOT NULL"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS payment_orders ("
+            "order_id TEXT PRIMARY KEY, "
+            "sender_id TEXT NOT NULL, "
+            "product TEXT, "
+            "recorded_at TEXT NOT NULL, "
+            "context TEXT"
+            ") WITHOUT ROWID"
+        )
+        self._add_column("payment_orders", "context", "TEXT")
+        if legacy_path:
+            self._import_legacy(legacy_path)
+
+    def _add_column(self, table: str, column: str, column_type: str):
+        """إضافة عمود لجدول أُنشئ بإصدار أقدم من السجل"""
+        columns = {row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")}
+        if column in columns:
+            return
+        try:
+            self._conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+        except sqlite3.OperationalError as e:
+            if "duplicate column" not in str(e):
+                raise  # عامل آخر أضاف العمود في نفس اللحظة هو الحالة الوحيدة المقبولة
+
+    def _import_legacy(self, legacy_path: str):
+        """ترحيل ملف used_transactions.json القديم (مرة واحدة) إلى السجل"""
+        if not os.path.exists(legacy_path):
+            return
+        try:
+            with open(legacy_path, "r") as f:
+                used_ids = json.load(f)
+        except FileNotFoundError:
+            return  # عامل آخر بدأ في نفس اللحظة ورحّل الملف قبلنا
+        except Exception as e:
+            logger.warning(f"⚠️ Could not read legacy ledger {legacy_path}: {e}")
+            return
+
+        now = datetime.now().isoformat()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO used_transactions (tx_id, recorded_at) VALUES (?, ?)",
+                    [(str(tx_id), now) for tx_id in used_ids if tx_id and tx_id != UNKNOWN_TX_ID]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        try:
+            os.replace(legacy_path, legacy_path + ".migrated")
+        except FileNotFoundError:
+            # عامل آخر رحّل نفس الملف (الإدخال بـ INSERT OR IGNORE فلا تكرار)
+            return
+        logger.info(f"✅ Migrated {len(used_ids)} transaction IDs from {legacy_path}")
+
+    def contains(self, tx_id: str) -> bool:
+        """هل تم استخدام رقم المعاملة من قبل؟"""
+        if not tx_id or tx_id == UNKNOWN_TX_ID:
+            return False
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM used_transactions WHERE tx_id = ?", (tx_id,)
+            ).fetchone()
+        return row is not None
+
+    def claim(self, tx_id: str) -> bool:
+        """
+        تسجيل رقم المعاملة وإرجاع الحكم في خطوة ذرّية واحدة
+
+        Returns:
+            True إذا كان الرقم جديداً وتم تسجيله، False إذا كان مكرراً
+        """
+        if not tx_id or tx_id == UNKNOWN_TX_ID:
+            return True  # لا يمكن تتبع الأرقام المجهولة
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO used_transactions (tx_id, recorded_at) VALUES (?, ?)",
+                (tx_id, datetime.now().isoformat())
+            )
+        return cursor.rowcount == 1
+
+    def get_screenshot_verdict(self, screenshot_hash: str) -> Optional[Tuple[bool, str]]:
+        """حكم سابق على نفس صورة الإيصال (بعد التجهيز)، أو None إذا لم تُرَ من قبل"""
+        if not screenshot_hash:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT is_valid, reason FROM screenshot_verdicts WHERE screenshot_hash = ?",
+                (screenshot_hash,)
+            ).fetchone()
+        return (bool(row[0]), row[1]) if row else None
+
+    def record_screenshot_verdict(self, screenshot_hash: str, is_valid: bool, reason: str) -> bool:
+        """
+        تسجيل حكم نموذج الرؤية على صورة الإيصال (حكم سابق بالرفض يُستبدل)
+
+        Returns:
+            False إذا كانت الصورة مقبولة ومسجلة بالفعل (عامل آخر سبقنا إليها)
+        """
+        if not screenshot_hash:
+            return True
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO screenshot_verdicts (screenshot_hash, is_valid, reason, recorded_at) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(screenshot_hash) DO UPDATE SET is_valid = excluded.is_valid, "
+                "reason = excluded.reason, recorded_at = excluded.recorded_at "
+                "WHERE screenshot_verdicts.is_valid = 0",
+                (screenshot_hash, int(is_valid), reason, datetime.now().isoformat())
+            )
+        return cursor.rowcount == 1
+
+    def record_order(self, order_id, sender_id: str, product: Optional[str] = None,
+                     context: Optional[Dict] = None):
+        """
+        ربط رقم طلب Paymob بالمستخدم الذي أنشأه (لاستقبال تأكيد الدفع لاحقاً)
+
+        Args:
+            context: اختيارات المستخدم وقت الطلب (القيمة، العمر، ...) لتنفيذ الطلب
+                بعد التأكيد حتى لو أُعيد تشغيل السيرفر وضاعت حالة المحادثة
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO payment_orders (order_id, sender_id, product, recorded_at, context) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (str(order_id), sender_id, product, datetime.now().isoformat(),
+                 json.dumps(context, ensure_ascii=False) if context else None)
+            )
+
+    def lookup_order(self, order_id) -> Optional[Tuple[str, Optional[str], Dict]]:
+        """(sender_id, product, context) لرقم الطلب، أو None إذا لم يكن معروفاً"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT sender_id, product, context FROM payment_orders WHERE order_id = ?", (str(order_id),)
+            ).fetchone()
+        return (row[0], row[1], json.loads(row[2]) if row[2] else {}) if row else None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_ledger: Optional[TransactionLedger] = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger() -> TransactionLedger:
+    """السجل المشترك للعملية (يُنشأ عند أول استخدام)"""
+    global _ledger
+    if _ledger is None:
+        with _ledger_lock:
+            if _ledger is None:
+                _ledger = TransactionLedger()
+    return _ledger